@@ -39,6 +39,16 @@ def main():
     settings = SELMAGUISettings.SelmaSettings() #SelmaSettings class is getting called here
     settings.applySettings() #applySettings function is called within SelmaSettings
 
+    connectSignals(SGM, SDM)
+
+    # ---------------------------------------
+    sys.exit(app.exec_())
+
+
+def connectSignals(SGM, SDM):
+    """Connects the signals of the GUI model and the data model to each
+    other's slots."""
+
     # Connect signals
     # ----------------------------------------
     # Signals from mainwindow (menubar)
@@ -50,13 +60,19 @@ def main():
     SGM.mainWin.openT1Signal        .connect(SDM.loadT1DCMSlot)
     SGM.mainWin.analyseVesselSignal .connect(SDM.analyseVesselSlot)
     SGM.mainWin.analyseBatchSignal  .connect(SDM.analyseBatchSlot)
+    SGM.mainWin.sweepSignal         .connect(SDM.sweepSlot)
+    SGM.mainWin.cancelAnalysisSignal.connect(SDM.cancelAnalysisSlot)
     SGM.mainWin.switchViewSignal    .connect(SDM.switchViewSlot)
+    SGM.mainWin.playSignal          .connect(SDM.playSlot)
     SGM.mainWin.applyMaskSignal     .connect(SDM.applyMaskSlot)
     SGM.mainWin.saveMaskSignal      .connect(SDM.saveMaskSlot)
 
     # Signals from mouseEvents
-    SGM.mainWin._imageViewer._scene.mouseMove.connect(SDM.pixelValueSlot)
+    SGM.mainWin._imageViewer._view.wheelEventSignal.connect(
+                                                SGM.mainWin.storeMaskSlot)
     SGM.mainWin._imageViewer._view.wheelEventSignal.connect(SDM.newFrameSlot)
+    SGM.mainWin._imageViewer.playbackFrameSignal.connect(
+                                                SDM.playbackFrameSlot)
 
     # Signals from ImVar
     SGM.mainWin.signalObj.getVarSignal.connect(
@@ -64,6 +80,10 @@ def main():
     SGM.mainWin.signalObj.setVarSignal.connect(
             SDM.setVarSlot)
 
+    # Signals from the batch progress window
+    SGM.mainWin.batchWindow.pauseSignal.connect(SDM.pauseBatchSlot)
+    SGM.mainWin.batchWindow.stopSignal .connect(SDM.stopBatchSlot)
+
     #Signals from settings
     SGM.mainWin.settingsWindow.thresholdSignal.connect(
         SDM.thresholdMaskSlot)
@@ -71,18 +91,23 @@ def main():
     #Signals from processing
     SDM.signalObject.sendVesselMaskSignal       .connect(SGM.setVesselMaskSlot)
     SDM.signalObject.setPixmapSignal            .connect(SGM.setPixmapSlot)
+    SDM.signalObject.setFramesSignal            .connect(SGM.setFramesSlot)
+    SDM.signalObject.showFrameSignal            .connect(SGM.showFrameSlot)
+    SDM.signalObject.playFramesSignal           .connect(SGM.playFramesSlot)
     SDM.signalObject.setProgressBarSignal       .connect(SGM.setProgressBarSlot)
     SDM.signalObject.setFrameCountSignal        .connect(SGM.setFrameCounterSlot)
     SDM.signalObject.sendMaskSignal             .connect(SGM.setMaskSlot)
-    SDM.signalObject.pixelValueSignal           .connect(SGM.mainWin._imageViewer.mouseHover)
     SDM.signalObject.errorMessageSignal         .connect(SGM.mainWin.errorMessageSlot)
     SDM.signalObject.infoMessageSignal          .connect(SGM.mainWin.infoMessageSlot)
     SDM.signalObject.sendImVarSignal            .connect(SGM.listenForVarsSlot)
     SDM.signalObject.setProgressLabelSignal     .connect(SGM.setProgressLabelSlot)
-
-
-    # ---------------------------------------
-    sys.exit(app.exec_())
+    SDM.signalObject.analysisProgressSignal     .connect(SGM.setAnalysisProgressSlot)
+    SDM.signalObject.clearFramesSignal          .connect(SGM.clearFramesSlot)
+    SDM.signalObject.busySignal                 .connect(SGM.setBusySlot)
+    SDM.signalObject.batchBusySignal            .connect(SGM.setBatchBusySlot)
+    SDM.signalObject.batchProgressSignal        .connect(SGM.setBatchProgressSlot)
+    SDM.signalObject.batchStageSignal           .connect(SGM.setBatchStageSlot)
+    SDM.signalObject.batchFailedSignal          .connect(SGM.batchFailedSlot)
 
 
 
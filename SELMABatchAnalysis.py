@@ -6,6 +6,8 @@ Created on Tue Jul  6 15:10:14 2021
 """
 
 import os
+import threading
+import traceback
 import numpy as np
 from PyQt5 import (QtCore)
 
@@ -13,7 +15,66 @@ import SELMAData
 import SELMADataIO
 import SELMADataModels
 
-def EnhancedBatchAnalysis(dirName, files, self):
+
+class BatchControl:
+    """
+    Lets the GUI pause a running batch analysis, or stop it after the 
+    current scan. Both take effect between two scans.
+    """
+    
+    def __init__(self):
+        self._resume    = threading.Event()
+        self._stop      = threading.Event()
+        self._resume.set()
+        
+    def pause(self):
+        self._resume.clear()
+        
+    def resume(self):
+        self._resume.set()
+        
+    def stop(self):
+        self._stop.set()
+        self._resume.set()
+        
+    def waitForNextScan(self, cancelEvent = None):
+        """
+        Waits while the batch is paused.
+        
+        Args:
+            cancelEvent(threading.Event): cancellation token of the 
+            analysis, stops waiting when it is set.
+            
+        Returns:
+            False if the batch should stop before the next scan.
+        """
+        
+        while not self._resume.wait(0.1):
+            if cancelEvent is not None and cancelEvent.is_set():
+                return False
+        
+        if cancelEvent is not None and cancelEvent.is_set():
+            return False
+        
+        return not self._stop.is_set()
+    
+
+def EnhancedBatchAnalysis(dirName, files, self, cancelEvent = None,
+                          batchControl = None):
+    """
+    Analyses all enhanced dicoms in dirName that have a mask. Runs in an
+    AnalysisWorker of the data model (self).
+    
+    Args:
+        dirName(str): path to the directory.
+        files(list): the files in the directory.
+        self(SelmaDataModel): the data model that started the batch.
+        cancelEvent(threading.Event): cancellation token of the analysis.
+        batchControl(BatchControl): used to pause or stop the batch.
+    """
+    
+    if batchControl is None:
+        batchControl = BatchControl()
 
     #Make list of all suitable .dcm files
     dcms = []
@@ -21,7 +82,6 @@ def EnhancedBatchAnalysis(dirName, files, self):
         if file.find(".dcm") != -1 and file.find("mask") == -1:
             dcms.append(file)
   
-    i       = 0 
     total   = len(dcms)
     
     if not dcms:
@@ -32,219 +92,315 @@ def EnhancedBatchAnalysis(dirName, files, self):
         
         return
 
-    batchAnalysisResults = dict()
+    #Results are appended to the store as each scan finishes
+    storeName   = dirName + '/batchAnalysisResults.h5'
+    SELMADataIO.createBatchResultsStore(storeName)
     
     #Iterate over all suitable .dcm files.
-    for dcm in dcms:
-
-        self.signalObject.setProgressLabelSignal.emit(
-                "Patient %.0f out of %.0f" %(i + 1, total))
-        
-        self._SDO   = SELMAData.SELMADataObject(self.signalObject,
-                                                dcmFilename = dirName 
-                                                + '/' + dcm,
-                                                classic = False)
-        
-        name        = dcm[:-4]
-        #find mask
-
-        for file in files:
-            if file.find(name) != -1 and file.find("mask") != -1:
-                if file[-4:] == ".dcm" or file[-4:] == ".npy":
-                    #Now it will find the dcm object itself.
-#                        self._SDO.setT1(file)
-#                        break
-                    pass
-                else:
-                    
-                    try:
-                        
-                        mask = SELMADataIO.loadMask(dirName + '/' + 
-                                                    file)
-                                                
-                        self._SDO.setMask(mask)
-                        
-                    except:
-                    
-                        self.signalObject.errorMessageSignal.emit(
-            "The mask of %s has a version of .mat file that " %(dcm) +
-            "is not supported. Please save it as a non-v7.3 file "+
-            "and try again. Moving on to next scan.")
-                        
-                        #return
-
-                        break
-        
-        #If no mask is found, move on to the next image
-        if self._SDO.getMask() is None:
+    done    = 0
+    try:
+        for dcm in dcms:
             
-            self.signalObject.infoMessageSignal.emit(
-             "Mask of %s not found in folder. Moving to next scan"
-             %(dcm))
+            if not batchControl.waitForNextScan(cancelEvent):
+                break
             
-            continue
-        
-        #Do vessel analysis
-        self._SDO.analyseVessels()
- 
-        
-        #Save results
-        #TODO: support for other output types.
-        vesselDict, velocityDict = self._SDO.getVesselDict()
-                        
-        if not bool(vesselDict):
+            self.signalObject.batchProgressSignal.emit(done, total, dcm)
             
-            continue
+            try:
+                _analyseEnhancedScan(dirName, files, dcm, self, cancelEvent,
+                                     storeName)
+            except SELMAData.AnalysisCancelled:
+                raise
+            except Exception as e:
+                _reportFailure(self, dcm, e)
+            done   += 1
+    
+    finally:
+        #Legacy output for MATLAB users, also when the batch was stopped
+        outputName = dirName + '/batchAnalysisResults.mat' 
+        SELMADataIO.convertBatchResultsStore(storeName, outputName)
+    
+    self.signalObject.batchProgressSignal.emit(done, total, "")
+    _reportFinished(self, done, total)
   
-        #Save in single file
-        #batchAnalysisResults[i] = self._SDO.getBatchAnalysisResults()
-        batchAnalysisResults[i] = SELMADataIO.getBatchAnalysisResults(self._SDO)
+    
+def createScanSignals(signalObject):
+    """
+    Creates the signals of the SELMADataObject of a scan in a batch. Only
+    the stage of the analysis and the messages are passed on to the 
+    signals of the data model. The masks and the progress of the scan are
+    not sent to the main window, so the scan that is shown in the GUI and
+    its analysis are not changed.
+    
+    Args:
+        signalObject(SDMSignals): the signals of the data model.
         
-        outputName = dirName + '/batchAnalysisResults.mat' 
-        SELMADataIO.writeBatchAnalysisDict(batchAnalysisResults, 
-                                           outputName)
-              
-        #Emit progress to progressbar
-        self.signalObject.setProgressBarSignal.emit(int(100 * i / 
-                                                        total))
-            
-        i += 1
+    Returns:
+        scanSignals(SDMSignals): the signals of the scan.
+    """
     
-    outputName = dirName + '/batchAnalysisResults.mat' 
-    SELMADataIO.writeBatchAnalysisDict(batchAnalysisResults, 
-                                       outputName)
+    scanSignals = SELMADataModels.SDMSignals()
     
-    #Emit progress to progressbar
-    self.signalObject.setProgressBarSignal.emit(int(100))
-    self.signalObject.setProgressLabelSignal.emit(
-                "Batch analysis complete!"
-                )
-  
-def ClassicBatchAnalysis(dirName, files, self):
+    for name in ('errorMessageSignal', 'infoMessageSignal'):
+        getattr(scanSignals, name).connect(getattr(signalObject, name))
+        
+    #The stage is shown in the batch window
+    scanSignals.analysisProgressSignal.connect(
+        signalObject.batchStageSignal)
+        
+    return scanSignals
     
-    i       = 0 
-    total   = len(files)
     
-    batchAnalysisResults = dict()
+def findMaskFile(files, dcm):
+    """
+    Finds the mask of an enhanced dicom: the first file that has the name
+    of the dicom and 'mask' in its name. Dicom and .npy files are skipped.
     
-    for subject in files:
+    Args:
+        files(list): the files in the directory of the dicom.
+        dcm(str): file name of the dicom.
         
-        if not os.path.isdir(dirName + '/' + subject):
+    Returns:
+        maskFile(str): file name of the mask, or None if there is none.
+    """
+    
+    name    = dcm[:-4]
+    
+    for file in files:
+        if file.find(name) != -1 and file.find("mask") != -1:
+            if file[-4:] != ".dcm" and file[-4:] != ".npy":
+                return file
             
-            continue
+    return None
+    
+    
+def _analyseEnhancedScan(dirName, files, dcm, self, cancelEvent, storeName):
+    """Analyses a single scan of EnhancedBatchAnalysis and appends the 
+    results to the store. The scan gets its own SELMADataObject, so the 
+    scan that is shown in the GUI is not changed."""
+    
+    sdo     = SELMAData.SELMADataObject(createScanSignals(self.signalObject),
+                                        dcmFilename = dirName + '/' + dcm,
+                                        classic = False)
+    
+    #find mask
+    maskFile    = findMaskFile(files, dcm)
+    if maskFile is not None:
+        
+        try:
+            
+            mask = SELMADataIO.loadMask(dirName + '/' + maskFile)
+                                    
+            sdo.setMask(mask)
+            
+        except:
         
-        subject_folder = os.listdir(dirName + '/' + subject)
+            self.signalObject.errorMessageSignal.emit(
+        "The mask of %s has a version of .mat file that " %(dcm) +
+        "is not supported. Please save it as a non-v7.3 file "+
+        "and try again. Moving on to next scan.")
+    
+    #If no mask is found, move on to the next image
+    if sdo.getMask() is None:
         
-        dcmFilename = []
+        self.signalObject.infoMessageSignal.emit(
+         "Mask of %s not found in folder. Moving to next scan"
+         %(dcm))
         
-        for file in subject_folder:
-            
-            if file.endswith('.mat'):
-                
-                if file.find('mask') != -1:
-                    
-                    try:
-                        
-                        mask = SELMADataIO.loadMask(dirName + '/' + 
-                                                    subject + '/' + 
-                                                    file)
+        return
+    
+    #Do vessel analysis
+    sdo.analyseVessels(cancelEvent)
     
-                    except:
+    #Save results
+    #TODO: support for other output types.
+    vesselDict, velocityDict = sdo.getVesselDict()
                     
-                        self.signalObject.errorMessageSignal.emit(
-            "The mask of %s has a version of .mat file that " 
-            %(subject) + "is not supported. Please save it as a " + 
-            "non-v7.3 file and try again. Moving on to next scan.")
-                        
-                        #return
-    
-                        break
-                
-                continue
-            
-            elif file.endswith('.log'):
-                
-                continue
+    if not bool(vesselDict):
+        
+        return
+
+    #Save in single file
+    SELMADataIO.appendBatchResultsStore(
+        SELMADataIO.getBatchAnalysisResults(sdo),
+        vesselDict,
+        storeName)
+  
+    
+def ClassicBatchAnalysis(dirName, files, self, cancelEvent = None,
+                         batchControl = None):
+    """
+    Analyses the classic dicoms in every subject folder in dirName. Runs 
+    in an AnalysisWorker of the data model (self).
+    
+    Args:
+        dirName(str): path to the directory.
+        files(list): the files and subject folders in the directory.
+        self(SelmaDataModel): the data model that started the batch.
+        cancelEvent(threading.Event): cancellation token of the analysis.
+        batchControl(BatchControl): used to pause or stop the batch.
+    """
+    
+    if batchControl is None:
+        batchControl = BatchControl()
+    
+    subjects    = [subject for subject in files
+                   if os.path.isdir(dirName + '/' + subject)]
+    total       = len(subjects)
+    
+    #Results are appended to the store as each scan finishes
+    storeName   = dirName + '/batchAnalysisResults.h5'
+    SELMADataIO.createBatchResultsStore(storeName)
+    
+    done        = 0
+    try:
+        for subject in subjects:
             
-            # elif file.endswith('.dcm'): # In case of Marseille data
-                
-            #     continue
+            if not batchControl.waitForNextScan(cancelEvent):
+                break
             
-            elif file.endswith('.npy'):
-                
-                continue
+            self.signalObject.batchProgressSignal.emit(done, total, subject)
             
-            elif file.endswith('.xml'):
-                
-                continue
+            try:
+                _analyseClassicSubject(dirName, subject, self, cancelEvent,
+                                       storeName)
+            except SELMAData.AnalysisCancelled:
+                raise
+            except Exception as e:
+                _reportFailure(self, subject, e)
+            done   += 1
+    
+    finally:
+        #Legacy output for MATLAB users, also when the batch was stopped
+        outputName = dirName + '/batchAnalysisResults.mat' 
+        SELMADataIO.convertBatchResultsStore(storeName, outputName)
+    
+    self.signalObject.batchProgressSignal.emit(done, total, "")
+    _reportFinished(self, done, total)
+    
+
+def _analyseClassicSubject(dirName, subject, self, cancelEvent, storeName):
+    """Analyses the scan of a single subject of ClassicBatchAnalysis and
+    appends the results to the store."""
+    
+    mask    = None
+    
+    subject_folder = os.listdir(dirName + '/' + subject)
+    
+    dcmFilename = []
+    
+    for file in subject_folder:
+        
+        if file.endswith('.mat'):
             
-            elif file.endswith('.txt'):
+            if file.find('mask') != -1:
                 
-                continue
-            
-            # Skip DICOMDIR files
-            elif os.path.getsize(dirName + '/' + subject + '/' 
-                                 + file) < 100000:
+                try:
+                    
+                    mask = SELMADataIO.loadMask(dirName + '/' + 
+                                                subject + '/' + 
+                                                file)
+
+                except:
                 
-                continue
-            
-            else:
-    
-                dcmFilename.append(dirName + '/' + subject + '/' + file)
-            
-        if dcmFilename == []:
+                    self.signalObject.errorMessageSignal.emit(
+        "The mask of %s has a version of .mat file that " 
+        %(subject) + "is not supported. Please save it as a " + 
+        "non-v7.3 file and try again. Moving on to next scan.")
+                    
+                    #return
+
+                    break
             
             continue
         
-        self.signalObject.setProgressLabelSignal.emit(
-                "Patient %.0f out of %.0f" %(i + 1, total))
+        elif file.endswith('.log'):
+            
+            continue
         
-        self._SDO   = SELMAData.SELMADataObject(self.signalObject,
-                                                dcmFilename ,
-                                                classic = True)
+        # elif file.endswith('.dcm'): # In case of Marseille data
+            
+        #     continue
         
-        self._SDO.setMask(mask)
-                                 
-        #If no mask is found, move on to the next image
-        if self._SDO.getMask() is None:
+        elif file.endswith('.npy'):
             
-            self.signalObject.infoMessageSignal.emit(
-             "Mask of %s not found in folder. Moving to next subject"
-             %(subject))
+            continue
+        
+        elif file.endswith('.xml'):
             
             continue
         
-        #Do vessel analysis
-        self._SDO.analyseVessels()
-      
-        #Save results
-        #TODO: support for other output types.
-        vesselDict, velocityDict = self._SDO.getVesselDict()
+        elif file.endswith('.txt'):
+            
+            continue
         
-        if not bool(vesselDict):
+        # Skip DICOMDIR files
+        elif os.path.getsize(dirName + '/' + subject + '/' 
+                             + file) < 100000:
             
             continue
+        
+        else:
+
+            dcmFilename.append(dirName + '/' + subject + '/' + file)
+        
+    if dcmFilename == []:
+        
+        return
+    
+    sdo     = SELMAData.SELMADataObject(createScanSignals(self.signalObject),
+                                        dcmFilename ,
+                                        classic = True)
     
-        #Save in single file
-        #batchAnalysisResults[i] = self._SDO.getBatchAnalysisResults()
-        batchAnalysisResults[i] = SELMADataIO.getBatchAnalysisResults(self._SDO)
+    sdo.setMask(mask)
+                             
+    #If no mask is found, move on to the next image
+    if sdo.getMask() is None:
         
-        outputName = dirName + '/batchAnalysisResults.mat' 
-        SELMADataIO.writeBatchAnalysisDict(batchAnalysisResults, 
-                                           outputName)
-              
-        #Emit progress to progressbar
-        self.signalObject.setProgressBarSignal.emit(int(100 * i 
-                                                        / total))
-            
-        i += 1
+        self.signalObject.infoMessageSignal.emit(
+         "Mask of %s not found in folder. Moving to next subject"
+         %(subject))
+        
+        return
+    
+    #Do vessel analysis
+    sdo.analyseVessels(cancelEvent)
+  
+    #Save results
+    #TODO: support for other output types.
+    vesselDict, velocityDict = sdo.getVesselDict()
+    
+    if not bool(vesselDict):
         
-    outputName = dirName + '/batchAnalysisResults.mat' 
-    SELMADataIO.writeBatchAnalysisDict(batchAnalysisResults, 
-                                       outputName)
+        return
+
+    #Save in single file
+    SELMADataIO.appendBatchResultsStore(
+        SELMADataIO.getBatchAnalysisResults(sdo),
+        vesselDict,
+        storeName)
+
+
+def _reportFailure(self, scan, error):
+    """Tells the user that the analysis of a scan stopped because of an
+    error. The batch moves on to the next scan."""
+    
+    traceback.print_exc()
+    self.signalObject.batchFailedSignal.emit(scan, str(error))
+    
+
+def _reportFinished(self, done, total):
+    """Tells the user that the batch analysis has finished or was 
+    stopped."""
     
     #Emit progress to progressbar
     self.signalObject.setProgressBarSignal.emit(int(100))
-    self.signalObject.setProgressLabelSignal.emit(
+    
+    if done < total:
+        self.signalObject.setProgressLabelSignal.emit(
+                "Batch analysis stopped after %.0f out of %.0f scans"
+                %(done, total))
+    else:
+        self.signalObject.setProgressLabelSignal.emit(
                 "Batch analysis complete!"
-                )    
\ No newline at end of file
+                )
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+
+"""
+This module contains a benchmark of the responsiveness of the viewer. It
+runs the SELMAMainWindow with the offscreen Qt platform on synthetic scans
+and times the following interactions, from the signal that starts them up
+to the moment the viewport is painted:
+
++ Frame scroll:       a wheel step of the view, through newFrameSlot.
++ Contrast drag:      a burst of mouse moves while dragging with the 
+                      middle mouse button, until the coalesced contrast
+                      and brightness update is shown.
++ ROI stroke:         the release of the mouse button that completes a
+                      drawn ROI (finishDrawing).
++ Mask threshold:     thresholding the white matter probability map after
+                      the threshold in the settings was changed.
++ Vessel overlay:     showing a vessel mask that was sent by the analysis.
+
+For every image size the median (p50) and 95th percentile (p95) of the
+latencies are reported in milliseconds. Run it with:
+
+    python SELMABenchmark.py --sizes 128 256 512 --repeats 50
+
+The settings are read from and written to a temporary directory, so the
+settings of the user are not changed.
+
+"""
+
+# ====================================================================
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+
+from PyQt5 import (QtCore, QtGui, QtWidgets)
+
+# ====================================================================
+
+import SELMA
+import SELMADataModels
+import SELMAGUIModels
+import SELMAGUISettings
+
+# ====================================================================
+
+INTERACTIONS    = ("Frame scroll", "Contrast drag", "ROI stroke",
+                   "Mask threshold", "Vessel overlay")
+
+PHILIPS_CREATOR = "Philips MR Imaging DD 001"
+
+
+def writeSyntheticDicom(fname, size, numFrames, seed = 0):
+    """
+    Writes an enhanced Philips dicom with noise frames that SELMADicom
+    can read. The first half of the frames are magnitude frames, the
+    second half velocity frames.
+
+    Args:
+        fname(str): path of the dicom file.
+        size(int): number of rows and columns of the frames.
+        numFrames(int): number of frames.
+        seed(int): seed of the random frames.
+    """
+
+    rng             = np.random.RandomState(seed)
+    rawFrames       = rng.randint(0, 4096, (numFrames, size, size)
+                                  ).astype(np.uint16)
+
+    meta                            = FileMetaDataset()
+    meta.MediaStorageSOPClassUID    = "1.2.840.10008.5.1.4.1.1.4.1"
+    meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    meta.TransferSyntaxUID          = pydicom.uid.ExplicitVRLittleEndian
+
+    dcm                             = FileDataset(fname, {},
+                                                  file_meta = meta,
+                                                  preamble = b"\0" * 128)
+    dcm.is_little_endian            = True
+    dcm.is_implicit_VR              = False
+    dcm.SOPClassUID                 = meta.MediaStorageSOPClassUID
+    dcm.Manufacturer                = "Philips Medical Systems"
+    dcm.Modality                    = "MR"
+    dcm.Rows                        = size
+    dcm.Columns                     = size
+    dcm.NumberOfFrames              = numFrames
+    dcm.SamplesPerPixel             = 1
+    dcm.PhotometricInterpretation   = "MONOCHROME2"
+    dcm.BitsAllocated               = 16
+    dcm.BitsStored                  = 12
+    dcm.HighBit                     = 11
+    dcm.PixelRepresentation         = 0
+    dcm.CardiacRRIntervalSpecified  = 1000
+    dcm.GradientEchoTrainLength     = 3
+    dcm.add_new((0x2005, 0x0010), "LO", PHILIPS_CREATOR)
+
+    timing                          = Dataset()
+    timing.RepetitionTime           = 20.0
+    shared                          = Dataset()
+    shared.MRTimingAndRelatedParametersSequence = Sequence([timing])
+    dcm.SharedFunctionalGroupsSequence          = Sequence([shared])
+
+    perFrameGroups  = []
+    for i in range(numFrames):
+        if i < numFrames // 2:
+            imageType   = ["ORIGINAL", "PRIMARY", "M_FFE", "M", "FFE"]
+        else:
+            imageType   = ["ORIGINAL", "PRIMARY", "VELOCITY MAP", "P", "PCA"]
+
+        private             = Dataset()
+        private.add_new((0x2005, 0x0010), "LO", PHILIPS_CREATOR)
+        private.add_new((0x2005, 0x100E), "FL", 1.0)
+        private.add_new((0x2005, 0x100D), "FL", 0.0)
+        private.ImageType   = imageType
+
+        venc                = Dataset()
+        venc.VelocityEncodingMaximumValue   = 40
+        measures            = Dataset()
+        measures.PixelSpacing               = [0.6, 0.6]
+        measures.SliceThickness             = 2.0
+
+        group               = Dataset()
+        group.add_new((0x2005, 0x0010), "LO", PHILIPS_CREATOR)
+        group.add_new((0x2005, 0x140f), "SQ", Sequence([private]))
+        group.MRVelocityEncodingSequence    = Sequence([venc])
+        group.PixelMeasuresSequence         = Sequence([measures])
+        perFrameGroups.append(group)
+
+    dcm.PerFrameFunctionalGroupsSequence    = Sequence(perFrameGroups)
+    dcm.PixelData                           = rawFrames.tobytes()
+    dcm.save_as(fname, write_like_original = False)
+
+
+# ====================================================================
+
+class ViewerBenchmark:
+    """
+    Times the interactions with the viewer of a SELMAMainWindow that is
+    connected to a SelmaDataModel, the same way as in SELMA.main.
+    """
+
+    def __init__(self, app):
+
+        self._app       = app
+        self._SGM       = SELMAGUIModels.SelmaGUIModel()
+        self._SDM       = SELMADataModels.SelmaDataModel()
+        SELMA.connectSignals(self._SGM, self._SDM)
+
+        self._viewer    = self._SGM.mainWin._imageViewer
+        self._scene     = self._viewer._scene
+        self._settings  = _getSettings()
+
+
+    '''Public'''
+
+    def loadScan(self, fname):
+        """Opens the scan and waits until all its frames are read."""
+
+        self._SDM.loadDCMSlot(fname)
+        while self._SDM._busy:
+            self._app.processEvents()
+            time.sleep(0.001)
+        self._paint()
+
+    def run(self, repeats):
+        """
+        Times every interaction repeats times on the loaded scan.
+
+        Returns:
+            latencies(dict): the latencies in seconds per interaction.
+        """
+
+        return {"Frame scroll":     self.timeFrameScroll(repeats),
+                "Contrast drag":    self.timeContrastDrag(repeats),
+                "ROI stroke":       self.timeROIStroke(repeats),
+                "Mask threshold":   self.timeMaskThreshold(repeats),
+                "Vessel overlay":   self.timeVesselOverlay(repeats)}
+
+    def timeFrameScroll(self, repeats):
+        """Times a wheel step of the view to the next frame."""
+
+        wheelEventSignal    = self._viewer._view.wheelEventSignal
+        return [self._time(lambda: wheelEventSignal.emit(1))
+                for _ in range(repeats)]
+
+    def timeContrastDrag(self, repeats):
+        """Times a drag with the middle mouse button. Every repeat sends a
+        burst of mouse moves, which the scene coalesces into one contrast 
+        and brightness update when its update timer fires. The drag ends
+        where it started, so the contrast is restored."""
+
+        rect        = self._scene.sceneRect()
+        centre      = rect.center()
+        button      = QtCore.Qt.MiddleButton
+
+        self._sendMouseEvent(QtCore.QEvent.MouseButtonPress, centre, button)
+        self._paint()
+
+        latencies   = []
+        previous    = centre
+        for i in range(repeats):
+            target  = centre + QtCore.QPointF(
+                                    0.4 * rect.width()  * np.sin(i / 5),
+                                    0.2 * rect.height() * np.cos(i / 7))
+            points  = [previous + (target - previous) * (j / 4)
+                       for j in range(1, 5)]
+            previous = target
+
+            latencies.append(self._time(
+                lambda: self._dragTo(points, button)))
+
+        self._dragTo([centre], button)
+        self._sendMouseEvent(QtCore.QEvent.MouseButtonRelease, centre,
+                             button)
+        self._paint()
+
+        return latencies
+
+    def timeROIStroke(self, repeats):
+        """Times the release of the mouse button that completes a drawn
+        ROI. The ROIs are circles that are alternately added to and
+        removed from the mask."""
+
+        rect        = self._scene.sceneRect()
+        radius      = 0.3 * min(rect.width(), rect.height())
+        angles      = np.linspace(0, 2 * np.pi, 90, endpoint = False)
+
+        latencies   = []
+        for i in range(repeats):
+            if i % 2 == 0:
+                button  = QtCore.Qt.LeftButton
+            else:
+                button  = QtCore.Qt.RightButton
+
+            points  = [rect.center() + QtCore.QPointF(
+                                            radius * np.cos(angle),
+                                            radius * np.sin(angle))
+                       for angle in angles]
+
+            self._sendMouseEvent(QtCore.QEvent.MouseButtonPress,
+                                 points[0], button)
+            for point in points[1:]:
+                self._sendMouseEvent(QtCore.QEvent.MouseMove, point, button)
+            self._paint()
+
+            latencies.append(self._time(
+                lambda: self._sendMouseEvent(QtCore.QEvent.MouseButtonRelease,
+                                             points[-1], button)))
+
+        return latencies
+
+    def timeMaskThreshold(self, repeats):
+        """Times thresholding the white matter probability map and showing
+        the mask, after the threshold in the settings was changed."""
+
+        rng         = np.random.RandomState(1)
+        shape       = np.shape(self._SDM.getSDO().getFrames()[0])
+
+        #The probability map is set the same way as by segmentMask
+        self._SDM.getSDO()._NBmask = rng.rand(*shape)
+
+        latencies   = []
+        for i in range(repeats):
+            self._settings.setValue("whiteMatterProb", 0.3 + 0.4 * (i % 2))
+            latencies.append(self._time(
+                self._SGM.mainWin.settingsWindow.thresholdSignal.emit))
+
+        return latencies
+
+    def timeVesselOverlay(self, repeats):
+        """Times showing a vessel mask that is sent by the analysis."""
+
+        rng         = np.random.RandomState(2)
+        shape       = np.shape(self._SDM.getSDO().getFrames()[0])
+
+        latencies   = []
+        for _ in range(repeats):
+            vesselMask  = rng.rand(*shape) > 0.995
+            latencies.append(self._time(
+                lambda: self._SDM.signalObject.sendVesselMaskSignal.emit(
+                                                                vesselMask)))
+
+        return latencies
+
+
+    '''Private'''
+
+    def _time(self, function):
+        """Returns the time from calling function until the viewport is
+        painted."""
+
+        start   = time.perf_counter()
+        function()
+        self._paint()
+
+        return time.perf_counter() - start
+
+    def _dragTo(self, points, button):
+        """Moves the mouse along points with button held down and waits 
+        until the scene has sent the coalesced updates."""
+
+        for point in points:
+            self._sendMouseEvent(QtCore.QEvent.MouseMove, point, button)
+
+        while self._scene._updateTimer.isActive():
+            self._app.processEvents(QtCore.QEventLoop.WaitForMoreEvents)
+
+    def _sendMouseEvent(self, eventType, point, button):
+        """Sends a mouse event at a point of the scene to the viewport,
+        the same way as the mouse does."""
+
+        viewport    = self._viewer._view.viewport()
+        position    = QtCore.QPointF(self._viewer._view.mapFromScene(point))
+
+        if eventType == QtCore.QEvent.MouseButtonRelease:
+            buttons = QtCore.Qt.NoButton
+        else:
+            buttons = button
+
+        event       = QtGui.QMouseEvent(eventType, position, button, buttons,
+                                        QtCore.Qt.NoModifier)
+        QtWidgets.QApplication.sendEvent(viewport, event)
+
+    def _paint(self):
+        """Handles the pending events and paints the viewport."""
+
+        self._app.processEvents()
+        self._viewer._view.viewport().repaint()
+
+
+# ====================================================================
+
+def _getSettings():
+    """Returns the QSettings of SELMA."""
+
+    COMPANY, APPNAME, _ = SELMAGUISettings.getInfo()
+    COMPANY             = COMPANY.split()[0]
+    APPNAME             = APPNAME.split()[0]
+
+    return QtCore.QSettings(COMPANY, APPNAME)
+
+def _formatResults(results):
+    """Returns a table with the p50 and p95 latencies in ms."""
+
+    lines   = ["%-16s %6s %10s %10s" % ("Interaction", "Size",
+                                        "p50 (ms)", "p95 (ms)")]
+    for size, latencies in results:
+        for interaction in INTERACTIONS:
+            p50, p95    = 1000 * np.percentile(latencies[interaction],
+                                               [50, 95])
+            lines.append("%-16s %6d %10.2f %10.2f" % (interaction, size,
+                                                      p50, p95))
+
+    return "\n".join(lines)
+
+
+def main(argv = None):
+    """Runs the benchmark for every image size and prints the results."""
+
+    parser  = argparse.ArgumentParser(description =
+                "Times the interactions with the SELMA viewer.")
+    parser.add_argument("--sizes", type = int, nargs = "+",
+                        default = [128, 256, 512],
+                        help = "rows and columns of the synthetic frames")
+    parser.add_argument("--frames", type = int, default = 40,
+                        help = "number of frames of the synthetic scans")
+    parser.add_argument("--repeats", type = int, default = 50,
+                        help = "number of times every interaction is timed")
+    args    = parser.parse_args(argv)
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+    with tempfile.TemporaryDirectory() as tempDir:
+
+        #Keep the settings of the user. SELMA.main uses the ini format
+        #by default; QSettings(COMPANY, APPNAME) always uses the native
+        #format, which is an ini file on Linux as well.
+        QtCore.QSettings.setDefaultFormat(QtCore.QSettings.IniFormat)
+        for settingsFormat in (QtCore.QSettings.IniFormat, 
+                               QtCore.QSettings.NativeFormat):
+            QtCore.QSettings.setPath(settingsFormat,
+                                     QtCore.QSettings.UserScope, tempDir)
+
+        app         = QtWidgets.QApplication(sys.argv[:1])
+        SELMAGUISettings.SelmaSettings().applySettings()
+        benchmark   = ViewerBenchmark(app)
+
+        results     = []
+        for size in args.sizes:
+            fname   = os.path.join(tempDir, "synthetic%d.dcm" % size)
+            writeSyntheticDicom(fname, size, args.frames)
+
+            benchmark.loadScan(fname)
+            results.append((size, benchmark.run(args.repeats)))
+
+        print(_formatResults(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -38,6 +38,7 @@ class SELMAClassicDicom(SELMADicom.SELMADicom):
         self._DCMs              = list()
         self._numFrames         = len(self._dcmFilenames)
         self._rescaleVelocity   = None
+        self._streaming         = False
         
         # load the dicoms
         #Iterate over the dicom files in the directory.
@@ -59,6 +60,9 @@ class SELMAClassicDicom(SELMADicom.SELMADicom):
         self._findPixelSpacing()    
         self._findNoiseScalingFactors()
         self._findTargets()
+        self._framePositions    = [self._getFramePosition(i)
+                                   for i in range(self._numFrames)]
+        self._findSlicePositions()
         
         #Get rescale values and apply
         self._rescaleFrames()
@@ -373,6 +377,26 @@ class SELMAClassicDicom(SELMADicom.SELMADicom):
         
         self._tags['pixelSpacing'] = ps
         
+    def _getFramePosition(self, frame):
+        """Returns the ImagePositionPatient of a frame, or None if it is 
+        not in the header."""
+        
+        try:
+            return np.asarray(self._DCMs[frame].ImagePositionPatient,
+                              dtype = float)
+        except AttributeError:
+            return None
+        
+    def _getImageOrientation(self):
+        """Returns the ImageOrientationPatient of the scan, or None if it is
+        not in the header."""
+        
+        try:
+            return np.asarray(self._DCMs[0].ImageOrientationPatient,
+                              dtype = float)
+        except AttributeError:
+            return None
+        
     def _findNoiseScalingFactors(self):
         """Find RR intervals and TFE in Dicom header, save it to the tags"""
 
@@ -5,34 +5,73 @@ This module is contains all the relevant classes that form the data layer
 of the SELMA project. It contains the following classes:
 
 + :class:`SELMADataObject`
++ :class:`AnalysisCancelled`
     
 """
 
 # ====================================================================
+import os
+import threading
+import concurrent.futures
 import numpy as np
-import SimpleITK as sitk
 from skimage import measure 
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter, binary_fill_holes
 import scipy.signal
 import scipy.stats
 import cv2
 
 #from multiprocessing import Pool, freeze_support, cpu_count
 
-from PyQt5 import (QtCore, QtGui, QtWidgets)
+from PyQt5 import (QtCore, QtGui)
 
 # ====================================================================
 
 import SELMADicom
 import SELMAClassicDicom
 import SELMAT1Dicom
+import SELMASegment
 import SELMADataIO
 import SELMAGUISettings
 import SELMADataClustering
 import SELMADataCalculate
+import SELMADataStreaming
 
 # ====================================================================
 
+#Width in pixels of the band along the edge of the brain that is excluded
+#when ignoreOuterBand is set.
+OUTER_BAND_WIDTH    = 40
+
+#Cut-off in standard deviations and maximum number of iterations of the
+#outlier removal in sigmaClipSTD. The factor is derived from simulated data.
+SIGMA_CLIP_FACTOR   = 4
+SIGMA_CLIP_RUNS     = 100
+
+#Minimum number of voxels in the mask for the converged standard deviation,
+#see _estimateVelocitySTD.
+MIN_NOISE_VOXELS    = 10
+
+#Percentile of the mean magnitude above which pixels can be brain, and the
+#sizes in pixels of the erosion that removes noise and of the dilation that
+#closes the brain, see findBrainMask.
+BRAIN_PERCENTILE    = 40
+BRAIN_ERODE_SIZE    = 15
+BRAIN_DILATE_SIZE   = 50
+
+#Stages of the vessel analysis, see _runPipeline. A run can start at a later
+#stage when only settings of that stage or later stages were changed, see
+#SELMASweep.
+STAGE_STATISTICS    = 0     #Median images and SNR
+STAGE_SIGNIFICANCE  = 1     #Significant voxels, masks and clusters
+STAGE_NON_PERP      = 2     #Removal of non-perpendicular vessels
+STAGE_VESSELS       = 3     #Deduplication and vessel parameters
+
+
+class AnalysisCancelled(Exception):
+    """Raised at the start of a stage of the vessel analysis when the 
+    analysis was cancelled."""
+    
+
 # -------------------------------------------------------------
 '''Auxillary functions, used in the vessel analysis'''
 
@@ -51,6 +90,94 @@ def applyMedianFilter(obj):
     diameter, array = obj
     return scipy.signal.medfilt2d(array, diameter)
 
+def sigmaClipSTD(data, factor = SIGMA_CLIP_FACTOR, 
+                 maxRuns = SIGMA_CLIP_RUNS):
+    """
+    Estimates the standard deviation of the noise in several series at once
+    with iterative outlier removal: the standard deviation is computed 
+    again without the values that lie further than factor times the 
+    previous standard deviation from the previous mean, until it converges.
+    The values are compared to the mean instead of to zero, so series that
+    are not centred around zero, like the real signal, work as well.
+    
+    The values that are kept are marked in an inclusion mask, so the 
+    series are not copied during the iterations.
+    
+    Args:
+        data(numpy.ndarray): the series as a (numSeries, numValues) array.
+        factor(float): cut-off in standard deviations.
+        maxRuns(int): maximum number of iterations.
+    
+    Returns:
+        stds(numpy.ndarray): the converged standard deviation of every 
+        series.
+    """
+    
+    data        = np.atleast_2d(np.asarray(data, dtype = np.float64))
+    distances   = np.empty(data.shape)
+    kept        = np.empty(data.shape, dtype = bool)
+    
+    means       = np.mean(data, axis = 1)
+    stds        = np.std(data, axis = 1)
+    counts      = np.full(data.shape[0], data.shape[1])
+    converged   = np.zeros(data.shape[0], dtype = bool)
+    
+    for _ in range(maxRuns):
+        if np.all(converged):
+            break
+        
+        np.subtract(data, means[:, None], out = distances)
+        np.abs(distances, out = distances)
+        np.less_equal(distances, factor * stds[:, None], out = kept)
+        newCounts   = np.sum(kept, axis = 1)
+        
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            newMeans    = np.sum(data, axis = 1, where = kept) / newCounts
+            newStds     = np.sqrt(np.sum((data - newMeans[:, None])**2, 
+                                         axis = 1, where = kept) / newCounts)
+        
+        #Converged when the same values are kept as in the previous run,
+        #or when the standard deviation doesn't change anymore
+        done        = (newCounts == counts) | ~(np.abs(newStds - stds) >= 
+                                                10 * np.finfo(float).eps)
+        means       = np.where(converged, means, newMeans)
+        stds        = np.where(converged, stds, newStds)
+        counts      = np.where(converged, counts, newCounts)
+        converged  |= done
+    
+    return stds
+
+def findBrainMask(meanMagnitude, bandWidth = OUTER_BAND_WIDTH):
+    """
+    Finds the brain in the mean magnitude frame and removes a band along 
+    its edge:
+        -Threshold the magnitude at a percentile
+        -Erode to remove noise and thin structures outside the brain
+        -Dilate to close the brain
+        -Fill the holes in the brain
+        -Erode to remove the band along the edge of the brain
+    
+    Args:
+        meanMagnitude(numpy.ndarray): the mean magnitude frame.
+        bandWidth(int): width in pixels of the band that is removed.
+    
+    Returns:
+        mask(numpy.ndarray): uint8 mask of the brain without the band.
+    """
+    
+    mask    = np.asarray(meanMagnitude > np.percentile(meanMagnitude, 
+                                                       BRAIN_PERCENTILE),
+                         dtype = np.uint8)
+    mask    = cv2.erode(mask, np.ones((BRAIN_ERODE_SIZE, 
+                                       BRAIN_ERODE_SIZE), np.uint8))
+    mask    = cv2.dilate(mask, np.ones((BRAIN_DILATE_SIZE, 
+                                        BRAIN_DILATE_SIZE), np.uint8))
+    mask    = binary_fill_holes(mask).astype(np.uint8)
+    mask    = cv2.erode(mask, np.ones((2 * bandWidth, 
+                                       2 * bandWidth), np.uint8))
+    
+    return mask
+
 
 class SELMADataObject:
     """This class stores all data used in the program. It has a SELMADicom
@@ -64,13 +191,23 @@ class SELMADataObject:
     def __init__(self,
                  signalObject,
                  dcmFilename = None,
-                 classic = False):
+                 classic = False,
+                 progressive = False):
         
         self._mask          = None
         self._NBmask        = None      #Non binary mask, no treshold applied
         self._t1            = None
         self._vesselMask    = None
         self._selmaDicom    = None
+        self._signalObject  = signalObject
+        self._sliceIdx      = None      #Index of the slice, see getSlice
+        self._brainMasks    = dict()    #Brain mask per slice index
+        self._cancelEvent   = threading.Event()
+        self._vesselDict    = dict()    #Results of the last analysis
+        self._velocityDict  = dict()
+        
+        #Settings that are used instead of the saved ones, see SELMASweep
+        self._settingsOverrides = dict()
         
         if dcmFilename is not None:
             if classic:
@@ -78,17 +215,19 @@ class SELMADataObject:
                                                             dcmFilename)
                 self._dcmFilename   = dcmFilename[0] + ".dcm"
             else:
-                self._selmaDicom    = SELMADicom.SELMADicom(dcmFilename)
+                streaming           = self._readFromSettings(
+                                                'streamingMode', False)
+                self._selmaDicom    = SELMADicom.SELMADicom(dcmFilename,
+                                                            streaming,
+                                                            progressive)
                 self._dcmFilename   = dcmFilename 
-            
-        self._signalObject = signalObject
     
     '''Public'''
     
     # 
     # ------------------------------------------------------------------
     
-    def analyseVessels(self):
+    def analyseVessels(self, cancelEvent = None):
         '''
         The main algorithm of segmenting & analysing the significant vessels.
         It is split in the following parts:
@@ -96,10 +235,44 @@ class SELMADataObject:
             -Find all significant voxels based on their SNR
             -Cluster results into vessels
             -Extract and save vessel properties
+            
+        Args:
+            cancelEvent(threading.Event): when set, the analysis stops at
+            the start of the next stage by raising AnalysisCancelled.
         '''
+        
+        if cancelEvent is not None:
+            self._cancelEvent = cancelEvent
+            
+        if not self._checkAnalysisSettings():
+            return
+        
+        #Slices of a multi-slice scan are analysed separately
+        if self._selmaDicom.getNumSlices() > 1:
+            self._analyseSlices()
+            return
+        
+        self._runPipeline()
+
+        #Send masks back to the GUI
+        self._signalObject.sendMaskSignal.emit(self._mask)
+        self._signalObject.sendVesselMaskSignal.emit(self._vesselMask)
+        
+        #make dictionary and write to disk
+        self._setProgress("Writing results to disk", 1)
+        self._makeVesselDict()
+        
+        SELMADataIO._writeToFile(self)
+    
+        self._signalObject.setProgressLabelSignal.emit("")
+        
+    def _checkAnalysisSettings(self):
+        """Returns whether the analysis can be run with the loaded scan
+        and the settings. Sends an error message if not."""
+        
         if self._selmaDicom is None:
             self._signalObject.errorMessageSignal.emit("No DICOM loaded.")
-            return
+            return False
         
         if (self._readFromSettings('BasalGanglia') + 
             self._readFromSettings('SemiovalCentre')) == 0:
@@ -108,7 +281,7 @@ class SELMADataObject:
             "selected. Please select either Basal Ganglia or Semioval Centre "
             "from the Structure tab in the settings.")
             
-            return
+            return False
  
         if self._readFromSettings('AdvancedClustering'):
             
@@ -121,58 +294,43 @@ class SELMADataObject:
                 self._signalObject.errorMessageSignal.emit("Invalid cluster " 
                 + "selection. Please make a magnitude and flow cluster " +
                 "selection in the Advanced Clustering tab in the settings.")
-                return 
+                return False
+            
+        return True
         
-        self._signalObject.setProgressBarSignal.emit(0)
-        self._signalObject.setProgressLabelSignal.emit(
-                    "Calculating median images")
-        self._calculateMedians()
-        self._signalObject.setProgressBarSignal.emit(60)
-        self._signalObject.setProgressLabelSignal.emit(
-                    "Finding significant vessels")
-        self._subtractMedian()
         
-        # #Estimate STD of noise in mean Velocity
-        # self._estimateVelocitySTD()
-                
-        #Determine SNR of all voxels
-        self._SNR()
         
-        #Find all vessels with significant flow.
-        self._findSignificantFlow()
-
-        #Adjust and apply the Mask
-        self._removeZeroCrossings()
-        self._removeGhosting()
-        self._removeOuterBand()
-        self._updateMask()
-        self._applyT1Mask()
-        self._signalObject.setProgressBarSignal.emit(80)
-        self._signalObject.setProgressLabelSignal.emit(
-                    "Analysing clusters")
+    def loadFrames(self, cancelEvent = None, framesLoaded = None):
+        """
+        Reads the frames of a scan that was opened with progressive = True.
+        The progress is sent to the GUI while the frames are read.
         
-        #Cluster the vessels. 
-        self._findSignificantMagnitude()
-        self._clusterVessels()
-        self._removeNonPerpendicular()
-        self._deduplicateVessels()
-        self._calculateParameters()
-        self._createVesselMask()
-        self._signalObject.setProgressBarSignal.emit(100)
-
-#        Send vessels back to the GUI
-        self._signalObject.sendVesselMaskSignal.emit(self._vesselMask)
+        Args:
+            cancelEvent(threading.Event): when set, reading stops by 
+            raising AnalysisCancelled.
+            
+            framesLoaded(callable): called with the number of frames that
+            can be shown, every time the progress is sent.
+        """
         
-        #make dictionary and write to disk
-        self._signalObject.setProgressLabelSignal.emit(
-                    "Writing results to disk")
-        self._makeVesselDict()
+        if cancelEvent is not None:
+            self._cancelEvent = cancelEvent
         
-        SELMADataIO._writeToFile(self)
-    
-        self._signalObject.setProgressLabelSignal.emit("")
+        numFrames   = self.getNumFrames()
+        step        = max(numFrames // 100, 1)
         
+        def frameRead(numRead):
+            if numRead % step != 0 and numRead != numFrames:
+                return
+            
+            self._setProgress("Loading frames", numRead / numFrames)
+            if framesLoaded is not None:
+                framesLoaded(numRead)
         
+        self._setProgress("Loading frames", 0)
+        self._selmaDicom.loadFrames(frameRead)
+        
+        self._signalObject.setProgressLabelSignal.emit("")
         
     def segmentMask(self):
         if self._t1 is None:
@@ -182,8 +340,16 @@ class SELMADataObject:
         
         self._signalObject.setProgressLabelSignal.emit(
             "Segmenting white matter from T1 - This may take a while.")
-  
-        self._NBmask  = self._t1.getSegmentationMask()
+        
+        backend = self._getSegmentationBackend()
+        try:
+            self._NBmask  = self._t1.getSegmentationMask(backend)
+        except ImportError:
+            self._signalObject.setProgressLabelSignal.emit("")
+            self._signalObject.errorMessageSignal.emit(
+                "The SPM12 segmentation needs the MATLAB engine for " +
+                "Python. Select the built-in segmentation in the settings.")
+            return
         self._thresholdMask()
         self._signalObject.setProgressLabelSignal.emit(
                     "")
@@ -198,6 +364,15 @@ class SELMADataObject:
     
     def getNumFrames(self):
         return self._selmaDicom.getNumFrames()
+    
+    def getFrameIndices(self):
+        return self._selmaDicom.getFrameIndices()
+    
+    def getNumSlices(self):
+        return self._selmaDicom.getNumSlices()
+    
+    def getSliceIndex(self, frame):
+        return self._selmaDicom.getSliceIndex(frame)
 
     def getMask(self):
         if self._NBmask is None:
@@ -216,9 +391,9 @@ class SELMADataObject:
         return self._selmaDicom.getTags()['venc']
     
     def getRescale(self):
-        velFrames   = self._selmaDicom.getVelocityFrames()
-        minres      = np.min(velFrames)
-        maxres      = np.max(velFrames)
+        #Frame by frame, so the frames of a streamed scan stay lazy
+        velFrames       = self._selmaDicom.getVelocityFrames()
+        minres, maxres  = SELMADicom.getFrameRange(velFrames)
         
         return [minres, maxres]
     
@@ -234,12 +409,35 @@ class SELMADataObject:
     #Setter functions
     # ------------------------------------------------------------------    
     
-    def setMask(self, mask):
-        self._mask = mask
+    def setMask(self, mask, sliceIdx = None):
+        """Sets the mask of the analysis. Multi-slice scans can have a 3D
+        mask with one mask per slice, or a 2D mask that is used for every
+        slice. If sliceIdx is given, the 2D mask is only set for that 
+        slice."""
+        
+        if sliceIdx is None or mask is None:
+            self._mask = mask
+            return
+        
+        if self._mask is None or np.ndim(self._mask) != 3:
+            shape       = (self.getNumSlices(),) + np.shape(mask)
+            sliceMasks  = np.zeros(shape, dtype = np.asarray(mask).dtype)
+            
+            #Start from the mask that was used for every slice
+            if self._mask is not None:
+                sliceMasks[:]   = self._mask
+            self._mask  = sliceMasks
+        
+        self._mask[sliceIdx] = mask
         
     def setT1(self, t1Fname):
+        slabMargin  = None
+        if self._readFromSettings('t1SlabMode', False):
+            slabMargin  = self._readFromSettings('t1SlabMargin', 10)
+        
         self._t1 = SELMAT1Dicom.SELMAT1Dicom(t1Fname, 
-                                             self._selmaDicom.getDCM())
+                                             self._selmaDicom.getDCM(),
+                                             slabMargin)
         
     def setVenc(self, venc):
         self._selmaDicom.setVenc(venc)
@@ -252,9 +450,14 @@ class SELMADataObject:
     # ------------------------------------------------------------------    
     
     
-    def _readFromSettings(self, key):
+    def _readFromSettings(self, key, default = None):
         """Loads the settings object associated with the program and 
-        returns the value at the key."""
+        returns the value at the key. Returns default if the setting has
+        not been saved yet. Settings in _settingsOverrides are returned 
+        without reading the settings object."""
+        
+        if key in self._settingsOverrides:
+            return self._settingsOverrides[key]
         
         COMPANY, APPNAME, _ = SELMAGUISettings.getInfo()
         COMPANY             = COMPANY.split()[0]
@@ -269,6 +472,9 @@ class SELMADataObject:
                 "Wrong setting accessed.")
             return val
         
+        if val is None:
+            return default
+        
         #Return the right type
         if val == "true":
             return True
@@ -278,6 +484,21 @@ class SELMADataObject:
         return float(val)
     
     
+    def _getSegmentationBackend(self):
+        """Returns the segmentation backend from the settings."""
+        
+        COMPANY, APPNAME, _ = SELMAGUISettings.getInfo()
+        COMPANY             = COMPANY.split()[0]
+        APPNAME             = APPNAME.split()[0]
+        settings            = QtCore.QSettings(COMPANY, APPNAME)
+        backend             = settings.value('segmentationBackend')
+        
+        if backend not in SELMASegment.BACKENDS:
+            backend         = SELMASegment.BACKENDS[0]
+            
+        return backend
+    
+    
     def _getSigma(self):
         """ Returns the upper end of the confidence interval with the alpha
         value in the settings.
@@ -309,6 +530,257 @@ class SELMADataObject:
     # ------------------------------------------------------------
     """Vessel Analysis"""
     
+    def _runPipeline(self, firstStage = STAGE_STATISTICS):
+        """
+        Runs all steps of the vessel analysis on a single slice, from the 
+        median images up to the vessel mask.
+        
+        Args:
+            firstStage(int): the stage to start at, see STAGE_STATISTICS.
+            The results of the earlier stages are taken from the last run.
+            The mask is changed by the significance stage, so it has to be
+            set again before a run that starts at that stage.
+        """
+        
+        #In streaming mode the frames are read one at a time and only the
+        #statistics per pixel are kept.
+        streaming                   = self._readFromSettings(
+                                                'streamingMode', False)
+        self._voxelSeriesIndex      = None
+        
+        if firstStage <= STAGE_STATISTICS:
+            self._setProgress("Calculating median images", 0)
+            
+            if streaming:
+                SELMADataStreaming.calculateStatistics(self)
+            
+            else:
+                self._calculateMedians()
+                self._setProgress("Calculating SNR", 0.5)
+                self._subtractMedian()
+                        
+                #Determine SNR of all voxels
+                self._SNR()
+            
+            #Estimate STD of noise in mean Velocity and use it for the SNR
+            if self._readFromSettings('convergedSTD', False):
+                self._convergedSNR()
+        
+        if firstStage <= STAGE_SIGNIFICANCE:
+            #Find all vessels with significant flow.
+            self._setProgress("Finding significant vessels", 0.6)
+            self._findSignificantFlow()
+    
+            #Adjust and apply the Mask
+            self._setProgress("Applying mask", 0.7)
+            self._removeZeroCrossings()
+            self._removeGhosting()
+            self._removeOuterBand()
+            self._updateMask()
+            self._applyT1Mask()
+            
+            #Cluster the vessels. 
+            self._setProgress("Analysing clusters", 0.8)
+            self._findSignificantMagnitude()
+            self._clusterVessels()
+        
+        if firstStage <= STAGE_NON_PERP:
+            self._removeNonPerpendicular()
+            
+        self._deduplicateVessels()
+        
+        self._setProgress("Calculating vessel parameters", 0.9)
+        if streaming:
+            SELMADataStreaming.gatherVoxelSeries(self)
+        
+        self._calculateParameters()
+        self._createVesselMask()
+    
+    def _analyseSlices(self):
+        """
+        Analyses every slice of a multi-slice scan as a separate scan. The 
+        slices are analysed concurrently in a pool of worker threads. 
+        
+        Afterwards the results of the slices are combined: the masks are 
+        stacked to 3D arrays, the vessels of all slices are put in one 
+        vesselDict with the index of their slice, and the average velocity
+        and PI are computed over the vessels of all slices.
+        """
+        
+        sliceObjects    = self._createSliceObjects()
+        if sliceObjects is None:
+            return
+        
+        self._runSlices(sliceObjects)
+        
+        self._setProgress("Writing results to disk", 1)
+        
+        self._combineSlices(sliceObjects)
+        
+        SELMADataIO._writeToFile(self)
+    
+        self._signalObject.setProgressLabelSignal.emit("")
+    
+    def _createSliceObjects(self):
+        """
+        Makes a SELMADataObject for every slice of a multi-slice scan, with
+        the mask of that slice. 
+        
+        Returns:
+            sliceObjects(list): the SELMADataObjects of the slices, or None
+            if the mask doesn't fit the scan.
+        """
+        
+        numSlices   = self._selmaDicom.getNumSlices()
+        mask        = np.asarray(self._mask)
+        
+        if mask.ndim == 3 and len(mask) != numSlices:
+            self._signalObject.errorMessageSignal.emit(
+                "The mask has %.0f slices, but the scan has %.0f slices."
+                %(len(mask), numSlices))
+            return None
+        
+        sliceObjects = []
+        for sliceIdx in range(numSlices):
+            sliceObject                 = SELMADataObject(self._signalObject)
+            sliceObject._selmaDicom     = self._selmaDicom.getSlice(sliceIdx)
+            sliceObject._dcmFilename    = self._dcmFilename
+            sliceObject._t1             = self._t1
+            sliceObject._sliceIdx       = sliceIdx
+            sliceObject._brainMasks     = self._brainMasks
+            sliceObject._cancelEvent    = self._cancelEvent
+            sliceObject._settingsOverrides  = self._settingsOverrides
+            
+            #A 2D mask is used for every slice
+            if mask.ndim == 3:
+                sliceObject._mask       = mask[sliceIdx]
+            else:
+                sliceObject._mask       = mask
+            
+            sliceObjects.append(sliceObject)
+            
+        return sliceObjects
+    
+    def _runSlices(self, sliceObjects, firstStage = STAGE_STATISTICS):
+        """
+        Runs the analysis of the slices concurrently in a pool of worker
+        threads.
+        
+        Args:
+            sliceObjects(list): the SELMADataObjects of the slices, see
+            _createSliceObjects.
+            firstStage(int): the stage to start at, see _runPipeline.
+        """
+        
+        numSlices   = len(sliceObjects)
+        stage       = "Analysing %.0f slices" %(numSlices)
+        self._setProgress(stage, 0)
+        
+        workers     = min(numSlices, os.cpu_count() or 1)
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(sliceObject._runPipeline, firstStage)
+                       for sliceObject in sliceObjects]
+            
+            for done, future in enumerate(
+                    concurrent.futures.as_completed(futures)):
+                #Raise errors of the slices here
+                future.result()
+                self._setProgress(stage, (done + 1) / numSlices)
+    
+    def _combineSlices(self, sliceObjects):
+        """
+        Combines the results of the analysed slices into the results of
+        the whole scan. See _analyseSlices.
+        
+        Args:
+            sliceObjects(list): the SELMADataObjects of the slices, in the 
+            order of the slices.
+        """
+        
+        self._mask          = np.stack([sliceObject._mask 
+                                        for sliceObject in sliceObjects])
+        self._vesselMask    = np.stack([sliceObject._vesselMask 
+                                        for sliceObject in sliceObjects])
+        self._nPhases       = sliceObjects[0]._nPhases
+        
+        #Concatenate the vessels and sum the counts of all slices
+        self._clusters              = []
+        self._non_perp_clusters     = []
+        self._lone_vessels          = []
+        self._cluster_vessels       = []
+        self._included_vessels      = []
+        self._NoMPosClusters        = 0
+        self._NoMNegClusters        = 0
+        self._NoMIsoClusters        = 0
+        self._Noperp_clusters       = 0
+        
+        for sliceObject in sliceObjects:
+            self._clusters          += list(sliceObject._clusters)
+            self._non_perp_clusters += list(sliceObject._non_perp_clusters)
+            self._lone_vessels      += list(sliceObject._lone_vessels)
+            self._cluster_vessels   += list(sliceObject._cluster_vessels)
+            self._included_vessels  += list(sliceObject._included_vessels)
+            self._NoMPosClusters    += sliceObject._NoMPosClusters
+            self._NoMNegClusters    += sliceObject._NoMNegClusters
+            self._NoMIsoClusters    += sliceObject._NoMIsoClusters
+            
+            if isinstance(sliceObject._Noperp_clusters, list):
+                self._Noperp_clusters  += len(sliceObject._Noperp_clusters)
+            else:
+                self._Noperp_clusters  += sliceObject._Noperp_clusters
+        
+        #Average velocity and PI over the vessels of all slices
+        SELMADataCalculate.summariseVelocities(self, np.concatenate(
+            [sliceObject._V_cardiac_cycle_included 
+             for sliceObject in sliceObjects]))
+        
+        #One vesselDict with the slice index of every voxel. The vessels
+        #are numbered over all slices.
+        self._vesselDict    = dict()
+        numVessels          = 0
+        
+        for sliceIdx, sliceObject in enumerate(sliceObjects):
+            sliceObject._makeVesselDict()
+            
+            for value_dict in sliceObject._vesselDict.values():
+                combined_dict   = dict()
+                for key, value in value_dict.items():
+                    combined_dict[key]  = value
+                    if key == 'ic':
+                        combined_dict['islice'] = sliceIdx + 1
+                
+                combined_dict['iblob']  += numVessels
+                self._vesselDict[len(self._vesselDict)] = combined_dict
+            
+            numVessels     += len(sliceObject._included_vessels)
+        
+        self._velocityDict      = dict()
+        self._velocityDict[0]   = self._makeVelocityDict()
+        
+        #Also keep the summary of every slice
+        for sliceIdx, sliceObject in enumerate(sliceObjects):
+            self._velocityDict[sliceIdx + 1] = sliceObject._velocityDict[0]
+    
+    def _setProgress(self, stage, fraction):
+        """
+        Marks the start of a stage of the analysis. Stops the analysis if 
+        it was cancelled, otherwise emits the progress to the GUI. Slices 
+        of a multi-slice scan don't report their own progress, since they 
+        are analysed at the same time.
+        
+        Args:
+            stage(str): name of the stage.
+            fraction(float): part of the analysis that is done, from 0 to 1.
+        """
+        
+        if self._cancelEvent.is_set():
+            raise AnalysisCancelled()
+        
+        if self._sliceIdx is not None:
+            return
+        
+        self._signalObject.analysisProgressSignal.emit(stage, fraction)
+    
     def _getMedianDiameter(self):
         """Returns the diameter as specified in the settings."""
         
@@ -331,15 +803,14 @@ class SELMADataObject:
         """Applies median filters to some necessary arrays.
         Starts a new process for each, to reduce processing time."""
  
-        #Prepares the data to be filtered
-        diameter = int(self._getMedianDiameter())
-        
         #phase Frames are used in the 3T Test Retest data
         velocityFrames  = np.asarray(self._selmaDicom.getVelocityFrames()) 
         magnitudeFrames = np.asarray(self._selmaDicom.getMagnitudeFrames())
         
-        meanVelocityFrame       = np.mean(velocityFrames, axis=0)
-        meanMagnitudeFrame      = np.mean(magnitudeFrames, axis=0)
+        self._nPhases               = len(velocityFrames)
+        self._meanVelocityFrame     = np.mean(velocityFrames, axis=0)
+        self._meanMagnitudeFrame    = np.mean(magnitudeFrames, axis=0)
+        self._stdMagnitude          = np.std(magnitudeFrames)
   
         venc                = self._selmaDicom.getTags()['venc']
         phaseFrames         = velocityFrames * np.pi / venc
@@ -350,12 +821,16 @@ class SELMADataObject:
                                                 )
         self._realSignal          = np.real(complexSignal)
         self._imagSignal          = np.imag(complexSignal)
+        self._meanRealSignal      = np.mean(self._realSignal, axis = 0)
+        self._meanImagSignal      = np.mean(self._imagSignal, axis = 0)
         
         realSignalSTD       = np.std(np.real(complexSignal), axis = 0, ddof=1)
         imagSignalSTD       = np.std(np.imag(complexSignal), axis = 0, ddof=1)
         
         rmsSTD              = np.sqrt( (realSignalSTD**2 + imagSignalSTD**2))
         
+        self._filterMeanFrames(rmsSTD)
+        
         #Multithreaded version, not very stable.
 #        objList = [(diameter, meanVelocityFrame),
 #                   (diameter, meanMagnitudeFrame),
@@ -372,6 +847,15 @@ class SELMADataObject:
 #        self._medianRMSSTD          = res[2]
         
         
+    def _filterMeanFrames(self, rmsSTD):
+        """Applies the median (or gaussian) filter to the mean velocity 
+        frame, the mean magnitude frame and the rms of the standard
+        deviation of the complex signal."""
+        
+        diameter            = int(self._getMedianDiameter())
+        meanVelocityFrame   = self._meanVelocityFrame
+        meanMagnitudeFrame  = self._meanMagnitudeFrame
+        
         #Either applies a gaussian smoothing filter or a median filter.
         #NOTE: the gaussian smoothing is not very reliable, should only
         #Be used for testing.
@@ -412,6 +896,17 @@ class SELMADataObject:
                                         self._medianVelocityFrame)
         self._correctedMagnitudeFrames  = (magnitudeFrames -
                                         self._medianMagnitudeFrame)
+        
+        self._meanCorrectedVelocity     = np.mean(
+                                        self._correctedVelocityFrames, 
+                                        axis = 0)
+        
+        #Voxels where the flow does not change sign
+        signs                           = np.sign(
+                                        self._correctedVelocityFrames)
+        signdiff                        = np.diff(signs, axis=0) 
+        self._noZeroCrossings           = np.sum(np.abs(signdiff), 
+                                                 axis=0) == 0
 
     def _estimateVelocitySTD(self):
         """ Estimate the spatial standard deviation of the noise in the 
@@ -424,106 +919,67 @@ class SELMADataObject:
         This function has been successfully implemented in the Basal Ganglia,
         and Semioval Centre where it is assumed that the noise in the velocity
         is normally distributed. 
-        """
         
-        SD_factor = 4 # value derived from simulated data
+        The mean velocity and the real and imaginary signal in the mask are 
+        estimated together, see sigmaClipSTD.
         
-        meanVelocity    = np.mean(self._correctedVelocityFrames, axis = 0)
-        meanMagnitudeReal   = np.mean(self._realSignal, axis = 0)
-        meanMagnitudeImag   = np.mean(self._imagSignal, axis = 0)
+        Returns:
+            valid(bool): False when the mask contains too few voxels or the
+            estimate did not give a finite standard deviation. An error 
+            message is sent in that case and the estimates are not stored.
+        """
         
-        voxel_coordinates = np.where(self._mask == 1)
+        mask    = self._mask > 0
+        if np.sum(mask) < MIN_NOISE_VOXELS:
+            self._signalObject.errorMessageSignal.emit(
+                "The mask contains fewer than %.0f voxels, the converged " 
+                %MIN_NOISE_VOXELS + "standard deviation can't be estimated.")
+            return False
         
-        VelocityData = np.zeros((1,len(voxel_coordinates[0])))
-        MagnitudeRealData = np.zeros((1,len(voxel_coordinates[0])))
-        MagnitudeImagData = np.zeros((1,len(voxel_coordinates[0])))
+        data    = np.stack([self._meanCorrectedVelocity[mask],
+                            self._meanRealSignal[mask],
+                            self._meanImagSignal[mask]])
         
-        #import pdb; pdb.set_trace()
- 
-        for j in range(0,len(voxel_coordinates[0])):
-        
-            VelocityData[0,j] = meanVelocity[voxel_coordinates[0][j],
-                                                    voxel_coordinates[1][j]]
-            MagnitudeRealData[0,j] = meanMagnitudeReal[voxel_coordinates[0][j],
-                                                    voxel_coordinates[1][j]]
-            MagnitudeImagData[0,j] = meanMagnitudeImag[voxel_coordinates[0][j],
-                                                    voxel_coordinates[1][j]]
-            
-        CONVERGED = 0;
-        MAXRUNS = 100;
-        iRun = 0;
-        SD_vel_init = np.std(VelocityData)
-        SD_vel_prev = SD_vel_init
-        
-        while (not CONVERGED) and (iRun < MAXRUNS):
-            
-            VelocityData_dummy = VelocityData
-            outlier_indices = np.where(abs(VelocityData) > 
-                                       (SD_factor * SD_vel_prev))
-            VelocityData_dummy = np.delete(VelocityData_dummy,outlier_indices)
-            SD_vel_curr = np.std(VelocityData_dummy)
-            
-            if abs(SD_vel_curr - SD_vel_prev) < 10 * np.finfo(float).eps:
-                
-                CONVERGED = 1;
-                
-            # Update counters/ stats
-            iRun = iRun + 1
-            SD_vel_prev = SD_vel_curr
-            
-        self._velocitySTD = SD_vel_curr
-            
-        CONVERGED = 0;
-        MAXRUNS = 100;
-        iRun = 0;
-        SD_mag_real_init = np.std(MagnitudeRealData)
-        SD_mag_real_prev = SD_mag_real_init
-    
-        while (not CONVERGED) and (iRun < MAXRUNS):
-            
-            MagnitudeRealData_dummy = MagnitudeRealData
-            outlier_indices = np.where(abs(MagnitudeRealData) > 
-                                        (SD_factor * SD_mag_real_prev))
-            MagnitudeRealData_dummy = np.delete(MagnitudeRealData_dummy,outlier_indices)
-            SD_mag_real_curr = np.std(MagnitudeRealData_dummy)
-            
-            if abs(SD_mag_real_curr - SD_mag_real_prev) < 10 * np.finfo(float).eps:
-                
-                CONVERGED = 1;
-                
-            # Update counters/ stats
-            iRun = iRun + 1
-            SD_mag_real_prev = SD_mag_real_curr
-            
-        self._magnitudeRealSTD = SD_mag_real_curr
+        velocitySTD, realSTD, imagSTD   = sigmaClipSTD(data)
         
-        CONVERGED = 0;
-        MAXRUNS = 100;
-        iRun = 0;
-        SD_mag_imag_init = np.std(MagnitudeImagData)
-        SD_mag_imag_prev = SD_mag_imag_init
-    
-        while (not CONVERGED) and (iRun < MAXRUNS):
-            
-            MagnitudeImagData_dummy = MagnitudeImagData
-            outlier_indices = np.where(abs(MagnitudeImagData) > 
-                                        (SD_factor * SD_mag_imag_prev))
-            MagnitudeImagData_dummy = np.delete(MagnitudeImagData_dummy,outlier_indices)
-            SD_mag_imag_curr = np.std(MagnitudeImagData_dummy)
-            
-            if abs(SD_mag_imag_curr - SD_mag_imag_prev) < 10 * np.finfo(float).eps:
-                
-                CONVERGED = 1;
-                
-            # Update counters/ stats
-            iRun = iRun + 1
-            SD_mag_imag_prev = SD_mag_imag_curr
-            
-        self._magnitudeImagSTD = SD_mag_imag_curr
+        if not np.all(np.isfinite([velocitySTD, realSTD, imagSTD])):
+            self._signalObject.errorMessageSignal.emit(
+                "The converged standard deviation of the noise is not " +
+                "finite, the SNR is not changed.")
+            return False
+        
+        self._velocitySTD       = velocitySTD
+        self._magnitudeRealSTD  = realSTD
+        self._magnitudeImagSTD  = imagSTD
         
         self._rmsSTD              = np.sqrt( (self._magnitudeRealSTD**2 + 
                                         self._magnitudeImagSTD**2))
         
+        return True
+        
+    def _convergedSNR(self):
+        """
+        Replaces the SNR of every voxel by the SNR with the converged 
+        standard deviations of _estimateVelocitySTD:
+            
+            The velocity SNR is the mean corrected velocity divided by the 
+            converged standard deviation of the velocity.
+            The magnitude SNR is the mean magnitude divided by the converged
+            standard deviation of the complex signal.
+        
+        The SNR is left as it is when the standard deviation can't be 
+        estimated.
+        """
+        
+        if not self._estimateVelocitySTD():
+            return
+        
+        self._velocitySNR       = div0(self._meanCorrectedVelocity,
+                                       self._velocitySTD)
+        magnitudeSNR            = div0(self._meanMagnitudeFrame,
+                                       self._rmsSTD)
+        self._magnitudeSNRMask  = (magnitudeSNR > 2).astype(np.uint8)
+        
             
     def _SNR(self):
         """Calculates the SNR in the velocity frames. This is done in the 
@@ -600,13 +1056,7 @@ class SELMADataObject:
     def _removeZeroCrossings(self):
         """Removes all vessels where the flow changes sign."""
         
-        # velocityFrames  = np.asarray(
-        #                     self._selmaDicom.getVelocityFrames())
-        # signs           = np.sign(velocityFrames)
-        
-        signs           = np.sign(self._correctedVelocityFrames)
-        signdiff        = np.diff(signs, axis=0) 
-        noZeroCrossings = np.sum(np.abs(signdiff), axis=0) == 0
+        noZeroCrossings = self._noZeroCrossings
         
         self._sigFlowPos *= noZeroCrossings
         self._sigFlowNeg *= noZeroCrossings
@@ -653,10 +1103,7 @@ class SELMADataObject:
         largeVesselExclY    = self._readFromSettings('largeVesselExclY')
         
         #Remove sharp edges from mean magnitude frame.
-        magnitude       = self._selmaDicom.getMagnitudeFrames()
-        meanMagnitude   = np.mean(magnitude, axis = 0)
-        medianMagnitude = self._medianMagnitudeFrame
-        meanMagnitude   -= medianMagnitude
+        meanMagnitude   = self._meanMagnitudeFrame - self._medianMagnitudeFrame
         
         #Find threshold for 'bright' vessels and mask them.
         meanMagNonzero  = np.abs(meanMagnitude[np.nonzero(meanMagnitude)])
@@ -727,12 +1174,12 @@ class SELMADataObject:
         
     def _removeOuterBand(self):
         """
-        Creates an exclusion mask around the outer edges of the image with a 
-        certain width.
+        Creates an exclusion mask of the band along the edge of the brain, 
+        which is found in the mean magnitude frame. The mask is only made 
+        once for every slice of the scan.
         """
 
         ignoreOuterBand         = self._readFromSettings('ignoreOuterBand')
-        self._outerBandMask     = np.zeros(self._mask.shape)
         
         if not ignoreOuterBand:
             
@@ -740,37 +1187,16 @@ class SELMADataObject:
             
             return
         
-        wm, _ = QtWidgets.QFileDialog.getOpenFileName(
-                                                      caption =
-                                                      'Open skull stripped NIFTI')
+        if self._sliceIdx not in self._brainMasks:
+            self._brainMasks[self._sliceIdx] = findBrainMask(
+                                                self._meanMagnitudeFrame)
         
-        im = sitk.ReadImage(wm)
-        im = sitk.GetArrayFromImage(im)
-        #im = np.flip(im, 1)
-        im = np.flip(im, 0)
-        #im = np.swapaxes(im,0,2)
-        #im = np.swapaxes(im,1,2)
-        
-        band                            = 80    #TODO, get from settings
-        # self._outerBandMask[:band, :]   = 1
-        # self._outerBandMask[:, :band]   = 1
-        # self._outerBandMask[-band:, :]  = 1
-        # self._outerBandMask[:, -band:]  = 1
-        
-        _,th = cv2.threshold(self._medianMagnitudeFrame.astype(np.uint8),0,
-                               1,cv2.THRESH_BINARY+cv2.THRESH_OTSU)
-        
-        kernel = np.ones((5, 5), np.uint8)
-        #self._outerBandMask = cv2.erode(th,kernel)
-        
-        outerBandMask_final = cv2.erode(self._mask,kernel)
+        self._outerBandMask     = self._brainMasks[self._sliceIdx]
         
     def _updateMask(self):
         """
         Removes the exclusion zones found in removeGhosting and 
         removeNonPerpendicular from the mask.
-        
-        Sends the updated mask to the GUI.
         """
 
         mask            = self._mask.astype(bool)
@@ -789,7 +1215,6 @@ class SELMADataObject:
         mask            = maskMinGhost & maskMinOuter
         
         self._mask = mask.astype(np.uint8)
-        self._signalObject.sendMaskSignal.emit(self._mask)
 
     
     def _applyT1Mask(self):
@@ -815,8 +1240,7 @@ class SELMADataObject:
             -Isointense magnitude
         """        
    
-        magnitudeFrames     = self._selmaDicom.getMagnitudeFrames()
-        meanMagnitude       = np.mean(magnitudeFrames, axis = 0)
+        meanMagnitude       = self._meanMagnitudeFrame
         sigma               = self._getSigma()
         
         # medianMagnitude     = scipy.signal.medfilt2d(meanMagnitude,
@@ -906,9 +1330,8 @@ class SELMADataObject:
         magnitudeThresh     = self._readFromSettings('magnitudeThresh')
         ratioThresh         = self._readFromSettings('ratioThresh')
         
-        meanMagnitude   = np.mean(self._selmaDicom.getMagnitudeFrames(),
-                                  axis = 0)
-        stdMagnitude    = np.std(self._selmaDicom.getMagnitudeFrames())
+        meanMagnitude   = self._meanMagnitudeFrame
+        stdMagnitude    = self._stdMagnitude
         # stdMagnitude_MATLAB    = np.std(meanMagnitude)
         
         # MATLAB determines the std using the mean magnitude frame averaged
@@ -1054,8 +1477,7 @@ class SELMADataObject:
         
         #First make a list of all the voxels with the highest velocity per
         #cluster
-        meanVelocity    = np.mean(self._correctedVelocityFrames,
-                                  axis = 0)
+        meanVelocity    = self._meanCorrectedVelocity
         voxels  = []
 
         iMBlob_array = np.zeros((1,len(clusters)))
@@ -1184,6 +1606,27 @@ class SELMADataObject:
                 
         
             
+    def _getVoxelSeries(self, rows, columns):
+        """
+        Returns the corrected velocity and the magnitude time series of the
+        voxels at (rows, columns), as arrays of shape (nPhases, nVoxels).
+        
+        In streaming mode the series are taken from those gathered by 
+        SELMADataStreaming.gatherVoxelSeries, otherwise from the frames.
+        """
+        
+        if self._voxelSeriesIndex is None:
+            magnitudeFrames = np.asarray(
+                                    self._selmaDicom.getMagnitudeFrames())
+            
+            return (self._correctedVelocityFrames[:, rows, columns],
+                    magnitudeFrames[:, rows, columns])
+        
+        index   = self._voxelSeriesIndex[rows, columns]
+        
+        return (self._voxelVelocitySeries[:, index],
+                self._voxelMagnitudeSeries[:, index])
+        
     def _calculateParameters(self):
         
         """
@@ -1249,11 +1692,8 @@ class SELMADataObject:
         self._velocityDict = dict()        
         
         #Get some variables from memory to save time. 
-        meanMagnitude   = np.mean(self._selmaDicom.getMagnitudeFrames(),
-                                  axis = 0)
-        meanVelocity    = np.mean(self._correctedVelocityFrames,
-                                  axis = 0)
-        magFrames       = np.asarray(self._selmaDicom.getMagnitudeFrames())
+        meanMagnitude   = self._meanMagnitudeFrame
+        meanVelocity    = self._meanCorrectedVelocity
         
         iMblob          = self._posMagClusters - self._negMagClusters 
         
@@ -1270,6 +1710,7 @@ class SELMADataObject:
             indexes     = np.argsort(velocities)
             indexes     = indexes[::-1]    #largest to smallest            
             
+            velocitySeries, magnitudeSeries = self._getVoxelSeries(*pixels)
             pixels      = np.transpose(pixels)
             
             for num, pidx in enumerate(indexes):
@@ -1291,20 +1732,21 @@ class SELMADataObject:
                 #value_dict['stdVnoise']     = round(np.mean(
                                                 #self._velocitySTD[:,x,y]),  4)
                 value_dict['minV']          = round(np.min(np.abs(
-                    self._correctedVelocityFrames[:,x,y])),4)
+                    velocitySeries[:,pidx])),4)
                 value_dict['maxV']          = round(np.max(np.abs(
-                    self._correctedVelocityFrames[:,x,y])), 4)
+                    velocitySeries[:,pidx])), 4)
                 value_dict['PI']            = abs(round(div0(
                                              [(value_dict['maxV'] -
                                               value_dict['minV'])],
                                               value_dict['meanV'])[0],
                                                     4))
-                value_dict['nPha']    = self._correctedVelocityFrames.shape[0]
+                value_dict['nPha']    = self._nPhases
                 value_dict['imBlob']  = int(iMblob[x,y])
                 
                 
                 #Magnitude per phase
-                for num, value in enumerate(magFrames[:,x,y].tolist()):
+                for num, value in enumerate(
+                        magnitudeSeries[:,pidx].tolist()):
                     num += 1
                     if num < 10:
                         numStr = '0' + str(num)
@@ -1315,7 +1757,7 @@ class SELMADataObject:
                 
                 #Velocity per phase
                 for num, value in enumerate(
-                        self._correctedVelocityFrames[:,x,y].tolist()):
+                        velocitySeries[:,pidx].tolist()):
                     num += 1
                     if num < 10:
                         numStr = '0' + str(num)
@@ -1328,11 +1770,16 @@ class SELMADataObject:
                 self._vesselDict[i] = value_dict
                 
                 #Emit progress to progressbar
-                self._signalObject.setProgressBarSignal.emit(
-                        int(100 * i / total))
+                self._setProgress("Writing results to disk", i / total)
                 i+= 1
                 
-        'Additional dictionary is created below'
+        self._velocityDict[0] = self._makeVelocityDict()
+        
+        self._setProgress("Writing results to disk", 1)
+        
+    def _makeVelocityDict(self):
+        """Makes the additional dictionary with the statistics per scan,
+        see _makeVesselDict."""
 
         velocity_dict = dict()
         velocity_dict['No. detected vessels']           = len(self._clusters)
@@ -1365,11 +1812,16 @@ class SELMADataObject:
 
         velocity_dict['Vmean SEM']              = round(self._allsemV, 4)
         velocity_dict['PI_norm SEM']            = round(self._allsemPI, 4)
-        velocity_dict['No. BG mask pixels']     = sum(sum(self._mask == 1))
-  
-        self._velocityDict[0] = velocity_dict
         
-        self._signalObject.setProgressBarSignal.emit(100)
+        if self._VmeanCI is not None:
+            velocity_dict['Vmean CI low']       = round(self._VmeanCI[0], 4)
+            velocity_dict['Vmean CI high']      = round(self._VmeanCI[1], 4)
+            velocity_dict['PI_norm CI low']     = round(self._PI_normCI[0], 4)
+            velocity_dict['PI_norm CI high']    = round(self._PI_normCI[1], 4)
+            
+        velocity_dict['No. BG mask pixels']     = np.sum(self._mask == 1)
+  
+        return velocity_dict
 
  
         
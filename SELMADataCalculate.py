@@ -11,6 +11,16 @@ import numpy as np
 import SELMAGUISettings
 from PyQt5 import QtCore
 
+#Confidence level of the bootstrap confidence intervals
+BOOTSTRAP_CONFIDENCE    = 0.95
+
+#Maximum number of values in the resampled velocity curves of one chunk of
+#bootstrap replicates (128 MB of float64)
+BOOTSTRAP_CHUNK_SIZE    = 1 << 24
+
+#Seed of the resampling, so the intervals of a scan are reproducible
+BOOTSTRAP_SEED          = 0
+
 def _readFromSettings(self, key):
     """Loads the settings object associated with the program and 
     returns the value at the key."""
@@ -35,6 +45,15 @@ def _readFromSettings(self, key):
         return False
     
 def obtainFilters(self):
+    """
+    Finds the voxel with the highest absolute mean velocity in every vessel
+    and stores its position, velocity trace and flow and magnitude flags.
+    
+    The voxels of all vessels are listed with their vessel number in one
+    go, and the peak of every vessel is found by sorting this list on the
+    vessel number and the velocity. Ties are broken by the position of the
+    voxel, so the same voxel is found as with np.where.
+    """
     
     if self._readFromSettings('AdvancedClustering'):
         
@@ -49,79 +68,78 @@ def obtainFilters(self):
                                      IsointenseMagnitude])
         self._Flow_filter = np.array([PositiveFlow, NegativeFlow])
     
-    meanVelocity    = np.mean(self._correctedVelocityFrames,axis = 0)
+    meanVelocity    = self._meanCorrectedVelocity
+    numVessels      = len(self._lone_vessels)
     
-    self._V_cardiac_cycle = np.zeros((len(self._lone_vessels),
-                                self._correctedVelocityFrames.shape[0] 
-                                + 3))
-
-    self._Magnitudes = np.zeros((len(self._lone_vessels),3))
-    self._Flows = np.zeros((len(self._lone_vessels),2))
-
-    for idx, vessel in enumerate(self._lone_vessels):
+    self._V_cardiac_cycle = np.zeros((numVessels, self._nPhases + 3))
+    self._Magnitudes = np.zeros((numVessels,3))
+    self._Flows = np.zeros((numVessels,2))
     
-        vesselCoords   = np.nonzero(vessel)
+    if numVessels == 0:
+        return
 
-        vessel_velocities = abs(meanVelocity[vesselCoords[0],
-                                             vesselCoords[1]])
-            
-        pidx = np.where(vessel_velocities == max(vessel_velocities))
-         
-        self._V_cardiac_cycle[idx,0] = vesselCoords[0][pidx[0][0]]
-        self._V_cardiac_cycle[idx,1] = vesselCoords[1][pidx[0][0]]
-        
-        self._Flows[idx,0] = round(self._sigFlowPos[vesselCoords[0][pidx[0][0]],
-                            vesselCoords[1][pidx[0][0]]],  4)
-        self._Flows[idx,1] = round(self._sigFlowNeg[vesselCoords[0][pidx[0][0]],
-                            vesselCoords[1][pidx[0][0]]],  4)
-        self._Magnitudes[idx,0] = round(self._sigMagPos[vesselCoords[0]
-                            [pidx[0][0]],vesselCoords[1][pidx[0][0]]],  4)
-        self._Magnitudes[idx,1] = round(self._sigMagNeg[vesselCoords[0]
-                            [pidx[0][0]],vesselCoords[1][pidx[0][0]]],  4)
-        self._Magnitudes[idx,2] = round(self._sigMagIso[vesselCoords[0]
-                            [pidx[0][0]],vesselCoords[1][pidx[0][0]]],  4)
-        
-        self._V_cardiac_cycle[idx,2] = idx + 1
-        
-        self._V_cardiac_cycle[
-        idx,3:self._V_cardiac_cycle.shape[1]] = self._correctedVelocityFrames[
-        :,vesselCoords[0][pidx[0][0]],vesselCoords[1][pidx[0][0]]].ravel()
+    #Vessel number, row and column of every vessel voxel
+    shape                   = meanVelocity.shape
+    voxels                  = np.flatnonzero(np.asarray(self._lone_vessels,
+                                                        dtype = bool))
+    labels, pixels          = np.divmod(voxels, shape[0] * shape[1])
+    rows, columns           = np.divmod(pixels, shape[1])
+    velocities              = np.abs(meanVelocity[rows, columns])
+    
+    #Sort on vessel number, then on descending velocity, then on position.
+    #The first voxel of every vessel is its peak.
+    order       = np.lexsort((columns, rows, -velocities, labels))
+    first       = np.ones(len(order), dtype = bool)
+    first[1:]   = labels[order][1:] != labels[order][:-1]
+    peaks       = order[first]
+    
+    peakRows    = rows[peaks]
+    peakColumns = columns[peaks]
+    
+    self._V_cardiac_cycle[:,0] = peakRows
+    self._V_cardiac_cycle[:,1] = peakColumns
+    self._V_cardiac_cycle[:,2] = np.arange(1, numVessels + 1)
+    self._V_cardiac_cycle[:,3:] = self._getVoxelSeries(peakRows, 
+                                                       peakColumns)[0].T
+    
+    self._Flows[:,0] = np.round(self._sigFlowPos[peakRows, peakColumns], 4)
+    self._Flows[:,1] = np.round(self._sigFlowNeg[peakRows, peakColumns], 4)
+    self._Magnitudes[:,0] = np.round(self._sigMagPos[peakRows, peakColumns], 
+                                     4)
+    self._Magnitudes[:,1] = np.round(self._sigMagNeg[peakRows, peakColumns], 
+                                     4)
+    self._Magnitudes[:,2] = np.round(self._sigMagIso[peakRows, peakColumns], 
+                                     4)
     
 def filterVelocities(self):
+    """
+    Selects the vessels with the flow and magnitude flags of the selected
+    structure. Sets _V_cardiac_cycle and _included_vessels to the selected
+    vessels.
+    """
+    
+    included = np.ones(len(self._lone_vessels), dtype = bool)
       
     if self._readFromSettings('BasalGanglia'):
-                        
-        self._V_cardiac_cycle = self._V_cardiac_cycle[np.intersect1d(
-        np.where(self._Flows[:,0] == 1)[0],
-        np.where(self._Magnitudes[:,0] == 1)[0]),:]
-    
-        self._included_vessels = [i for j, 
-        i in enumerate(self._lone_vessels) 
-        if j in np.intersect1d(np.where(self._Flows[:,0] == 1)[0]
-                               ,np.where(self._Magnitudes[:,0] == 1)[0])]
+        
+        included = (self._Flows[:,0] == 1) & (self._Magnitudes[:,0] == 1)
 
     elif self._readFromSettings('SemiovalCentre'):
  
-        self._V_cardiac_cycle = self._V_cardiac_cycle[np.where(self._Flows[
-            :,1]  == 1)[0],:]
-    
-        self._included_vessels = [i for j, 
-        i in enumerate(self._lone_vessels) if j in np.where(self._Flows[:,1] 
-                                                            == 1)[0]]
+        included = self._Flows[:,1] == 1
         
     elif self._readFromSettings('AdvancedClustering'):
     
         selectedMagnitudes = np.where(self._Magnitude_filter == 1)[0]
         selectedFlows = np.where(self._Flow_filter == 1)[0]
         
-        self._V_cardiac_cycle = self._V_cardiac_cycle[np.intersect1d(
-            np.where(self._Flows[:,selectedFlows] == 1)[0], np.where(
-                self._Magnitudes[:,selectedMagnitudes] == 1)[0]),:]
-        
-        self._included_vessels = [i for j, 
-        i in enumerate(self._lone_vessels) 
-        if j in np.intersect1d(np.where(self._Flows[:,selectedFlows] == 1)[0],
-                    np.where(self._Magnitudes[:,selectedMagnitudes] == 1)[0])]
+        included = (np.any(self._Flows[:,selectedFlows] == 1, axis = 1) & 
+                    np.any(self._Magnitudes[:,selectedMagnitudes] == 1, 
+                           axis = 1))
+    
+    self._V_cardiac_cycle   = self._V_cardiac_cycle[included]
+    self._included_vessels  = [vessel for vessel, keep in 
+                               zip(self._lone_vessels, included) if keep]
 
 def calculateParameters(self):
     """
@@ -134,45 +152,41 @@ def calculateParameters(self):
     obtainFilters(self)
     filterVelocities(self)
 
-    for idx in np.where(self._V_cardiac_cycle[:,3:
-                self._correctedVelocityFrames.shape[0] + 3] > 
-                        self._selmaDicom.getTags()['venc'])[0]:
- 
-        del(self._included_vessels[idx])
-
+    #Exclude the vessels with a velocity above the venc in any phase
     V_cardiac_cycle = abs(self._V_cardiac_cycle)
+    belowVenc       = np.all(V_cardiac_cycle[:,3:self._nPhases + 3] <= 
+                             self._selmaDicom.getTags()['venc'], axis = 1)
+    self._included_vessels  = [vessel for vessel, keep in 
+                               zip(self._included_vessels, belowVenc) if keep]
     
-    V_cardiac_cycle = np.delete(V_cardiac_cycle, np.where(
-    V_cardiac_cycle[:,3:self._correctedVelocityFrames.shape[0] + 3] 
-    > self._selmaDicom.getTags()['venc'])[0], 0)
-                
-    VmeanPerVesselList = np.zeros((V_cardiac_cycle.shape[0],1))
-    MeanCurveOverAllVessels = np.zeros((1,self._correctedVelocityFrames.
-                                        shape[0]))
-    
-    NormMeanCurvePerVessel = np.zeros((V_cardiac_cycle.shape[0],
-                            self._correctedVelocityFrames.shape[0]))
-    normMeanCurveOverAllVessels = np.zeros((1,
-                                self._correctedVelocityFrames.shape[0]))
-
-    for i in range(0,V_cardiac_cycle.shape[0]):
-        
-       VmeanPerVesselList[i,0:V_cardiac_cycle.shape[0]] = np.mean(
-           V_cardiac_cycle[i,3:V_cardiac_cycle.shape[1]])
-       
-       MeanCurveOverAllVessels = MeanCurveOverAllVessels + np.squeeze((
-           V_cardiac_cycle[i,3:V_cardiac_cycle.shape[1]]/
-           (V_cardiac_cycle.shape[0])))
-       
-       NormMeanCurvePerVessel[i,0:self._correctedVelocityFrames.
-        shape[0]] = V_cardiac_cycle[i,3:V_cardiac_cycle.shape[1]]/np.mean(
-            V_cardiac_cycle[i,3:V_cardiac_cycle.shape[1]])
-       
-       # Velocity curves are first normalised and then averaged
-       normMeanCurveOverAllVessels = (normMeanCurveOverAllVessels + 
-        V_cardiac_cycle[i,3:V_cardiac_cycle.shape[1]]/np.mean(
-        V_cardiac_cycle[i,3:V_cardiac_cycle.shape[1]])/
-        (V_cardiac_cycle.shape[0]))
+    self._V_cardiac_cycle_included = V_cardiac_cycle[belowVenc]
+    
+    summariseVelocities(self, self._V_cardiac_cycle_included)
+    
+def summariseVelocities(self, V_cardiac_cycle):
+    """
+    Computes the average velocity, the normalised PI and their standard 
+    errors over the velocity traces of the included vessels. Also used to
+    combine the vessels of all slices of a multi-slice scan.
+    
+    Args:
+        V_cardiac_cycle(numpy.ndarray): row, column and vessel number 
+        followed by the absolute velocity trace, for every included vessel.
+    """
+    
+    numVessels      = V_cardiac_cycle.shape[0]
+    curves          = V_cardiac_cycle[:,3:]
+    
+    if numVessels == 0:
+        #Nothing to average
+        curves      = np.zeros((1, self._nPhases))
+    
+    VmeanPerVesselList      = np.mean(curves, axis = 1)
+    MeanCurveOverAllVessels = np.mean(curves, axis = 0)
+    
+    # Velocity curves are first normalised and then averaged
+    NormMeanCurvePerVessel  = curves / VmeanPerVesselList[:,None]
+    normMeanCurveOverAllVessels = np.mean(NormMeanCurvePerVessel, axis = 0)
          
     # Compute mean velocity  
     self._Vmean = np.mean(MeanCurveOverAllVessels)
@@ -183,19 +197,76 @@ def calculateParameters(self):
         normMeanCurveOverAllVessels))/np.mean(normMeanCurveOverAllVessels)
     
     # Compute standard error of the mean of Vmean (adapted from MATLAB)
-    allstdV = np.std(VmeanPerVesselList,ddof = 1)
-    self._allsemV = allstdV/np.sqrt(V_cardiac_cycle.shape[0])
+    allstdV = np.std(VmeanPerVesselList[:numVessels],ddof = 1)
+    self._allsemV = allstdV/np.sqrt(numVessels)
     
     # Compute standard error of the mean of PI_norm (adapted from MATLAB)
-    allimaxV = np.where(normMeanCurveOverAllVessels == np.max(
-        normMeanCurveOverAllVessels))[1]
-    alliminV = np.where(normMeanCurveOverAllVessels == np.min(
-        normMeanCurveOverAllVessels))[1]
-    allstdnormV = np.std(NormMeanCurvePerVessel,ddof = 1,axis = 0)
-    allstdmaxV = allstdnormV[allimaxV];
-    allstdminV = allstdnormV[alliminV];
-    allsemmaxV = allstdmaxV/np.sqrt(V_cardiac_cycle.shape[0])
-    allsemminV = allstdminV/np.sqrt(V_cardiac_cycle.shape[0])
+    allimaxV = np.argmax(normMeanCurveOverAllVessels)
+    alliminV = np.argmin(normMeanCurveOverAllVessels)
+    allstdnormV = np.std(NormMeanCurvePerVessel[:numVessels],ddof = 1,
+                         axis = 0)
+    allsemmaxV = allstdnormV[allimaxV]/np.sqrt(numVessels)
+    allsemminV = allstdnormV[alliminV]/np.sqrt(numVessels)
     allcovarmaxminV = 0
     self._allsemPI = np.sqrt(allsemmaxV**2 + allsemminV**2 - 2*
-                             allcovarmaxminV)[0]
\ No newline at end of file
+                             allcovarmaxminV)
+    
+    # Bootstrap confidence intervals of Vmean and PI_norm
+    self._VmeanCI   = None
+    self._PI_normCI = None
+    
+    if self._readFromSettings('bootstrap', False) and numVessels > 0:
+        numReplicates   = int(self._readFromSettings('bootstrapReplicates',
+                                                     10000))
+        self._VmeanCI, self._PI_normCI = bootstrapParameters(
+                                            V_cardiac_cycle[:,3:], 
+                                            numReplicates)
+        
+def bootstrapParameters(curves, numReplicates, 
+                        confidence = BOOTSTRAP_CONFIDENCE,
+                        seed = BOOTSTRAP_SEED):
+    """
+    Computes percentile bootstrap confidence intervals of Vmean and PI_norm
+    over the vessels. Every replicate draws as many vessels as there are,
+    with replacement, and computes Vmean and PI_norm of the drawn vessels
+    the same way as summariseVelocities. The replicates are drawn in 
+    chunks, with one (replicates, vessels, phases) gather per chunk.
+    
+    Args:
+        curves(numpy.ndarray): absolute velocity trace of every vessel, as
+        a (vessels, phases) array.
+        numReplicates(int): number of bootstrap replicates.
+        confidence(float): confidence level of the intervals.
+        seed(int): seed of the random number generator.
+        
+    Returns:
+        VmeanCI(numpy.ndarray): lower and upper bound of Vmean.
+        PI_normCI(numpy.ndarray): lower and upper bound of PI_norm.
+    """
+    
+    numVessels, numPhases   = curves.shape
+    rng                     = np.random.default_rng(seed)
+    
+    VmeanPerVessel  = np.mean(curves, axis = 1)
+    normCurves      = curves / VmeanPerVessel[:,None]
+    
+    Vmeans          = np.zeros(numReplicates)
+    PI_norms        = np.zeros(numReplicates)
+    chunkSize       = max(1, BOOTSTRAP_CHUNK_SIZE // (numVessels * numPhases))
+    
+    for start in range(0, numReplicates, chunkSize):
+        stop        = min(start + chunkSize, numReplicates)
+        indices     = rng.integers(0, numVessels, (stop - start, numVessels))
+        
+        Vmeans[start:stop]  = np.mean(VmeanPerVessel[indices], axis = 1)
+        
+        normMeanCurves      = np.mean(normCurves[indices], axis = 1)
+        PI_norms[start:stop] = (np.max(normMeanCurves, axis = 1) - 
+                                np.min(normMeanCurves, axis = 1)) / \
+                                np.mean(normMeanCurves, axis = 1)
+    
+    percentiles     = 100 * np.array([(1 - confidence) / 2, 
+                                      (1 + confidence) / 2])
+    
+    return np.percentile(Vmeans, percentiles), np.percentile(PI_norms, 
+                                                             percentiles)
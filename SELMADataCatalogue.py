@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+This module belongs to the SELMADataIO module. It manages the SQLite
+catalogue of analysed scans. Every finished analysis adds one row per scan
+and one row per vessel, so results of a whole cohort can be queried and
+compared without parsing the output files.
+
+"""
+
+# ====================================================================
+import numpy as np
+import sqlite3
+import hashlib
+import json
+import datetime
+
+from PyQt5 import QtCore
+
+# ====================================================================
+
+import SELMAGUISettings
+
+# ====================================================================
+
+#Settings that change the results of the analysis. Only these are stored
+#and hashed, so settings of the display and the output don't split the 
+#scans with the same analysis in groups.
+RESULT_SETTINGS_KEYS = ('medDiam', 'confidenceInter', 'mmPixel', 'mmVenc',
+                        'ignoreOuterBand', 'gaussianSmoothing', 
+                        'whiteMatterProb', 'doGhosting', 'noVesselThresh', 
+                        'smallVesselThresh', 'smallVesselExclX', 
+                        'smallVesselExclY', 'largeVesselExclX', 
+                        'largeVesselExclY', 'brightVesselPerc', 
+                        'removeNonPerp', 'onlyMPos', 'minScaling', 
+                        'maxScaling', 'windowSize', 'magnitudeThresh', 
+                        'ratioThresh', 'deduplicate', 'deduplicateRange',
+                        'BasalGanglia', 'SemiovalCentre', 
+                        'AdvancedClustering', 'PositiveMagnitude', 
+                        'NegativeMagnitude', 'IsointenseMagnitude', 
+                        'PositiveFlow', 'NegativeFlow', 
+                        'segmentationBackend', 't1SlabMode', 
+                        't1SlabMargin', 'convergedSTD', 'bootstrap', 
+                        'bootstrapReplicates')
+
+#Columns of the scans table and the key in the velocityDict they come from
+SCAN_METRICS        = (('nDetected',    'No. detected vessels'),
+                       ('nIncluded',    'No. included vessels'),
+                       ('Vmean',        'Vmean vessels'),
+                       ('PI_norm',      'PI_norm vessels'),
+                       ('VmeanSEM',     'Vmean SEM'),
+                       ('PI_normSEM',   'PI_norm SEM'),
+                       ('nMaskPixels',  'No. BG mask pixels'))
+
+#Columns of the vessels table, taken from the peak voxel of each vessel
+VESSEL_METRICS      = ('ir', 'ic', 'meanV', 'minV', 'maxV', 'PI', 'meanMag',
+                       'Vpos', 'Vneg', 'Mpos', 'Miso', 'Mneg')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id              INTEGER PRIMARY KEY,
+    filename        TEXT,
+    settingsHash    TEXT,
+    settings        TEXT,
+    version         TEXT,
+    venc            REAL,
+    analysed        TEXT,
+    nDetected       INTEGER,
+    nIncluded       INTEGER,
+    Vmean           REAL,
+    PI_norm         REAL,
+    VmeanSEM        REAL,
+    PI_normSEM      REAL,
+    nMaskPixels     INTEGER,
+    velocityDict    TEXT
+);
+CREATE TABLE IF NOT EXISTS vessels (
+    scanId          INTEGER REFERENCES scans(id) ON DELETE CASCADE,
+    vessel          INTEGER,
+    nPixels         INTEGER,
+    ir              INTEGER,
+    ic              INTEGER,
+    meanV           REAL,
+    minV            REAL,
+    maxV            REAL,
+    PI              REAL,
+    meanMag         REAL,
+    Vpos            INTEGER,
+    Vneg            INTEGER,
+    Mpos            INTEGER,
+    Miso            INTEGER,
+    Mneg            INTEGER,
+    velocityTrace   TEXT
+);
+CREATE INDEX IF NOT EXISTS scansByFilename ON scans(filename, settingsHash);
+CREATE INDEX IF NOT EXISTS scansBySettings ON scans(settingsHash);
+CREATE INDEX IF NOT EXISTS vesselsByScan   ON vessels(scanId);
+"""
+
+
+def getCatalogueFile():
+    """Returns the path of the catalogue from the settings, or None if no
+    catalogue is used."""
+
+    COMPANY, APPNAME, _ = SELMAGUISettings.getInfo()
+    COMPANY             = COMPANY.split()[0]
+    APPNAME             = APPNAME.split()[0]
+    settings            = QtCore.QSettings(COMPANY, APPNAME)
+    catalogueFile       = settings.value('catalogueFile')
+
+    if not catalogueFile:
+        return None
+
+    return catalogueFile
+
+
+def connect(fname):
+    """
+    Opens the catalogue and creates the tables if they don't exist yet.
+
+    Args:
+        fname(str): path to the catalogue.
+
+    Returns:
+        sqlite3.Connection to the catalogue. Rows are returned as
+        sqlite3.Row objects.
+    """
+
+    connection              = sqlite3.connect(fname, timeout = 30)
+    connection.row_factory  = sqlite3.Row
+    connection.execute("PRAGMA foreign_keys = ON")
+    connection.executescript(SCHEMA)
+
+    return connection
+
+
+def getSettingsHash(addonDict):
+    """
+    Returns a hash of the analysis settings in the addonDict. Scans that
+    were analysed with the same settings have the same hash.
+
+    Args:
+        addonDict(dict): dictionary made by SELMADataIO.getAddonDict.
+
+    Returns:
+        settingsHash(str): hexadecimal sha1 hash of the settings.
+    """
+
+    settings    = _getSettings(addonDict)
+    text        = json.dumps(settings, sort_keys = True)
+
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def addScan(fname, addonDict, columns, velocityDict):
+    """
+    Adds a finished analysis to the catalogue: one row in the scans table
+    and one row per vessel in the vessels table.
+
+    Args:
+        fname(str): path to the catalogue.
+
+        addonDict(dict): dictionary made by SELMADataIO.getAddonDict.
+
+        columns(dict): the vesselDict as columns, see
+        SELMADataIO.vesselDictToColumns.
+
+        velocityDict(dict): the summary of the scan (velocityDict[0]).
+
+    Returns:
+        scanId(int): the id of the scan in the catalogue.
+    """
+
+    scanRow     = {'filename':      str(addonDict['filename']),
+                   'settingsHash':  getSettingsHash(addonDict),
+                   'settings':      json.dumps(_getSettings(addonDict),
+                                               sort_keys = True),
+                   'version':       str(addonDict['version']),
+                   'venc':          float(addonDict['venc']),
+                   'analysed':      datetime.datetime.now().isoformat(),
+                   'velocityDict':  json.dumps(velocityDict,
+                                               default = _toPython)}
+    for column, key in SCAN_METRICS:
+        scanRow[column] = _toPython(velocityDict.get(key))
+
+    vesselRows  = _makeVesselRows(columns)
+
+    connection  = connect(fname)
+    try:
+        with connection:
+            cursor  = connection.execute(
+                "INSERT INTO scans (" + ", ".join(scanRow.keys()) +
+                ") VALUES (" + ", ".join("?" * len(scanRow)) + ")",
+                list(scanRow.values()))
+            scanId  = cursor.lastrowid
+
+            if vesselRows:
+                names   = ["scanId"] + list(vesselRows[0].keys())
+                connection.executemany(
+                    "INSERT INTO vessels (" + ", ".join(names) +
+                    ") VALUES (" + ", ".join("?" * len(names)) + ")",
+                    [[scanId] + list(row.values()) for row in vesselRows])
+    finally:
+        connection.close()
+
+    return scanId
+
+
+def getScans(fname, filename = None, settingsHash = None):
+    """
+    Returns the scans in the catalogue, optionally only those of one file
+    and / or one set of settings.
+
+    Args:
+        fname(str): path to the catalogue.
+        filename(str): only return analyses of this file.
+        settingsHash(str): only return analyses with these settings.
+
+    Returns:
+        list of dictionaries, one per row of the scans table.
+    """
+
+    query       = "SELECT * FROM scans"
+    conditions  = []
+    values      = []
+
+    if filename is not None:
+        conditions.append("filename = ?")
+        values.append(filename)
+    if settingsHash is not None:
+        conditions.append("settingsHash = ?")
+        values.append(settingsHash)
+    if conditions:
+        query  += " WHERE " + " AND ".join(conditions)
+    query      += " ORDER BY id"
+
+    connection  = connect(fname)
+    try:
+        rows    = connection.execute(query, values).fetchall()
+    finally:
+        connection.close()
+
+    return [dict(row) for row in rows]
+
+
+def getVessels(fname, scanId):
+    """
+    Returns the vessels of a scan in the catalogue.
+
+    Args:
+        fname(str): path to the catalogue.
+        scanId(int): id of the scan in the scans table.
+
+    Returns:
+        list of dictionaries, one per vessel. The velocity trace is
+        returned as a list.
+    """
+
+    connection  = connect(fname)
+    try:
+        rows    = connection.execute(
+            "SELECT * FROM vessels WHERE scanId = ? ORDER BY vessel",
+            (scanId,)).fetchall()
+    finally:
+        connection.close()
+
+    vessels     = []
+    for row in rows:
+        vessel                  = dict(row)
+        vessel['velocityTrace'] = json.loads(vessel['velocityTrace'])
+        vessels.append(vessel)
+
+    return vessels
+
+
+'''Private'''
+
+def _getSettings(addonDict):
+    """Returns the analysis settings in the addonDict as strings."""
+
+    return dict((str(key), str(value)) for key, value in addonDict.items()
+                if key in RESULT_SETTINGS_KEYS)
+
+
+def _toPython(value):
+    """Converts numpy scalars to their python equivalent."""
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return value
+
+
+def _makeVesselRows(columns):
+    """Makes one row per vessel from the columns of the vesselDict. The
+    values are taken from the voxel with the highest velocity."""
+
+    if not columns:
+        return []
+
+    peaks       = np.nonzero(columns['ipixel'] == 1)[0]
+    nPixels     = np.bincount(columns['iblob'])
+    traceKeys   = [key for key in columns.keys() if key.startswith('Vpha')]
+    traces      = np.stack([columns[key] for key in traceKeys], axis = 1)
+
+    rows        = []
+    for peak in peaks:
+        vessel              = int(columns['iblob'][peak])
+        row                 = dict()
+        row['vessel']       = vessel
+        row['nPixels']      = int(nPixels[vessel])
+        for key in VESSEL_METRICS:
+            row[key]        = _toPython(columns[key][peak])
+        row['velocityTrace']= json.dumps(traces[peak].tolist())
+        rows.append(row)
+
+    return rows
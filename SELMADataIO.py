@@ -19,11 +19,14 @@ import pydicom
 import imageio
 import scipy.io
 import time
+import operator
+import os
 # import h5py
 from PyQt5 import (QtCore, QtGui, QtWidgets)
 # ====================================================================
 
 import SELMAGUISettings
+import SELMADataCatalogue
 
 # ====================================================================
 
@@ -113,6 +116,7 @@ def _makeBatchAnalysisDict(self):
         V_mean SEM
         PI_mean
         PI_mean SEM
+        V_mean and PI_mean bootstrap confidence intervals, if enabled
         mean Velocity Trace
     """
     
@@ -131,10 +135,19 @@ def _makeBatchAnalysisDict(self):
                                                     'Vmean SEM'] 
     self._batchAnalysisDict['PI_mean_SEM'] = self._velocityDict[0][
                                                     'PI_norm SEM']  
+    
+    if 'Vmean CI low' in self._velocityDict[0]:
+        self._batchAnalysisDict['V_mean_CI'] = np.array([
+                                self._velocityDict[0]['Vmean CI low'],
+                                self._velocityDict[0]['Vmean CI high']])
+        self._batchAnalysisDict['PI_mean_CI'] = np.array([
+                                self._velocityDict[0]['PI_norm CI low'],
+                                self._velocityDict[0]['PI_norm CI high']])
+        
     self._batchAnalysisDict['Filename'] = self._dcmFilename   
 
     velocityTrace = np.zeros((self._batchAnalysisDict['No_of_vessels'],
-                              len(self._correctedVelocityFrames)))
+                              self._nPhases))
             
     for blob in range(1, self._batchAnalysisDict['No_of_vessels'] + 1):
         
@@ -143,7 +156,7 @@ def _makeBatchAnalysisDict(self):
             if self._vesselDict[vessel]['iblob'] == blob and (
                     self._vesselDict[vessel]['ipixel'] == 1):
 
-                for num in range(1,len(self._correctedVelocityFrames) + 1):
+                for num in range(1,self._nPhases + 1):
                    
                    if num < 10:
                            
@@ -163,36 +176,75 @@ def _makeBatchAnalysisDict(self):
 
 def _writeToFile(self):
     """
-    Creates a filename for the output and passes it to writeVesselDict
-    along with the vesselDict object to be written. The velocityDict 
+    Creates a filename for the output and passes it to the writer of the
+    selected output format along with the vesselDict object to be written. The velocityDict 
     object is written to a different file. 
     """
     
+    addonDict = getAddonDict(self)
+    
     #TODO: Add scan name to error message of no vessels found
     #Message if no vessels were found
     if len(np.nonzero(self._lone_vessels)[0]) == 0:
         
         #self._signalObject.errorMessageSignal.emit("No vessels Found")
+        
+        #Scans without vessels have no output files, but are catalogued
+        _addToCatalogue(self, addonDict)
         return
     
-    #Get filename for textfile output for vesselData
+    #Get filename and writer for the output of the vesselData
+    extension, writer   = OUTPUT_FORMATS[_getOutputFormat()]
     fname = self._dcmFilename[:-4]
-    fname += "-Vessel_Data.txt"
+    fname += "-Vessel_Data" + extension
     
     #Get filename for textfile output for velocityData
     fname_vel = self._dcmFilename[:-4]
     fname_vel += "-averagePIandVelocity_Data.txt"
     
-    addonDict = getAddonDict(self)
-    
-    writeVesselDict(self._vesselDict,
+    try:
+        writer(self._vesselDict,
                                 addonDict,
                                 fname)
+    except ImportError as e:
+        #Fall back on the text output if the backend is not installed
+        self._signalObject.errorMessageSignal.emit(
+            "Could not write " + fname + ": " + str(e) + 
+            "\nThe vessel data is written as text instead.")
+        writeVesselDict(self._vesselDict,
+                                addonDict,
+                                self._dcmFilename[:-4] + "-Vessel_Data.txt")
     
     writeVelocityDict(self._velocityDict,
                                 addonDict,
                                 fname_vel)
     
+    _addToCatalogue(self, addonDict)
+    
+def _addToCatalogue(self, addonDict):
+    """
+    Adds the scan to the catalogue, if one is set. The output files are 
+    already written, so an error of the catalogue is reported but doesn't
+    stop the analysis.
+    """
+    
+    catalogueFile   = SELMADataCatalogue.getCatalogueFile()
+    if catalogueFile is None:
+        return
+    
+    try:
+        columns     = dict()
+        if bool(self._vesselDict):
+            columns = vesselDictToColumns(self._vesselDict)
+        SELMADataCatalogue.addScan(catalogueFile, 
+                                   addonDict,
+                                   columns,
+                                   self._velocityDict[0])
+    except Exception as e:
+        self._signalObject.errorMessageSignal.emit(
+            "Could not add the scan to the catalogue " + catalogueFile +
+            ": " + str(e))
+    
 def getAddonDict(self):
     """Makes a dictionary that contains the necessary information for
     repeating the analysis.""" 
@@ -223,6 +275,70 @@ def getAddonDict(self):
     return addonDict        
     
 
+def vesselDictToColumns(vesselDict):
+    """
+    Converts the vesselDict object, which holds one dictionary per voxel,
+    to a dictionary of column arrays. The order of the columns is the
+    order of the keys in the vesselDict.
+    
+    Args:
+        vesselDict(dict): dictionary containing all the analysis values
+        of all the significant vessels in the analysed dicom.
+        
+    Returns:
+        columns(dict): dictionary with one numpy.ndarray per key of the 
+        vesselDict.
+    """
+    
+    keys        = list(vesselDict[0].keys())
+    getter      = operator.itemgetter(*keys)
+    rows        = [getter(vesselDict[i]) for i in range(len(vesselDict))]
+    
+    columns     = dict()
+    for key, column in zip(keys, zip(*rows)):
+        columns[key]    = np.asarray(column)
+        
+    return columns
+    
+
+def _formatColumns(columns, decimalComma):
+    """
+    Converts a dictionary of column arrays to a 2D array of strings. Whole
+    columns are formatted at once.
+    
+    Args:
+        columns(dict): dictionary with one numpy.ndarray per column.
+        decimalComma(bool): replace the decimal dot with a comma.
+        
+    Returns:
+        numpy.ndarray of strings with shape (rows, columns).
+    """
+    
+    cells   = []
+    for column in columns.values():
+        text    = column.astype(str)
+        if decimalComma and column.dtype.kind == 'f':
+            text    = np.char.replace(text, '.', ',')
+        cells.append(text)
+        
+    return np.stack(cells, axis = 1)
+    
+
+def _getOutputFormat():
+    """Returns the output format of the vessel data from the settings."""
+    
+    COMPANY, APPNAME, _ = SELMAGUISettings.getInfo()
+    COMPANY             = COMPANY.split()[0]
+    APPNAME             = APPNAME.split()[0]
+    settings            = QtCore.QSettings(COMPANY, APPNAME)
+    outputFormat        = settings.value('outputFormat')
+    
+    if outputFormat not in OUTPUT_FORMATS:
+        outputFormat    = 'txt'
+        
+    return outputFormat
+    
+
 def writeVesselDict(vesselDict, addonDict, fname):
     """
     Writes the vesselDict object to a .txt file.
@@ -242,22 +358,17 @@ def writeVesselDict(vesselDict, addonDict, fname):
     settings            = QtCore.QSettings(COMPANY, APPNAME)
     decimalComma        = settings.value('decimalComma') == 'true'
     
+    columns             = vesselDictToColumns(vesselDict)
+    table               = _formatColumns(columns, decimalComma)
+    
     with open(fname, 'w') as f:    
         #Write headers
-        for key in vesselDict[0].keys():
-            f.write(key)
-            f.write('\t')
-        f.write('\n')
+        f.write('\t'.join(columns.keys()))
+        f.write('\t\n')
     
         #Write vesseldata
-        for i in range(len(vesselDict))    :
-            for key in vesselDict[0].keys():
-                text    = str(vesselDict[i][key])
-                if decimalComma:
-                    text    = text.replace('.',',')
-                f.write(text)
-                f.write('\t')
-            f.write('\n')
+        f.write('\t\n'.join(map('\t'.join, table.tolist())))
+        f.write('\t\n')
             
         #Write additional info
         f.write('\n')
@@ -267,6 +378,96 @@ def writeVesselDict(vesselDict, addonDict, fname):
             f.write(str(addonDict[key]))
             f.write('\n')
             
+
+def writeVesselDictNpz(vesselDict, addonDict, fname):
+    """
+    Writes the vesselDict object to a compressed .npz file. Every column 
+    of the vesselDict is stored as a separate array, the addonDict is 
+    stored in the arrays 'addonKeys' and 'addonValues'.
+    
+    Args:
+        vesselDict(dict): dictionary containing all the analysis values
+        of all the significant vessels in the analysed dicom.
+        
+        addonDict(dict): dictionary containing the settings of the 
+        analysis.
+        
+        fname(str): path to where the dictionary needs to be saved.
+    
+    """
+    
+    columns                 = vesselDictToColumns(vesselDict)
+    columns['addonKeys']    = np.asarray(list(addonDict.keys()), dtype=str)
+    columns['addonValues']  = np.asarray([str(value) for value in 
+                                          addonDict.values()], dtype=str)
+    
+    np.savez_compressed(fname, **columns)
+    
+
+def writeVesselDictHDF5(vesselDict, addonDict, fname):
+    """
+    Writes the vesselDict object to a HDF5 file. Every column of the 
+    vesselDict is stored as a dataset in the group 'vessels', the 
+    addonDict is stored in the attributes of the file.
+    
+    Args:
+        vesselDict(dict): dictionary containing all the analysis values
+        of all the significant vessels in the analysed dicom.
+        
+        addonDict(dict): dictionary containing the settings of the 
+        analysis.
+        
+        fname(str): path to where the dictionary needs to be saved.
+    
+    """
+    
+    import h5py
+    
+    columns     = vesselDictToColumns(vesselDict)
+    
+    with h5py.File(fname, 'w') as f:
+        group   = f.create_group('vessels')
+        for key, column in columns.items():
+            group.create_dataset(key, data = column, compression = 'gzip')
+            
+        for key, value in addonDict.items():
+            f.attrs[key]    = str(value)
+            
+
+def writeVesselDictParquet(vesselDict, addonDict, fname):
+    """
+    Writes the vesselDict object to a Parquet file. The addonDict is 
+    stored in the metadata of the table.
+    
+    Args:
+        vesselDict(dict): dictionary containing all the analysis values
+        of all the significant vessels in the analysed dicom.
+        
+        addonDict(dict): dictionary containing the settings of the 
+        analysis.
+        
+        fname(str): path to where the dictionary needs to be saved.
+    
+    """
+    
+    import pyarrow
+    import pyarrow.parquet
+    
+    columns     = vesselDictToColumns(vesselDict)
+    metadata    = dict((str(key), str(value)) 
+                       for key, value in addonDict.items())
+    
+    table       = pyarrow.Table.from_pydict(columns)
+    table       = table.replace_schema_metadata(metadata)
+    pyarrow.parquet.write_table(table, fname)
+    
+
+#Output formats of the vessel data: extension and writer
+OUTPUT_FORMATS = {'txt':        (".txt",        writeVesselDict),
+                  'npz':        (".npz",        writeVesselDictNpz),
+                  'h5':         (".h5",         writeVesselDictHDF5),
+                  'parquet':    (".parquet",    writeVesselDictParquet)}
+
 def writeVelocityDict(velocityDict, addonDict, fname):
     """
     Writes the velocityDict object to a .txt file. This is a separate text file
@@ -328,4 +529,119 @@ def writeBatchAnalysisDict(batchAnalysisResults, fname):
     scipy.io.savemat(fname,{'Results':[struct_object]})
 
 
+def createBatchResultsStore(fname):
+    """
+    Creates an empty HDF5 results store for a batch analysis. An existing
+    store with the same name is overwritten.
+    
+    Args:
+        fname(str): path to where the results store needs to be saved.
+    """
+    
+    import h5py
+    
+    with h5py.File(fname, 'w', track_order = True):
+        pass
+    
+
+def appendBatchResultsStore(batchAnalysisDict, vesselDict, fname):
+    """
+    Appends the results of a single scan to the HDF5 results store as a 
+    new group. The scalar results are stored as attributes of the group,
+    the arrays (such as the velocity trace) as datasets and the vessel 
+    table as one dataset per column in the subgroup 'vessels'.
+    
+    The file is closed after every scan, so the results of the finished 
+    scans can be read while the batch is still running.
+    
+    Args:
+        batchAnalysisDict(dict): dictionary containing the results of the
+        scan, see _makeBatchAnalysisDict.
+        
+        vesselDict(dict): dictionary containing all the analysis values
+        of all the significant vessels in the scan.
+        
+        fname(str): path to the results store.
+    """
+    
+    import h5py
+    
+    filename    = batchAnalysisDict['Filename']
+    if isinstance(filename, list):
+        #Classic dicom, use the name of the subject folder
+        name    = os.path.basename(os.path.dirname(filename[0]))
+    else:
+        name    = os.path.splitext(os.path.basename(filename))[0]
+    
+    with h5py.File(fname, 'a', track_order = True) as f:
+        group   = f.create_group('%04d-%s' %(len(f), name), 
+                                 track_order = True)
+        
+        for key, value in batchAnalysisDict.items():
+            if key == 'Filename' and isinstance(value, list):
+                group.attrs[key]    = np.asarray(value, dtype = 
+                                        h5py.special_dtype(vlen = str))
+            elif np.ndim(value) == 0:
+                group.attrs[key]    = value
+            else:
+                group.create_dataset(key, data = value)
+                
+        if bool(vesselDict):
+            columns = vesselDictToColumns(vesselDict)
+            vessels = group.create_group('vessels', track_order = True)
+            for key, column in columns.items():
+                vessels.create_dataset(key, data = column, 
+                                       compression = 'gzip')
+                
+
+def readBatchResultsStore(fname):
+    """
+    Reads the results of all scans from the HDF5 results store.
+    
+    Args:
+        fname(str): path to the results store.
+        
+    Returns:
+        batchAnalysisResults(dict): the results of every scan in the same
+        format as _makeBatchAnalysisDict, in the order of analysis.
+    """
+    
+    import h5py
+    
+    batchAnalysisResults    = dict()
+    
+    with h5py.File(fname, 'r') as f:
+        for i, name in enumerate(f.keys()):
+            group   = f[name]
+            results = dict()
+            
+            for key, value in group.attrs.items():
+                if isinstance(value, np.ndarray) and value.dtype == object:
+                    value   = list(value)
+                results[key]    = value
+                
+            for key, value in group.items():
+                if key != 'vessels':
+                    results[key]    = value[()]
+                    
+            batchAnalysisResults[i] = results
+            
+    return batchAnalysisResults
+            
+
+def convertBatchResultsStore(fname, matname):
+    """
+    Converts the HDF5 results store of a batch analysis to the legacy 
+    batchAnalysisResults.mat file.
+    
+    Args:
+        fname(str): path to the results store.
+        
+        matname(str): path to where the .mat file needs to be saved.
+    """
+    
+    batchAnalysisResults    = readBatchResultsStore(fname)
+    writeBatchAnalysisDict(batchAnalysisResults, matname)
+
+
 
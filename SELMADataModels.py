@@ -5,6 +5,7 @@ This module is contains all the relevant classes that form the second layer
 between the SELMA GUI and the data objects. It contains the following classes:
 
 + :class: `SDMSignals`
++ :class: `AnalysisWorker`
 + :class: `SelmaDataModel`
 
 """
@@ -12,6 +13,7 @@ between the SELMA GUI and the data objects. It contains the following classes:
 # ====================================================================
 
 import os
+import traceback
 import numpy as np
 from PyQt5 import (QtCore)
 import threading
@@ -21,6 +23,7 @@ import threading
 import SELMAData
 import SELMADataIO
 import SELMABatchAnalysis
+import SELMASweep
 
 # ====================================================================
 
@@ -33,17 +36,86 @@ class SDMSignals(QtCore.QObject):
     """
     
     setPixmapSignal         = QtCore.pyqtSignal(np.ndarray) 
+    setFramesSignal         = QtCore.pyqtSignal(object) 
+    showFrameSignal         = QtCore.pyqtSignal(int) 
+    playFramesSignal        = QtCore.pyqtSignal(object) 
     sendVesselMaskSignal    = QtCore.pyqtSignal(np.ndarray) 
     sendMaskSignal          = QtCore.pyqtSignal(np.ndarray) 
     setProgressBarSignal    = QtCore.pyqtSignal(int) 
     setProgressLabelSignal  = QtCore.pyqtSignal(str) 
+    analysisProgressSignal  = QtCore.pyqtSignal(str, float) 
+    busySignal              = QtCore.pyqtSignal(bool) 
+    workerFinishedSignal    = QtCore.pyqtSignal(object) 
+    batchBusySignal         = QtCore.pyqtSignal(bool) 
+    batchProgressSignal     = QtCore.pyqtSignal(int, int, str) 
+    batchStageSignal        = QtCore.pyqtSignal(str, float) 
+    batchFailedSignal       = QtCore.pyqtSignal(str, str) 
     setFrameCountSignal     = QtCore.pyqtSignal(int, int) 
-    pixelValueSignal        = QtCore.pyqtSignal(int, int, float)
+    framesLoadedSignal      = QtCore.pyqtSignal(int) 
+    framesLoadFailedSignal  = QtCore.pyqtSignal() 
+    clearFramesSignal       = QtCore.pyqtSignal() 
     errorMessageSignal      = QtCore.pyqtSignal(str)
     infoMessageSignal       = QtCore.pyqtSignal(str)
     
     sendImVarSignal         = QtCore.pyqtSignal(dict)
     
+    
+class AnalysisWorker(QtCore.QRunnable):
+    """
+    Runs an analysis in the global QThreadPool, so the GUI stays 
+    responsive. The analysis is given a cancellation token 
+    (threading.Event) that it checks at the start of every stage. 
+    """
+    
+    def __init__(self, function, signalObject, description = "analysis"):
+        """
+        Args:
+            function(callable): the analysis. It is called with the 
+            cancellation token as its only argument.
+            
+            signalObject(SDMSignals): used to report that the analysis 
+            was cancelled or stopped with an error, and to send 
+            workerFinishedSignal with the worker when it has stopped.
+            
+            description(str): what the function does, used in the 
+            messages to the user.
+        """
+        super(AnalysisWorker, self).__init__()
+        
+        #The worker is kept by the data model, not by the thread pool.
+        self.setAutoDelete(False)
+        
+        self._function      = function
+        self._signalObject  = signalObject
+        self._description   = description
+        self._cancelEvent   = threading.Event()
+        
+    def cancel(self):
+        """Stops the analysis at the start of its next stage."""
+        self._cancelEvent.set()
+        self._signalObject.setProgressLabelSignal.emit(
+            "Cancelling " + self._description)
+        
+    def run(self):
+        try:
+            self._function(self._cancelEvent)
+            
+        except SELMAData.AnalysisCancelled:
+            self._signalObject.setProgressBarSignal.emit(0)
+            self._signalObject.setProgressLabelSignal.emit(
+                self._description.capitalize() + " cancelled")
+            
+        except Exception as e:
+            traceback.print_exc()
+            self._signalObject.errorMessageSignal.emit(
+                "The " + self._description + 
+                " stopped because of an error: " + str(e))
+            
+        finally:
+            #Handled in the GUI thread by the data model
+            self._signalObject.workerFinishedSignal.emit(self)
+    
+    
 class SelmaDataModel:
     """
     This class is the hub that manages all the data that is used in the 
@@ -69,7 +141,27 @@ class SelmaDataModel:
         
         self._displayT1     = False;
         
+        #Only one analysis of the shown scan runs at a time
+        self._worker        = None
+        self._busy          = False
+        
+        #The batch analysis runs next to it, it doesn't use the shown scan
+        self._batchWorker   = None
+        self._batchBusy     = False
+        self._batchControl  = None
+        
+        #Masks drawn during an analysis, by slice. They are applied when
+        #the analysis has finished.
+        self._pendingMasks  = dict()
+        
         self.signalObject = SDMSignals()
+        self.signalObject.workerFinishedSignal.connect(self._workerFinished)
+        
+        #The frames are read in a worker, the frame count is updated on
+        #the GUI thread
+        self.signalObject.framesLoadedSignal.connect(self._framesLoaded)
+        self.signalObject.framesLoadFailedSignal.connect(
+            self._framesLoadFailed)
         
         
     '''Public'''
@@ -95,9 +187,11 @@ class SelmaDataModel:
                 frameMax   (int): the total number of Frames.
         """
         
-        if self._SDO is None:
+        if self._SDO is None or self._frameMax == 0:
             return
         
+        sliceIdx = self._getSliceIdx()
+        
         if not self._displayT1:
             self._frameCount += direction
             if self._frameCount <= 0:
@@ -107,6 +201,10 @@ class SelmaDataModel:
                 self._frameCount = 1
             
         self._displayFrame()
+        
+        #Show the masks of the new slice of a multi-slice scan
+        if self._getSliceIdx() != sliceIdx:
+            self._displaySliceMasks()
     
     
     def loadMaskSlot(self, fname):
@@ -122,7 +220,7 @@ class SelmaDataModel:
                 mask (numpy.ndarray): the mask which was referred to.        
         """
         
-        if fname is None or self._SDO is None:
+        if fname is None or self._SDO is None or self._isBusy():
             return
         
         mask = SELMADataIO.loadMask(fname)
@@ -139,7 +237,14 @@ class SelmaDataModel:
         maskShape   = mask.shape
         frameShape  = frame.shape
         
-        if maskShape != frameShape:
+        #Multi-slice scans can have a mask per slice
+        sliceShape  = (self._SDO.getNumSlices(),) + frameShape
+        
+        if maskShape == sliceShape and self._getSliceIdx() is not None:
+            self._SDO.setMask(mask)
+            self._displaySliceMasks()
+        
+        elif maskShape != frameShape:
             errStr  = "The dimensions of the frame and the mask do not align."
             self.signalObject.errorMessageSignal.emit(errStr + 
                                                       str(frameShape) + 
@@ -178,6 +283,8 @@ class SelmaDataModel:
             self.signalObject.errorMessageSignal.emit(
                     "Please load a T1 dicom first.")
             return
+        if self._isBusy():
+            return
         
         self._SDO.segmentMask()
         
@@ -201,6 +308,9 @@ class SelmaDataModel:
     def loadDCMSlot(self, fname):
         """
         Loads a new DCM into the SDO. Triggered when the openAct is called.
+        Only the header and the first frame are read before the first frame
+        is shown. The other frames are read in the background and can be 
+        scrolled through as soon as they are read.
         
         Args:
             fname (str): path to the Dicom file.
@@ -214,15 +324,23 @@ class SelmaDataModel:
         
         """
         
-        if fname is None:
+        if fname is None or self._isBusy():
             return
         
         self._SDO   = SELMAData.SELMADataObject(self.signalObject,
-                                                dcmFilename= fname)
+                                                dcmFilename= fname,
+                                                progressive = True)
         self._frameCount    = 1
-        self._frameMax      = self._SDO.getNumFrames()
+        self._frameMax      = len(self._SDO.getFrames())
+        self._displayT1     = False
         
-        self._displayFrame()
+        self.signalObject.setFramesSignal.emit(self._SDO.getFrames())
+        
+        #Compressed frames are only shown once they are decoded
+        if self._frameMax > 0:
+            self._displayFrame()
+        
+        self._startWorker(self._loadFrames, "loading of the scan")
         
             
     def loadClassicDCMSlot(self, fnames):
@@ -234,7 +352,7 @@ class SelmaDataModel:
             fnames(tuple(str)): list of filenames
                 
         """
-        if fnames is None:
+        if fnames is None or self._isBusy():
             return
  
         self._SDO   = SELMAData.SELMADataObject(self.signalObject,
@@ -242,6 +360,9 @@ class SelmaDataModel:
                                                 classic = True)
         self._frameCount = 1
         self._frameMax = self._SDO.getNumFrames()
+        self._displayT1     = False
+        
+        self.signalObject.setFramesSignal.emit(self._SDO.getFrames())
         
         self._displayFrame()
         
@@ -261,6 +382,8 @@ class SelmaDataModel:
             self.signalObject.errorMessageSignal.emit(
                     "Please load a PCA dicom first.")
             return
+        if self._isBusy():
+            return
         
         self._SDO.setT1(fname)
         self._t1FrameCount  = 1
@@ -272,30 +395,56 @@ class SelmaDataModel:
         
     def applyMaskSlot(self, mask):
         """
-        Sets the drawn mask into the data object.
+        Sets the drawn mask into the data object. For multi-slice scans
+        the mask is set for the slice of the current frame. The mask is 
+        not changed while an analysis is running, the latest mask of every
+        slice is applied when it has finished.
         
         Args:
             mask (numpy.ndarray): mask from the GUI.
         
         """
-        self._SDO.setMask(mask)
+        if self._SDO is None:
+            return
+        
+        sliceIdx = self._getSliceIdx()
+        if self._busy:
+            #Keep the order in which the masks were drawn
+            self._pendingMasks.pop(sliceIdx, None)
+            self._pendingMasks[sliceIdx] = np.copy(mask)
+            return
+        
+        self._SDO.setMask(mask, sliceIdx)
     
     
     def analyseVesselSlot(self):
         """
         Slot for analyseVesselSignal. Tells the SDO to analyse the vessels
-        in its current dataset.
+        in its current dataset. The analysis runs in a background thread
+        and can be stopped with cancelAnalysisSlot.
         
         """
         if self._SDO is None:
             self.signalObject.errorMessageSignal.emit("No DICOM loaded.")
             return
+        if self._isBusy():
+            return
+        
+        self._startWorker(self._analyseVessels)
+        
+    
+    def cancelAnalysisSlot(self):
+        """
+        Slot for cancelAnalysisSignal. Stops the running analysis at the 
+        start of its next stage. The analysis of the shown scan is 
+        cancelled first, otherwise the batch analysis.
+        """
         
-        self.analysisThread = threading.Thread(
-                                target= self._SDO.analyseVessels,
-                                daemon = True)    
+        if self._busy:
+            self._worker.cancel()
+        elif self._batchBusy:
+            self._batchWorker.cancel()
         
-        self.analysisThread.start()
         
     
     def analyseBatchSlot(self, dirName):
@@ -311,29 +460,145 @@ class SelmaDataModel:
             Then the vesselAnalysis function is called and the results are
             written to a .txt file with the same name.
             
+        The batch runs in the background, next to the analysis of the 
+        shown scan. Its progress is sent with the batchProgressSignal, and 
+        it can be paused or stopped after the current scan with 
+        pauseBatchSlot and stopBatchSlot.
+            
         Args:
             dirname(str): path to the directory containing all input files.
         """
         
-        #TODO: add progress feedback
-
-        self.signalObject.infoMessageSignal.emit(
-            "GUI may become unresponsive while executing batch analysis. "+
-            "Please do not close GUI until batch analysis is complete "+
-            "or an error has occured. Press OK to continue.")
+        if self._isBatchBusy():
+            return
 
         files = os.listdir(dirName)
         
         if not any(os.path.isdir(dirName + '/' + subfolder) 
                    for subfolder in files):
      
-            SELMABatchAnalysis.EnhancedBatchAnalysis(dirName, files, self)
+            batchAnalysis = SELMABatchAnalysis.EnhancedBatchAnalysis
+            
+        else:
             
-        elif any(os.path.isdir(dirName + '/' + subfolder) 
-                 for subfolder in files):
+            batchAnalysis = SELMABatchAnalysis.ClassicBatchAnalysis
+        
+        batchControl        = SELMABatchAnalysis.BatchControl()
+        
+        self._startBatchWorker(lambda cancelEvent: batchAnalysis(
+                                                            dirName, 
+                                                            files, 
+                                                            self,
+                                                            cancelEvent,
+                                                            batchControl),
+                               batchControl)
+        
+    def sweepSlot(self, dirName):
+        """Slot for the sweep signal.
+        Analyses every enhanced .dcm file in the directory that has a mask
+        for every combination of the values in the Sweep tab of the 
+        settings, see SELMASweep.sweepDirectory. The results are written to
+        sweepResults.csv in the directory.
+        
+        The sweep runs in the background as a batch analysis, next to the 
+        analysis of the shown scan, and can be paused or stopped after the 
+        current scan.
+            
+        Args:
+            dirname(str): path to the directory containing all input files.
+        """
+        
+        if self._isBatchBusy():
+            return
+        
+        try:
+            grid = SELMASweep.getSweepGrid()
+        except ValueError as e:
+            self.signalObject.errorMessageSignal.emit(str(e))
+            return
+        
+        if not grid:
+            self.signalObject.errorMessageSignal.emit(
+                "No values to sweep. Enter them in the Sweep tab of the " +
+                "settings.")
+            return
+
+        files = os.listdir(dirName)
+        
+        batchControl        = SELMABatchAnalysis.BatchControl()
+        
+        self._startBatchWorker(lambda cancelEvent: SELMASweep.sweepDirectory(
+                                                            dirName,
+                                                            files, 
+                                                            grid,
+                                                            self,
+                                                            cancelEvent,
+                                                            batchControl),
+                               batchControl)
+        
+    def pauseBatchSlot(self, paused):
+        """
+        Pauses or resumes the running batch analysis. A paused batch 
+        finishes the current scan and waits before starting the next one.
+        
+        Args:
+            paused(bool): True to pause, False to resume.
+        """
+        
+        if not self._batchBusy:
+            return
+        
+        if paused:
+            self._batchControl.pause()
+        else:
+            self._batchControl.resume()
             
-            SELMABatchAnalysis.ClassicBatchAnalysis(dirName, files, self)
+    def stopBatchSlot(self):
+        """Stops the running batch analysis after the current scan."""
+        
+        if not self._batchBusy:
+            return
+        
+        self._batchControl.stop()
                                    
+    def playSlot(self):
+        """
+        Slot for playSignal. Sends the frames to play to the GUI: the 
+        frames of the same type (velocity, magnitude, ...) as the shown
+        frame. For multi-slice scans only the frames of the shown slice
+        are played.
+        """
+        
+        if self._SDO is None or self._displayT1:
+            return
+        
+        frame   = self._frameCount - 1
+        indices = list(range(self._frameMax))
+        for typeIndices in self._SDO.getFrameIndices().values():
+            if frame in typeIndices:
+                indices = list(typeIndices)
+        
+        sliceIdx = self._getSliceIdx()
+        if sliceIdx is not None:
+            indices = [idx for idx in indices 
+                       if self._SDO.getSliceIndex(idx) == sliceIdx]
+        
+        self.signalObject.playFramesSignal.emit(indices)
+        
+    def playbackFrameSlot(self, idx):
+        """
+        Slot for the playbackFrameSignal of the image viewer. Keeps track
+        of the frame that is shown during playback, so scrolling continues
+        from there.
+        
+        Args:
+            idx(int): index of the shown frame.
+        """
+        
+        self._frameCount = idx + 1
+        self.signalObject.setFrameCountSignal.emit(self._frameCount,
+                                                   self._frameMax)
+        
     def switchViewSlot(self):
         if self._SDO is None:
             return
@@ -358,31 +623,6 @@ class SelmaDataModel:
         vesselDict = self._SDO.getVesselDict()
         SELMADataIO.writeVesselDict(vesselDict, fname)
         
-    def pixelValueSlot(self, x,y):
-        """
-        Slot for mouseMoveEvent in the GUI. Sends back the cursor location
-        as well as the value of the current frame under that location.
-        
-        Args:
-            x (int): x-index of the frame
-            y (int): y-index of the frame
-            
-        Returns:
-            Sends the following via a signal:
-                x (int): x-index of the frame
-                y (int): y-index of the frame
-                pixelValue (float): value of the current frame at [x,y]
-        """        
-        
-        if self._SDO is None:
-            return
-        
-        frames      = self._SDO.getFrames()
-        frame       = frames[self._frameCount - 1]
-        pixelValue  = frame[y,x]
-        
-        self.signalObject.pixelValueSignal.emit(x, y, pixelValue)
-        
     def getVarSlot(self):
         
         if self._SDO is None:
@@ -405,6 +645,8 @@ class SelmaDataModel:
         if self._SDO is None:
             self.signalObject.errorMessageSignal.emit("No DICOM loaded.")
             return
+        if self._isBusy():
+            return
             
         for variable in variables:
             
@@ -439,6 +681,152 @@ class SelmaDataModel:
     
     '''Private'''
         
+    def _analyseVessels(self, cancelEvent):
+        """Analyses the vessels and shows the masks of the current slice
+        of a multi-slice scan afterwards. Runs in an AnalysisWorker."""
+        
+        self._SDO.analyseVessels(cancelEvent)
+        self._displaySliceMasks()
+    
+    def _loadFrames(self, cancelEvent):
+        """Reads the frames of a scan that was opened progressively. Runs
+        in an AnalysisWorker. A scan that is not read completely is 
+        closed by _framesLoadFailed."""
+        
+        try:
+            self._SDO.loadFrames(cancelEvent, 
+                                 self.signalObject.framesLoadedSignal.emit)
+        except Exception:
+            self.signalObject.framesLoadFailedSignal.emit()
+            raise
+    
+    def _framesLoaded(self, numFrames):
+        """Slot for the framesLoadedSignal, which is sent by _loadFrames 
+        while the frames are read. Lets the user scroll through the frames
+        that are read."""
+        
+        first           = self._frameMax == 0
+        self._frameMax  = numFrames
+        
+        if first:
+            self._displayFrame()
+        else:
+            self.signalObject.setFrameCountSignal.emit(self._frameCount,
+                                                       self._frameMax)
+    
+    def _framesLoadFailed(self):
+        """Slot for the framesLoadFailedSignal. Closes the scan that could
+        not be read completely and removes it from the viewer. Runs in the
+        GUI thread, so the scan isn't closed while a slot is using it."""
+        
+        self._SDO           = None
+        self._frameCount    = 1
+        self._frameMax      = 0
+        
+        self.signalObject.clearFramesSignal.emit()
+    
+    def _isBusy(self):
+        """Returns True, and tells the user, if an analysis is running."""
+        
+        if self._busy:
+            self.signalObject.errorMessageSignal.emit(
+                "An analysis is running. Please wait until it is finished "
+                "or cancel it.")
+        
+        return self._busy
+    
+    def _isBatchBusy(self):
+        """Returns True, and tells the user, if a batch analysis is 
+        running."""
+        
+        if self._batchBusy:
+            self.signalObject.errorMessageSignal.emit(
+                "A batch analysis is running. Please wait until it is "
+                "finished or stop it.")
+        
+        return self._batchBusy
+    
+    def _startWorker(self, function, description = "analysis"):
+        """Runs function in an AnalysisWorker and marks the data model as 
+        busy until it has finished."""
+        
+        self._busy      = True
+        self._worker    = AnalysisWorker(function, self.signalObject,
+                                         description)
+        self.signalObject.busySignal.emit(True)
+        
+        QtCore.QThreadPool.globalInstance().start(self._worker)
+    
+    def _startBatchWorker(self, function, batchControl):
+        """Runs a batch analysis in an AnalysisWorker and marks the batch 
+        as busy until it has finished.
+        
+        Args:
+            function(callable): the batch analysis, called with the
+            cancellation token.
+            batchControl(BatchControl): pauses or stops the batch.
+        """
+        
+        self._batchBusy     = True
+        self._batchControl  = batchControl
+        self._batchWorker   = AnalysisWorker(function, self.signalObject,
+                                             "batch analysis")
+        self.signalObject.batchBusySignal.emit(True)
+        
+        QtCore.QThreadPool.globalInstance().start(self._batchWorker)
+    
+    def _workerFinished(self, worker):
+        """Slot for workerFinishedSignal, runs in the GUI thread when an
+        AnalysisWorker has stopped. Applies the masks that were drawn 
+        during the analysis of the shown scan."""
+        
+        if worker is self._batchWorker and self._batchBusy:
+            self._batchBusy     = False
+            self._batchControl  = None
+            self.signalObject.batchBusySignal.emit(False)
+            return
+        
+        if worker is not self._worker:
+            return
+        
+        self._busy          = False
+        
+        pendingMasks        = self._pendingMasks
+        self._pendingMasks  = dict()
+        if self._SDO is not None:
+            for sliceIdx, mask in pendingMasks.items():
+                self._SDO.setMask(mask, sliceIdx)
+        
+        self.signalObject.busySignal.emit(False)
+    
+    def _getSliceIdx(self):
+        """Returns the slice of the current frame, or None if the scan
+        has a single slice."""
+        
+        if self._SDO is None or self._SDO.getNumSlices() == 1:
+            return None
+        
+        return self._SDO.getSliceIndex(self._frameCount - 1)
+    
+    def _displaySliceMasks(self):
+        """Sends the mask and the vessel mask of the slice of the current
+        frame to the GUI, for multi-slice scans."""
+        
+        sliceIdx = self._getSliceIdx()
+        if sliceIdx is None:
+            return
+        
+        mask = self._SDO.getMask()
+        if mask is None:
+            frames  = self._SDO.getFrames()
+            mask    = np.zeros(np.shape(frames[0]), dtype = bool)
+        elif mask.ndim == 3:
+            mask    = mask[sliceIdx]
+        self.signalObject.sendMaskSignal.emit(np.copy(mask))
+        
+        vesselMask = self._SDO.getVesselMask()
+        if vesselMask is not None and vesselMask.ndim == 3:
+            self.signalObject.sendVesselMaskSignal.emit(vesselMask[sliceIdx])
 
     def _displayFrame(self):
         
@@ -447,11 +835,10 @@ class SelmaDataModel:
             frame   = self._SDO.getT1().getFrames()
 #            frame   = frames[self._t1FrameCount - 1]
             self.signalObject.setFrameCountSignal.emit(1, 1)
+            self.signalObject.setPixmapSignal.emit(frame)
             
         else:
-            frames      = self._SDO.getFrames()
-            frame       = frames[self._frameCount - 1]
+            #The GUI keeps the converted frames of the series
             self.signalObject.setFrameCountSignal.emit(self._frameCount,
                                                        self._frameMax)
-            
-        self.signalObject.setPixmapSignal.emit(frame)
+            self.signalObject.showFrameSignal.emit(self._frameCount - 1)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+This module belongs to the SELMAData module. It contains the streaming
+version of the first steps of the vessel analysis. Instead of loading all
+velocity and magnitude frames at once, the frames are read one at a time and
+only running statistics per pixel are kept. The voxel time series are only
+gathered for the voxels that end up in a vessel.
+
+Peak memory use is therefore proportional to the size of a single frame,
+independent of the number of phases.
+
+"""
+
+# ====================================================================
+import numpy as np
+
+# ====================================================================
+
+import SELMAData
+
+# ====================================================================
+
+class RunningStatistics:
+    """
+    Running estimator of the mean and variance per pixel of a series of
+    frames, using Welford's algorithm. Frames are added one at a time with
+    update.
+    """
+
+    def __init__(self):
+        self._count     = 0
+        self._sum       = None
+        self._mean      = None
+        self._M2        = None
+
+    def update(self, frame):
+        """Adds a frame to the statistics."""
+
+        frame           = np.asarray(frame, dtype = np.float64)
+        self._count    += 1
+
+        if self._count == 1:
+            self._sum   = frame.copy()
+            self._mean  = frame.copy()
+            self._M2    = np.zeros(frame.shape)
+            return
+
+        self._sum      += frame
+        delta           = frame - self._mean
+        self._mean     += delta / self._count
+        self._M2       += delta * (frame - self._mean)
+
+    def getCount(self):
+        return self._count
+
+    def getMean(self):
+        """Returns the mean per pixel. The sum of the frames is divided by
+        the count, the same way as np.mean does."""
+
+        return self._sum / self._count
+
+    def getVariance(self, ddof = 0):
+        """Returns the variance per pixel."""
+
+        return self._M2 / (self._count - ddof)
+
+    def getTotalSTD(self):
+        """Returns the standard deviation of all pixels of all frames
+        together, as np.std of the whole stack."""
+
+        totalMean   = np.mean(self._mean)
+        totalM2     = (np.sum(self._M2) +
+                       self._count * np.sum((self._mean - totalMean)**2))
+
+        return np.sqrt(totalM2 / (self._count * self._mean.size))
+
+
+# ====================================================================
+
+def iterFrames(self):
+    """Yields the velocity and magnitude frames of the scan in pairs, one
+    phase at a time."""
+
+    return zip(self._selmaDicom.iterVelocityFrames(),
+               self._selmaDicom.iterMagnitudeFrames())
+
+
+def calculateStatistics(self):
+    """
+    Streaming replacement of _calculateMedians, _subtractMedian and _SNR.
+    Reads the frames twice:
+
+        First pass: running mean of the velocity and magnitude, and running
+            variance of the real and imaginary part of the complex signal.
+            From these the median filtered frames are made.
+        Second pass: with the median filtered frames known, the mean of the
+            corrected velocity, the velocity and magnitude SNR and whether
+            the sign of the corrected velocity changes are accumulated.
+
+    Only maps of a single frame are stored on the SELMADataObject.
+    """
+
+    venc                = self._selmaDicom.getTags()['venc']
+
+    #First pass
+    velocityStats       = RunningStatistics()
+    magnitudeStats      = RunningStatistics()
+    realStats           = RunningStatistics()
+    imagStats           = RunningStatistics()
+
+    for velocityFrame, magnitudeFrame in iterFrames(self):
+        phaseFrame      = velocityFrame * np.pi / venc
+
+        velocityStats.update(velocityFrame)
+        magnitudeStats.update(magnitudeFrame)
+        realStats.update(magnitudeFrame * np.cos(phaseFrame))
+        imagStats.update(magnitudeFrame * np.sin(phaseFrame))
+
+    self._nPhases               = velocityStats.getCount()
+    self._meanVelocityFrame     = velocityStats.getMean()
+    self._meanMagnitudeFrame    = magnitudeStats.getMean()
+    self._stdMagnitude          = magnitudeStats.getTotalSTD()
+    self._meanRealSignal        = realStats.getMean()
+    self._meanImagSignal        = imagStats.getMean()
+
+    rmsSTD              = np.sqrt(realStats.getVariance(ddof = 1) +
+                                  imagStats.getVariance(ddof = 1))
+
+    self._filterMeanFrames(rmsSTD)
+
+    #Second pass
+    shape               = self._meanVelocityFrame.shape
+    correctedSum        = np.zeros(shape)
+    velocitySNRSum      = np.zeros(shape)
+    magnitudeSNRSum     = np.zeros(shape)
+    noZeroCrossings     = np.ones(shape, dtype = bool)
+    firstSigns          = None
+
+    for velocityFrame, magnitudeFrame in iterFrames(self):
+        correctedFrame  = velocityFrame - self._medianVelocityFrame
+        magnitudeSNR    = SELMAData.div0(magnitudeFrame, self._medianRMSSTD)
+        velocitySTD     = venc / np.pi * SELMAData.div0(1, magnitudeSNR)
+
+        correctedSum       += correctedFrame
+        magnitudeSNRSum    += magnitudeSNR
+        velocitySNRSum     += SELMAData.div0(correctedFrame, velocitySTD)
+
+        signs           = np.sign(correctedFrame)
+        if firstSigns is None:
+            firstSigns  = signs
+        else:
+            noZeroCrossings &= signs == firstSigns
+
+    self._meanCorrectedVelocity = correctedSum / self._nPhases
+    self._magnitudeSNRMask      = (magnitudeSNRSum / self._nPhases > 2
+                                   ).astype(np.uint8)
+    self._velocitySNR           = velocitySNRSum / self._nPhases
+    self._noZeroCrossings       = noZeroCrossings
+
+
+def gatherVoxelSeries(self):
+    """
+    Reads the frames a last time and stores the corrected velocity and
+    magnitude time series of all voxels in the remaining vessels
+    (_lone_vessels). These are used by _calculateParameters and
+    _makeVesselDict via _getVoxelSeries.
+    """
+
+    shape               = self._meanVelocityFrame.shape
+    vesselVoxels        = np.zeros(shape, dtype = bool)
+    for vessel in self._lone_vessels:
+        vesselVoxels   |= np.asarray(vessel).astype(bool)
+
+    rows, columns       = np.nonzero(vesselVoxels)
+
+    self._voxelSeriesIndex                  = np.full(shape, -1,
+                                                      dtype = np.int64)
+    self._voxelSeriesIndex[rows, columns]   = np.arange(len(rows))
+    self._voxelVelocitySeries   = np.zeros((self._nPhases, len(rows)))
+    self._voxelMagnitudeSeries  = np.zeros((self._nPhases, len(rows)))
+
+    medianVelocity      = self._medianVelocityFrame[rows, columns]
+
+    for phase, (velocityFrame, magnitudeFrame) in enumerate(
+                                                        iterFrames(self)):
+        self._voxelVelocitySeries[phase]    = (velocityFrame[rows, columns]
+                                               - medianVelocity)
+        self._voxelMagnitudeSeries[phase]   = magnitudeFrame[rows, columns]
@@ -11,12 +11,51 @@ This module contains the following classes:
 # ====================================================================
 #IO
 
+import copy
+import functools
 import pydicom
 import numpy as np
 import SELMAGUISettings
 from PyQt5 import QtCore
 # ====================================================================
 
+class LazyFrames:
+    """
+    Sequence of frames that are only read from the file when they are
+    indexed. Used in streaming mode instead of an array with all frames, so
+    only one frame is in memory at a time. Converting it to an array with
+    np.asarray still reads all frames.
+    """
+
+    def __init__(self, getFrame, indices):
+        """
+        Args:
+            getFrame(function): returns the frame at an index in the file.
+            indices(list): indices in the file of the frames in this
+            sequence.
+        """
+        self._getFrame  = getFrame
+        self._indices   = list(indices)
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, idx):
+        return self._getFrame(self._indices[idx])
+
+    def __iter__(self):
+        for idx in self._indices:
+            yield self._getFrame(idx)
+    
+    def addIndex(self, idx):
+        """Adds the frame at idx in the file to the end of the sequence."""
+        self._indices.append(idx)
+
+    def __array__(self, dtype = None, copy = None):
+        return np.asarray([frame for frame in self], dtype = dtype)
+
+# ====================================================================
+
 class SELMADicom:
     """
     This class contains all methods concerning the handling of .dcm (Dicom)
@@ -24,35 +63,49 @@ class SELMADicom:
     etc. is managed here.
     """
     
-    def __init__(self, dcmFilename):
+    def __init__(self, dcmFilename, streaming = False, progressive = False):
         """Read the dicom header using pydicom. 
         Also extract the pixel array.
-        Call the functions that initiate the Dicom."""
+        Call the functions that initiate the Dicom.
+        
+        In streaming mode the pixel array is not decoded up front. Instead,
+        every frame is read from the file when it is needed.
+        
+        In progressive mode only the header and the first frame are read, 
+        so the first frame can be shown right away. The other frames are
+        read with loadFrames."""
         
         self._dcmFilename   = dcmFilename
-        self._DCM           = pydicom.dcmread(self._dcmFilename)
-
+        self._streaming     = streaming
         self._tags          = dict()
-        self._rawFrames     = self._DCM.pixel_array
-        self._numFrames     = len(self._rawFrames)
         self._rescaleVelocity   = None
         
+        if streaming or progressive:
+            self._openRawFrames(decode = not progressive)
+        else:
+            self._DCM       = pydicom.dcmread(self._dcmFilename)
+            self._rawFrames = self._DCM.pixel_array
+            self._numFrames = len(self._rawFrames)
+        
         #Get manufacturer
         self._findManufacturer()
         
-        #find important Tags
-        self._findRescaleValues()    
+        #find the tags that are the same for all frames
         self._findVEncoding()
-        self._findFrameTypes()
         self._findPixelSpacing()     
         self._findNoiseScalingFactors()
         self._findTargets()
         
-        #Get rescale values and apply
-        self._rescaleFrames()
+        #The tags of every frame are found when the frame is read
+        self._initFrames()
         
-        #Sort the frames on their type
-        self._orderFramesOnType()
+        if progressive:
+            #Compressed frames can only be shown after they are decoded
+            if self._rawFrames is not None:
+                self._readFrame(0)
+            return
+        
+        self.loadFrames()
     
         
     '''Public'''
@@ -73,9 +126,14 @@ class SELMADicom:
     def getNumFrames(self):
         return self._numFrames
     
+    def getFrameIndices(self):
+        """Returns a dictionary with the indices of the velocity, 
+        magnitude, modulus and phase frames."""
+        return self._frameIndices
+    
     def getVelocityFrames(self):
 
-        if self._velocityFrames != []:
+        if len(self._velocityFrames) > 0:
             return self._velocityFrames
         else:
             return self._makeVelocityFrames()[0]
@@ -87,7 +145,7 @@ class SELMADicom:
         return self._modulusFrames
     
     def getRawVelocityFrames(self):
-        if self._rawVelocityFrames != []:
+        if len(self._rawVelocityFrames) > 0:
             return self._rawVelocityFrames
         else:
             return self._makeVelocityFrames()[1]
@@ -103,9 +161,124 @@ class SELMADicom:
     
     def getPixelSpacing(self):
         return self._tags['pixelSpacing']
+    
+    def getNumSlices(self):
+        return self._numSlices
+    
+    def getSliceIndex(self, frame):
+        """Returns the index of the slice that the frame belongs to."""
+        return self._tags['sliceIndices'][frame]
+    
+    def getSlice(self, sliceIdx):
+        """
+        Returns a SELMADicom object that only contains the frames of one 
+        slice of a multi-slice scan. The header and the raw frames are 
+        shared with this object, so no data is read from the file again.
+        
+        Args:
+            sliceIdx(int): index of the slice, in the order of the slice
+            positions.
+        
+        Returns:
+            SELMADicom object of the slice.
+        """
+        
+        sliceIndices                = self._tags['sliceIndices']
+        
+        sliceDicom                  = copy.copy(self)
+        sliceDicom._tags            = dict(self._tags)
+        sliceDicom._numSlices       = 1
+        sliceDicom._frameIndices    = dict(
+            (key, [idx for idx in indices if sliceIndices[idx] == sliceIdx])
+            for key, indices in self._frameIndices.items())
+        sliceDicom._collectFrames()
+        
+        if sliceDicom._rescaleVelocity is not None:
+            sliceDicom._rescaleVelocityFrames()
+        
+        return sliceDicom
+    
+    def iterVelocityFrames(self):
+        """
+        Yields the velocity frames one at a time. Gives the same frames as
+        getVelocityFrames, but in streaming mode only one frame is read
+        from the file at a time.
+        """
+        
+        if len(self._velocityFrames) > 0:
+            for frame in self._velocityFrames:
+                yield np.asarray(frame)
+            return
+        
+        if len(self._phaseFrames) == 0:
+            return
+        
+        venc            = self._tags['venc']
+        minPhase, maxPhase  = getFrameRange(self._phaseFrames)
+        
+        #Velocity frames that are accidentally stored as phase
+        if np.round(maxPhase, 1) == venc and np.round(minPhase, 1) == -venc:
+            for frame in self._phaseFrames:
+                yield np.asarray(frame)
+            return
+        
+        if self._rescaleVelocity is not None:
+            minVel, maxVel  = self._rescaleVelocity
+            minRaw, maxRaw  = getFrameRange(self._rawPhaseFrames)
+            
+            deltaVel        = np.abs(minVel - maxVel)
+            deltaRaw        = np.abs(float(minRaw) - float(maxRaw))
+            slope           = deltaRaw / deltaVel
+            intercept       = deltaRaw / 2 + float(minRaw)
+            
+            for frame in self._rawPhaseFrames:
+                yield (np.asarray(frame) - intercept) / slope
+            return
+        
+        for frame in self._phaseFrames:
+            yield np.asarray(frame) * venc / np.pi
+    
+    def iterMagnitudeFrames(self):
+        """
+        Yields the magnitude frames one at a time, see iterVelocityFrames.
+        """
+        
+        for frame in self._magnitudeFrames:
+            yield np.asarray(frame)
 
         
     
+    def loadFrames(self, progress = None):
+        """
+        Reads the frames that are not read yet: finds the tags of every 
+        frame, applies the rescale values and sorts the frames on their 
+        type. Called by __init__, or after it in progressive mode.
+        
+        Args:
+            progress(callable): called with the number of frames that are
+            read after every frame. These frames can already be shown with
+            getFrames.
+        """
+        
+        if self._rawFrames is None:
+            self._rawFrames = self._decodeRawFrames()
+        
+        for idx in range(len(self._rescaledFrames), self._numFrames):
+            self._readFrame(idx)
+            
+            if progress is not None:
+                progress(idx + 1)
+        
+        #Without streaming all frames are kept in memory
+        if not self._streaming and isinstance(self._rawFrames, np.memmap):
+            self._rawFrames = np.array(self._rawFrames)
+        
+        self._findSlicePositions()
+        
+        #Sort the frames on their type
+        self._orderFramesOnType()
+        
+    
     #Setter functions
     # ------------------------------------------------------------------    
     
@@ -146,12 +319,9 @@ class SELMADicom:
 
         self._tags['manufacturer'] = self._DCM[0x0008, 0x0070].value
     
-    def _findRescaleValues(self):
-        """Finds the rescale slope and intercept
-        and applies it to the frames"""
-        
-        rescaleSlopes     = []
-        rescaleIntercepts = []
+    def _findRescaleValues(self, i):
+        """Finds the rescale slope and intercept of frame i
+        and adds them to the tags"""
         
         #Philips
         if 'philips' in self._tags['manufacturer'].lower():
@@ -161,17 +331,16 @@ class SELMADicom:
             dcmRescaleInterceptAddress  = 0x2005, 0x100D
             
             
-            for i in range(self._numFrames):
-                rescaleSlope        = float(self._DCM[dcmFrameAddress][i]           
-                                        [dcmPrivateCreatorAddress][0]      
-                                        [dcmRescaleSlopeAddress].value)
-                          
-                rescaleIntercept    = float(self._DCM[dcmFrameAddress][i]           
-                                        [dcmPrivateCreatorAddress][0]      
-                                        [dcmRescaleInterceptAddress].value)
-                
-                rescaleSlopes.append(rescaleSlope)
-                rescaleIntercepts.append(rescaleIntercept)
+            rescaleSlope        = float(self._DCM[dcmFrameAddress][i]           
+                                    [dcmPrivateCreatorAddress][0]      
+                                    [dcmRescaleSlopeAddress].value)
+                      
+            rescaleIntercept    = float(self._DCM[dcmFrameAddress][i]           
+                                    [dcmPrivateCreatorAddress][0]      
+                                    [dcmRescaleInterceptAddress].value)
+            
+            self._tags['rescaleSlopes'].append(rescaleSlope)
+            self._tags['rescaleIntercepts'].append(rescaleIntercept)
 
 
 
@@ -179,10 +348,6 @@ class SELMADicom:
         #
         #
         #
-    
-        
-        self._tags['rescaleSlopes']     = rescaleSlopes
-        self._tags['rescaleIntercepts'] = rescaleIntercepts
 
 
 
@@ -237,23 +402,20 @@ class SELMADicom:
             
             
             
-    def _findFrameTypes(self):
-        """Find the frame types per manufacturer.
+    def _findFrameType(self, i):
+        """Find the frame type of frame i per manufacturer.
         Method differs for each manufacturer."""
         
-        self._tags['frameTypes'] = []
-        
         #Philips
         if 'philips' in self._tags['manufacturer'].lower():
             self._dcmFrameAddress             = 0x5200, 0x9230
             self._dcmPrivateCreatorAddress    = 0x2005, 0x140f
             self._dcmImageTypeAddress         = 0x0008, 0x0008
             
-            for i in range(self._numFrames):
-                frameType = self._DCM[self._dcmFrameAddress][i]                   \
-                                [self._dcmPrivateCreatorAddress][0]               \
-                                [self._dcmImageTypeAddress].value[2]
-                self._tags['frameTypes'].append(frameType)
+            frameType = self._DCM[self._dcmFrameAddress][i]                   \
+                            [self._dcmPrivateCreatorAddress][0]               \
+                            [self._dcmImageTypeAddress].value[2]
+            self._tags['frameTypes'].append(frameType)
             
             
         #Other manufacturers
@@ -314,23 +476,153 @@ class SELMADicom:
             self._tags['targets']['modulus']    = "Modulus"
             
             
+
+
+    def _findSlicePositions(self):
+        """
+        Groups the frames per slice using the positions of the frames that
+        were found by _readFrame. The slices are sorted along the normal of
+        the image plane if the orientation is known, otherwise in the order
+        in which they first appear. Saves the slice index of every frame to the tags.
+        """
+        
+        normal          = None
+        orientation     = self._getImageOrientation()
+        if orientation is not None:
+            normal      = np.cross(orientation[:3], orientation[3:])
+        
+        positions       = []
+        sliceIndices    = []
+        for position in self._framePositions:
+            
+            if position is None:
+                key     = None
+            elif normal is not None:
+                key     = round(float(np.dot(position, normal)), 3)
+            else:
+                key     = tuple(np.round(position, 3))
+            
+            if key not in positions:
+                positions.append(key)
+            sliceIndices.append(positions.index(key))
+        
+        if normal is not None and None not in positions:
+            order           = np.argsort(positions)
+            rank            = np.empty(len(order), dtype = int)
+            rank[order]     = np.arange(len(order))
+            sliceIndices    = [int(rank[idx]) for idx in sliceIndices]
+        
+        self._tags['sliceIndices']  = sliceIndices
+        self._numSlices             = len(positions)
+        
+    def _getFramePosition(self, frame):
+        """Returns the ImagePositionPatient of a frame, or None if it is 
+        not in the header."""
+        
+        try:
+            return np.asarray(self._DCM.PerFrameFunctionalGroupsSequence[
+                frame].PlanePositionSequence[0].ImagePositionPatient,
+                dtype = float)
+        except (AttributeError, IndexError, KeyError):
+            return None
+        
+    def _getImageOrientation(self):
+        """Returns the ImageOrientationPatient of the scan, or None if it is
+        not in the header."""
+        
+        for groups in ('SharedFunctionalGroupsSequence',
+                       'PerFrameFunctionalGroupsSequence'):
+            try:
+                return np.asarray(getattr(self._DCM, groups)[0].
+                                  PlaneOrientationSequence[0].
+                                  ImageOrientationPatient, dtype = float)
+            except (AttributeError, IndexError, KeyError):
+                pass
+        
+        return None
     
     # Apply changes to the frames
     # ------------------------------------------------------------------    
 
-    def _rescaleFrames(self):
-        ''' Applies the rescale slope and intercept to the frames. '''       
+    def _openRawFrames(self, decode = True):
+        """
+        Reads the dicom header without the pixel data and opens the raw
+        frames without decoding them. Uncompressed pixel data is mapped into
+        memory directly from the file, so a frame is only read when it is 
+        indexed. Compressed pixel data is decoded completely.
+        
+        Args:
+            decode(bool): if False, compressed pixel data is not decoded 
+            yet and the raw frames are None until loadFrames is called.
+        """
+        
+        self._DCM, self._rawFrames  = openRawFrames(self._dcmFilename)
+        self._numFrames             = int(self._DCM.NumberOfFrames)
+        
+        if self._rawFrames is None and decode:
+            self._rawFrames = self._decodeRawFrames()
+    
+    def _decodeRawFrames(self):
+        """Reads the dicom file and returns all its frames decoded."""
+        
+        return pydicom.dcmread(self._dcmFilename).pixel_array
+    
+    def _initFrames(self):
+        """Starts the tags of every frame and the rescaled frames empty.
+        They are filled in by _readFrame."""
+        
+        self._tags['rescaleSlopes']     = []
+        self._tags['rescaleIntercepts'] = []
+        self._tags['frameTypes']        = []
+        self._framePositions            = []
+        
+        #Until all frames are read, the scan has no slices or frame types
+        self._numSlices                 = 1
+        self._frameIndices              = dict(velocity  = [],
+                                               magnitude = [],
+                                               modulus   = [],
+                                               phase     = [])
+        
+        if self._streaming:
+            self._rescaledFrames    = LazyFrames(self._getRescaledFrame, [])
+        else:
+            self._rescaledFrames    = []
+    
+    def _readFrame(self, idx):
+        """Finds the tags of the frame at idx and adds the frame with the 
+        rescale values applied to the rescaled frames."""
+        
+        self._findRescaleValues(idx)
+        self._findFrameType(idx)
+        self._framePositions.append(self._getFramePosition(idx))
+        
+        if self._streaming:
+            self._rescaledFrames.addIndex(idx)
+        else:
+            self._rescaledFrames.append(self._getRescaledFrame(idx))
+    
+    def _getRawFrame(self, idx):
+        """Returns the raw frame at idx as an array in memory."""
+        
+        return np.array(self._rawFrames[idx])
+    
+    def _getRescaledFrame(self, idx, rescale = None):
+        """Returns the frame at idx with the rescale values applied.
+        
+        Args:
+            idx(int): index of the frame in the file.
+            rescale(tuple): manual slope and intercept. When None, the 
+            rescale values of the frame in the dicom are used.
+        """
+        
+        if rescale is not None:
+            rescaleSlope, rescaleIntercept  = rescale
+        else:
+            rescaleSlope        = self._tags['rescaleSlopes'][idx]
+            rescaleIntercept    = self._tags['rescaleIntercepts'][idx]
+        
+        return (self._getRawFrame(idx) - rescaleIntercept) / rescaleSlope
 
-        self._rescaledFrames    = []
-        for i in range(len(self._rawFrames)):
-            rescaleSlope        = self._tags['rescaleSlopes'][i]
-            rescaleIntercept    = self._tags['rescaleIntercepts'][i]
-            
-            rawFrame            = self._rawFrames[i]
-            rescaledFrame       = (rawFrame - rescaleIntercept)/rescaleSlope
-            
-            self._rescaledFrames.append(rescaledFrame)
-            
     def _rescaleVelocityFrames(self):
         '''
         Rescales only the velocity frames (if available).
@@ -346,15 +638,24 @@ class SELMADicom:
             return
         
         minVel, maxVel  = self._rescaleVelocity
-        minRaw          = np.min(self._rawVelocityFrames).astype(np.float)
-        maxRaw          = np.max(self._rawVelocityFrames).astype(np.float)
+        minRaw, maxRaw  = getFrameRange(self._rawVelocityFrames)
+        minRaw          = float(minRaw)
+        maxRaw          = float(maxRaw)
         
         deltaVel        = np.abs(minVel - maxVel)
         deltaRaw        = np.abs(minRaw - maxRaw)
         slope           = deltaRaw / deltaVel
         intercept       = deltaRaw / 2 + minRaw
         
-        self._velocityFrames    = (self._rawVelocityFrames - 
+        if self._streaming:
+            #Keep the frames lazy, they are rescaled when they are read.
+            self._velocityFrames    = LazyFrames(
+                functools.partial(self._getRescaledFrame,
+                                  rescale = (slope, intercept)),
+                self._frameIndices['velocity'])
+            return
+        
+        self._velocityFrames    = (np.asarray(self._rawVelocityFrames) - 
                                    intercept) / slope
         
 
@@ -363,15 +664,6 @@ class SELMADicom:
         """Uses the indices found in findFrameTypes to create an array for
         the magnitude, modulus, and velocity frames."""
         
-        self._magnitudeFrames           = []
-        self._rawMagnitudeFrames        = []
-        self._modulusFrames             = []
-        self._rawModulusFrames          = []
-        self._velocityFrames            = []
-        self._rawVelocityFrames         = []
-        self._phaseFrames               = []
-        self._rawPhaseFrames            = []
-        
         frameTypes      = self._tags['frameTypes']
         targets         = self._tags['targets']
         
@@ -405,23 +697,76 @@ class SELMADicom:
                     
                     frameTypes[idx] = targets['velocity']
     
+        #Indices of the frames of every type
+        self._frameIndices              = dict(velocity  = [],
+                                               magnitude = [],
+                                               modulus   = [],
+                                               phase     = [])
+        
         for idx in range(self._numFrames):
                         
             if targets['velocity'] in frameTypes[idx]:
-                self._velocityFrames.append(self._rescaledFrames[idx])
-                self._rawVelocityFrames.append(self._rawFrames[idx])
+                self._frameIndices['velocity'].append(idx)
                 
             elif targets['magnitude'] in frameTypes[idx]:
-                self._magnitudeFrames.append(self._rescaledFrames[idx])
-                self._rawMagnitudeFrames.append(self._rawFrames[idx])
+                self._frameIndices['magnitude'].append(idx)
                 
             elif targets['modulus'] in frameTypes[idx]:
-                self._modulusFrames.append(self._rescaledFrames[idx])
-                self._rawModulusFrames.append(self._rawFrames[idx])
+                self._frameIndices['modulus'].append(idx)
                 
             elif targets['phase'] in frameTypes[idx]:
-                self._phaseFrames.append(self._rescaledFrames[idx])
-                self._rawPhaseFrames.append(self._rawFrames[idx])
+                self._frameIndices['phase'].append(idx)
+        
+        self._collectFrames()
+        
+    def _collectFrames(self):
+        """Creates the magnitude, modulus, velocity and phase frames from
+        the indices found in orderFramesOnType."""
+        
+        self._magnitudeFrames           = []
+        self._rawMagnitudeFrames        = []
+        self._modulusFrames             = []
+        self._rawModulusFrames          = []
+        self._velocityFrames            = []
+        self._rawVelocityFrames         = []
+        self._phaseFrames               = []
+        self._rawPhaseFrames            = []
+        
+        if self._streaming:
+            indices                     = self._frameIndices
+            self._magnitudeFrames       = LazyFrames(self._getRescaledFrame,
+                                                     indices['magnitude'])
+            self._rawMagnitudeFrames    = LazyFrames(self._getRawFrame,
+                                                     indices['magnitude'])
+            self._modulusFrames         = LazyFrames(self._getRescaledFrame,
+                                                     indices['modulus'])
+            self._rawModulusFrames      = LazyFrames(self._getRawFrame,
+                                                     indices['modulus'])
+            self._velocityFrames        = LazyFrames(self._getRescaledFrame,
+                                                     indices['velocity'])
+            self._rawVelocityFrames     = LazyFrames(self._getRawFrame,
+                                                     indices['velocity'])
+            self._phaseFrames           = LazyFrames(self._getRescaledFrame,
+                                                     indices['phase'])
+            self._rawPhaseFrames        = LazyFrames(self._getRawFrame,
+                                                     indices['phase'])
+            return
+        
+        for idx in self._frameIndices['velocity']:
+            self._velocityFrames.append(self._rescaledFrames[idx])
+            self._rawVelocityFrames.append(self._rawFrames[idx])
+            
+        for idx in self._frameIndices['magnitude']:
+            self._magnitudeFrames.append(self._rescaledFrames[idx])
+            self._rawMagnitudeFrames.append(self._rawFrames[idx])
+            
+        for idx in self._frameIndices['modulus']:
+            self._modulusFrames.append(self._rescaledFrames[idx])
+            self._rawModulusFrames.append(self._rawFrames[idx])
+            
+        for idx in self._frameIndices['phase']:
+            self._phaseFrames.append(self._rescaledFrames[idx])
+            self._rawPhaseFrames.append(self._rawFrames[idx])
             
             
         self._magnitudeFrames       = np.asarray(self._magnitudeFrames)
@@ -450,9 +795,11 @@ class SELMADicom:
             
             #Check if the velocity frames aren't accidentally stored as phase
             
-            if np.round(np.max(self._phaseFrames), 1) == venc and \
-               np.round(np.min(self._phaseFrames), 1) == -venc:
-                   return [self._phaseFrames, self._rawPhaseFrames]
+            minPhase, maxPhase  = getFrameRange(self._phaseFrames)
+            if np.round(maxPhase, 1) == venc and \
+               np.round(minPhase, 1) == -venc:
+                   return [np.asarray(self._phaseFrames), 
+                           np.asarray(self._rawPhaseFrames)]
             
             #Else, compute velocity frames from the phaseFrames
             
@@ -461,23 +808,23 @@ class SELMADicom:
             #frames.
             if self._rescaleVelocity is not None:
                 minVel, maxVel  = self._rescaleVelocity
-                minRaw          = np.min(self._rawPhaseFrames).astype(
-                                                                    np.float)
-                maxRaw          = np.max(self._rawPhaseFrames).astype(
-                                                                    np.float)
+                minRaw, maxRaw  = getFrameRange(self._rawPhaseFrames)
+                minRaw          = float(minRaw)
+                maxRaw          = float(maxRaw)
                 
                 deltaVel        = np.abs(minVel - maxVel)
                 deltaRaw        = np.abs(minRaw - maxRaw)
                 slope           = deltaRaw / deltaVel
                 intercept       = deltaRaw / 2 + minRaw
                 
-                velocityFrames  = (self._rawPhaseFrames - intercept) / slope
+                rawPhaseFrames  = np.asarray(self._rawPhaseFrames)
+                velocityFrames  = (rawPhaseFrames - intercept) / slope
 
-                return  [velocityFrames, self._rawPhaseFrames]
+                return  [velocityFrames, rawPhaseFrames]
                 
             else:
-                frames      = self._phaseFrames * venc / np.pi
-                rawFrames   = self._rawPhaseFrames * venc / np.pi
+                frames      = np.asarray(self._phaseFrames) * venc / np.pi
+                rawFrames   = np.asarray(self._rawPhaseFrames) * venc / np.pi
 
                 return [frames, rawFrames]
                 
@@ -492,5 +839,75 @@ class SELMADicom:
         settings            = QtCore.QSettings(COMPANY, APPNAME)
         
         return settings.value('mmVenc') == "true"
+
+
+# ====================================================================
+
+def openRawFrames(dcmFilename):
+    """
+    Reads the header of an enhanced dicom without the pixel data and maps 
+    uncompressed pixel data into memory directly from the file, so a frame,
+    or a part of it, is only read when it is indexed.
+    
+    Args:
+        dcmFilename(str): path to the dicom.
+    
+    Returns:
+        header(pydicom.Dataset): the dicom without the pixel data.
+        frames(numpy.memmap): the raw frames, or None if the pixel data is
+        compressed or can't be mapped and has to be decoded with pydicom.
+    """
+    
+    with open(dcmFilename, 'rb') as dcmFile:
+        header          = pydicom.dcmread(dcmFile, stop_before_pixels = True)
+        #The file is left at the start of the pixel data element
+        pixelDataTell   = dcmFile.tell()
+        elementHeader   = dcmFile.read(12)
+    
+    transferSyntax  = header.file_meta.TransferSyntaxUID
+    bitsAllocated   = int(header.BitsAllocated)
+    signed          = int(header.PixelRepresentation) == 1
+    shape           = (int(header.NumberOfFrames), int(header.Rows), 
+                       int(header.Columns))
+    
+    if transferSyntax.is_implicit_VR:
+        headerLength    = 8
+        length          = elementHeader[4:8]
+    else:
+        headerLength    = 12
+        length          = elementHeader[8:12]
+    
+    if (transferSyntax.is_compressed 
+        or not transferSyntax.is_little_endian
+        or transferSyntax == pydicom.uid.DeflatedExplicitVRLittleEndian
+        or elementHeader[:4] != b'\xe0\x7f\x10\x00'
+        or length == b'\xff\xff\xff\xff'
+        or int(header.SamplesPerPixel) != 1
+        or bitsAllocated not in (8, 16, 32)
+        or (signed and int(header.BitsStored) != bitsAllocated)):
+        
+        return header, None
+    
+    dtype           = np.dtype('<%s%d' % ('i' if signed else 'u', 
+                                          bitsAllocated // 8))
+    frames          = np.memmap(dcmFilename, dtype = dtype, mode = 'r', 
+                                shape = shape, 
+                                offset = pixelDataTell + headerLength)
+    
+    return header, frames
+
+def getFrameRange(frames):
+    """Returns the minimum and maximum of a sequence of frames, reading one
+    frame at a time."""
+    
+    minVal  = None
+    maxVal  = None
+    for frame in frames:
+        frameMin    = np.min(frame)
+        frameMax    = np.max(frame)
+        if minVal is None or frameMin < minVal:
+            minVal  = frameMin
+        if maxVal is None or frameMax > maxVal:
+            maxVal  = frameMax
     
-        
\ No newline at end of file
+    return minVal, maxVal
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+This module contains the following classes:
+
++ :class:`FrameCache`
+
+The FrameCache holds the frames of the displayed series converted to 8-bit
+QImages, so scrolling through the frames doesn't convert the same frame
+again. Neighbouring frames are converted in the background before they are
+shown.
+
+"""
+
+# ====================================================================
+
+import threading
+import numpy as np
+import qimage2ndarray
+
+from PyQt5 import QtCore
+
+# ====================================================================
+
+#Number of frames on either side of the shown frame that are prefetched
+PREFETCH_FRAMES     = 8
+
+#Number of background threads that convert frames
+PREFETCH_THREADS    = 2
+
+_threadPool         = None
+
+def _getThreadPool():
+    """Returns the thread pool shared by all caches."""
+
+    global _threadPool
+    if _threadPool is None:
+        _threadPool = QtCore.QThreadPool()
+        _threadPool.setMaxThreadCount(PREFETCH_THREADS)
+
+    return _threadPool
+
+# ====================================================================
+
+class FrameCache:
+    """
+    Cache of the frames of a single series as 8-bit indexed QImages.
+    The frames are normalised between their minimum and maximum, the same
+    way as qimage2ndarray.array2qimage(frame, normalize = True).
+
+    Frames that are not in the cache yet are converted when they are
+    requested. After every request, the neighbouring frames are converted
+    in a background thread.
+    """
+
+    def __init__(self, frames, prefetch = PREFETCH_FRAMES):
+        """
+        Args:
+            frames(sequence): the frames of the series. Anything that
+            returns a 2D array when indexed, e.g. a list of arrays, a 3D
+            array, or the LazyFrames of a streaming SELMADicom.
+
+            prefetch(int): number of frames on either side of a requested
+            frame that are converted in the background.
+        """
+
+        self._frames    = frames
+        self._prefetch  = prefetch
+        self._images    = dict()
+        self._pending   = set()
+        self._lock      = threading.Lock()
+        self._closed    = False
+
+    def __len__(self):
+        return len(self._frames)
+
+
+    '''Public'''
+
+    def getImage(self, idx):
+        """
+        Returns the frame at idx as an 8-bit |QImage| and starts
+        prefetching its neighbours.
+
+        Args:
+            idx(int): index of the frame.
+
+        Returns:
+            image(QImage): the converted frame.
+        """
+
+        with self._lock:
+            image = self._images.get(idx)
+
+        if image is None:
+            image = self._convert(idx)
+
+        self.prefetch(idx)
+
+        return image
+
+    def getFrame(self, idx):
+        """Returns the original frame at idx."""
+
+        return np.asarray(self._frames[idx])
+
+    def prefetch(self, idx):
+        """Converts the frames around idx in the background. The series
+        wraps around, the same way as scrolling through the frames."""
+
+        numFrames   = len(self)
+        threadPool  = _getThreadPool()
+
+        for offset in range(1, min(self._prefetch, numFrames // 2) + 1):
+            for neighbour in ((idx + offset) % numFrames,
+                              (idx - offset) % numFrames):
+
+                with self._lock:
+                    if (neighbour in self._images or
+                        neighbour in self._pending):
+                        continue
+                    self._pending.add(neighbour)
+
+                threadPool.start(_PrefetchJob(self, neighbour))
+
+    def close(self):
+        """Stops converting frames in the background. Called when another
+        series is shown."""
+
+        self._closed = True
+
+
+    '''Private'''
+
+    def _convert(self, idx):
+        """Converts the frame at idx and stores it in the cache."""
+
+        image   = qimage2ndarray.gray2qimage(self.getFrame(idx),
+                                             normalize = True)
+
+        with self._lock:
+            self._images[idx] = image
+            self._pending.discard(idx)
+
+        return image
+
+# ====================================================================
+
+class _PrefetchJob(QtCore.QRunnable):
+    """Converts a single frame of a FrameCache in the thread pool."""
+
+    def __init__(self, cache, idx):
+        super(_PrefetchJob, self).__init__()
+        self._cache = cache
+        self._idx   = idx
+
+    def run(self):
+        if self._cache._closed:
+            return
+
+        self._cache._convert(self._idx)
@@ -17,6 +17,7 @@ from PyQt5 import (QtCore, QtGui, QtWidgets)
 import SELMAImageViewer
 import SELMAGUISettings
 import SELMAGUIImVar
+import SELMAGUIBatch
 
 # ====================================================================
 
@@ -53,6 +54,11 @@ class SELMAMainWindow(QtWidgets.QMainWindow):
         #Subwindows:
         self.signalObj      = SGMSignals()
         self._imVarWindow    = SELMAGUIImVar.SelmaImVar(self.signalObj)
+        self.batchWindow    = SELMAGUIBatch.SelmaBatchProgress()
+        
+        #Running analyses
+        self._busy          = False
+        self._batchBusy     = False
         
         #filenames
         self._fname         = None
@@ -105,11 +111,26 @@ class SELMAMainWindow(QtWidgets.QMainWindow):
     Emitted when the user triggers the analyseBatchAct.    
     """
     
+    sweepSignal = QtCore.pyqtSignal(str)
+    """ Sweep **Signal**.
+    Emitted when the user triggers the sweepAct.    
+    """
+    
+    cancelAnalysisSignal = QtCore.pyqtSignal()
+    """ Cancel Analysis **Signal**.
+    Emitted when the user triggers the cancelAnalysisAct.    
+    """
+    
     switchViewSignal = QtCore.pyqtSignal()
     """ Switch View **Signal**
     Emitted when the user triggers the switchViewAct
     """
     
+    playSignal = QtCore.pyqtSignal()
+    """ Play **Signal**
+    Emitted when the user triggers the playAct while no frames are played.
+    """
+    
     #Setters
     
     def setMask(self, mask):
@@ -119,6 +140,18 @@ class SELMAMainWindow(QtWidgets.QMainWindow):
     def setPixmap(self, pixmap):
         """Passes along the pixmap to the imageViewer."""
         self._imageViewer.setPixmap(pixmap)
+        
+    def setFrames(self, frames):
+        """Passes along the frames of a new series to the imageViewer."""
+        self._imageViewer.setFrames(frames)
+        
+    def showFrame(self, idx):
+        """Tells the imageViewer to show a frame of the series."""
+        self._imageViewer.showFrame(idx)
+        
+    def clearFrames(self):
+        """Tells the imageViewer to remove the frames of the series."""
+        self._imageViewer.clear()
     
     def setVesselMask(self, mask):
         """Passes along the vessel mask to the imageViewer."""
@@ -127,10 +160,59 @@ class SELMAMainWindow(QtWidgets.QMainWindow):
     def setFrameCounter(self, frameCounter, maxFrames):
         """Passes along the frame count to the imageViewer."""
         self._imageViewer.setFrameCounter(frameCounter, maxFrames)
+        
+    def playFrames(self, indices):
+        """Tells the imageViewer to play the frames."""
+        self._imageViewer.startPlayback(indices)
+        
+    def setBusy(self, busy):
+        """Disables the actions that conflict with a running analysis of 
+        the shown scan."""
+        
+        self._busy  = busy
+        self._updateActions()
+        
+    def setBatchBusy(self, busy):
+        """Disables the actions that conflict with a running batch 
+        analysis. The shown scan can still be viewed and analysed."""
+        
+        self._batchBusy = busy
+        self._updateActions()
+        
+        if not busy:
+            self.batchWindow.finish()
+        
+    def setBatchProgress(self, done, total, scan):
+        """Passes along the progress of a batch analysis to the 
+        batchWindow."""
+        self.batchWindow.setBatchProgress(done, total, scan)
+        
+    def setBatchFailure(self, scan, message):
+        """Passes along a scan of a batch analysis that failed to the 
+        batchWindow."""
+        self.batchWindow.addFailure(scan, message)
     
     '''Private'''
     # ------------------------------------------------------------------
 
+    def _updateActions(self):
+        """Enables the actions that don't conflict with the running
+        analyses. The cancelAnalysisAct is enabled while any analysis is
+        running."""
+
+        for action in (self.openAct, self.openClassicAct, self.openT1Act,
+                       self.loadMaskAct, self.saveMaskAct,
+                       self.segmentMaskAct, self.analyseVesselsAct,
+                       self.imageVariablesAct):
+            action.setEnabled(not self._busy)
+
+        for action in (self.analyseBatchAct, self.sweepAct):
+            action.setEnabled(not self._batchBusy)
+
+        #The batch reads the settings at the start of every scan
+        self.settingsAct.setEnabled(not (self._busy or self._batchBusy))
+        self.cancelAnalysisAct.setEnabled(self._busy or self._batchBusy)
+
     def createActions(self):
         """Create actions for the menus."""
 
@@ -198,6 +280,18 @@ class SELMAMainWindow(QtWidgets.QMainWindow):
             statusTip="Perform vessel analysis on all files in a directory.",
             triggered=self._analyseBatch)
         
+        self.sweepAct =  QtWidgets.QAction(
+            "Parameter &Sweep", self,
+            statusTip="Analyse all files in a directory for every " +
+            "combination of the values in the Sweep tab of the settings.",
+            triggered=self._sweep)
+        
+        self.cancelAnalysisAct =  QtWidgets.QAction(
+            "&Cancel Analysis", self,
+            statusTip="Stop the running analysis.",
+            enabled=False,
+            triggered=self._cancelAnalysis)
+        
         
         #View Actions
         
@@ -207,6 +301,13 @@ class SELMAMainWindow(QtWidgets.QMainWindow):
             shortcut= "Tab",
             triggered=self._switchView)
         
+        self.playAct = QtWidgets.QAction(
+            "&Play / Pause", self,
+            statusTip="Play the velocity or magnitude frames of the shown" +
+            " frame in a loop.",
+            shortcut= "P",
+            triggered=self._togglePlayback)
+        
         #scroll actions
         self.scrollToTopAct = QtWidgets.QAction(
             "&Top", self,
@@ -294,11 +395,14 @@ class SELMAMainWindow(QtWidgets.QMainWindow):
         #Create Analyse Menu
         self.analyseMenu = QtWidgets.QMenu("&Analyse")
         self.analyseMenu.addAction(self.analyseVesselsAct)
-        self.analyseMenu.addAction(self.analyseBatchAct)        
+        self.analyseMenu.addAction(self.analyseBatchAct)
+        self.analyseMenu.addAction(self.sweepAct)
+        self.analyseMenu.addAction(self.cancelAnalysisAct)        
 
         #Create view Menu
         self.viewMenu = QtWidgets.QMenu("&View", self)
         self.viewMenu.addAction(self.switchViewAct)
+        self.viewMenu.addAction(self.playAct)
 
         #Create Scroll Menu
         self.scrollMenu = QtWidgets.QMenu("&Scroll", self)
@@ -358,11 +462,29 @@ class SELMAMainWindow(QtWidgets.QMainWindow):
         """Updates the statusBar with text from elsewhere in the program."""
 #        self._imageViewer.setProgressLabel(text)
         self.statusBar().showMessage(text)
+        
+    def setAnalysisProgress(self, stage, fraction):
+        """Shows the current stage of the analysis in the statusBar and 
+        the part of the analysis that is done in the progressbar."""
+        self.setProgressBar(int(100 * fraction))
+        self.setProgressLabel(stage)
+        
+    def setBatchStage(self, stage, fraction):
+        """Passes along the stage of the analysis of the current scan of a
+        batch analysis to the batchWindow."""
+        self.batchWindow.setStage(stage, fraction)
 
 
     def passOnVars(self, variables):
         self._imVarWindow.listenForVars(variables)
     
+    def storeMaskSlot(self, direction = 0):
+        """Sends the drawn mask to the data models before another frame is
+        shown, so the mask of every slice of a multi-slice scan is kept."""
+        mask = self._imageViewer._scene.getMask()
+        if mask is not None:
+            self.applyMaskSignal.emit(mask)
+    
     #Private slots
     # ------------------------------------------------------------------
     
@@ -489,10 +611,33 @@ class SELMAMainWindow(QtWidgets.QMainWindow):
         if len(dirname) != 0:
             self.analyseBatchSignal.emit(dirname)
             
+    @QtCore.pyqtSlot()
+    def _sweep(self):
+        """Triggered when the parameter sweep action is called."""
+         
+        dirname = QtWidgets.QFileDialog.getExistingDirectory(self,
+                                                      'Open folder',
+                                                      ''
+                                                      )
+        if len(dirname) != 0:
+            self.sweepSignal.emit(dirname)
+            
+    @QtCore.pyqtSlot()
+    def _cancelAnalysis(self):
+        """Triggered when the cancel analysis action is called."""
+        self.cancelAnalysisSignal.emit()
+            
     @QtCore.pyqtSlot()
     def _switchView(self):
         self.switchViewSignal.emit()
         
+    @QtCore.pyqtSlot()
+    def _togglePlayback(self):
+        if self._imageViewer.isPlaying():
+            self._imageViewer.stopPlayback()
+        else:
+            self.playSignal.emit()
+        
     @QtCore.pyqtSlot()
     def _openSettings(self):
         self.settingsWindow.show()
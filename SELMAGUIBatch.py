@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+"""
+This module contains the following classes:
+
++ :class:`SelmaBatchProgress`
+
+"""
+
+# ====================================================================
+
+import time
+from PyQt5 import (QtCore, QtGui, QtWidgets)
+
+# ====================================================================
+
+class SelmaBatchProgress(QtWidgets.QWidget):
+    """
+    This class contains the window that shows the progress of a running
+    batch analysis: the number of scans that are done and remaining, the
+    current scan and the stage of its analysis, the throughput and the
+    estimated time until the batch is finished. Scans whose analysis 
+    failed are listed as well.
+
+    The batch can be paused, or stopped after the current scan.
+    """
+
+    #Signals
+    pauseSignal     = QtCore.pyqtSignal(bool)
+    """Emitted with True when the batch should pause, False to resume."""
+
+    stopSignal      = QtCore.pyqtSignal()
+    """Emitted when the batch should stop after the current scan."""
+
+
+    def __init__(self):
+        QtWidgets.QWidget.__init__(self)
+
+        self._startTime     = None
+        self._pauseTime     = None
+        self._pausedTime    = 0
+        self._done          = 0
+        self._total         = 0
+        self._failures      = []
+        self._running       = False
+
+        #Create window
+        self._initGui()
+
+    def _initGui(self):
+        self.setGeometry(QtCore.QRect(100, 100, 400, 200))
+        self.setWindowTitle("Batch Analysis")
+        self.setWindowIcon(QtGui.QIcon("icon.png"))
+
+        #Layout of the progress
+        self.scanLabel          = QtWidgets.QLabel()
+        self.stageLabel         = QtWidgets.QLabel()
+        self.stageBar           = QtWidgets.QProgressBar()
+        self.batchBar           = QtWidgets.QProgressBar()
+        self.countLabel         = QtWidgets.QLabel()
+        self.throughputLabel    = QtWidgets.QLabel()
+        self.etaLabel           = QtWidgets.QLabel()
+        self.failedLabel        = QtWidgets.QLabel()
+        self.failedLabel.setWordWrap(True)
+
+        self.progressLayout     = QtWidgets.QGridLayout()
+        self.progressLayout.addWidget(self.scanLabel,       0, 0, 1, 2)
+        self.progressLayout.addWidget(self.stageLabel,      1, 0, 1, 2)
+        self.progressLayout.addWidget(self.stageBar,        2, 0, 1, 2)
+        self.progressLayout.addWidget(self.batchBar,        3, 0, 1, 2)
+        self.progressLayout.addWidget(self.countLabel,      4, 0, 1, 2)
+        self.progressLayout.addWidget(self.throughputLabel, 5, 0)
+        self.progressLayout.addWidget(self.etaLabel,        5, 1)
+        self.progressLayout.addWidget(self.failedLabel,     6, 0, 1, 2)
+
+        #Layout of the buttons
+        self.pauseButton        = QtWidgets.QPushButton("Pause")
+        self.stopButton         = QtWidgets.QPushButton("Stop")
+        self.closeButton        = QtWidgets.QPushButton("Close")
+        self.pauseButton.setCheckable(True)
+        self.pauseButton.setToolTip(
+            "Pause the batch after the current scan.")
+        self.stopButton.setToolTip(
+            "Stop the batch after the current scan.")
+        self.pauseButton.toggled.connect(self._pauseButtonToggled)
+        self.stopButton.pressed.connect(self._stopButtonPressed)
+        self.closeButton.pressed.connect(self.close)
+
+        self.buttonLayout       = QtWidgets.QHBoxLayout()
+        self.buttonLayout.addWidget(self.pauseButton)
+        self.buttonLayout.addWidget(self.stopButton)
+        self.buttonLayout.addWidget(self.closeButton)
+
+        self.layout             = QtWidgets.QVBoxLayout()
+        self.layout.addLayout(self.progressLayout)
+        self.layout.addLayout(self.buttonLayout)
+        self.setLayout(self.layout)
+
+
+    '''Public'''
+
+    def setBatchProgress(self, done, total, scan):
+        """
+        Updates the window when a scan of the batch starts, or when the
+        batch has finished. The window is shown at the start of a batch.
+
+        Args:
+            done(int): number of scans that are done.
+            total(int): number of scans in the batch.
+            scan(str): name of the current scan, empty when the batch has
+            finished.
+        """
+
+        if not self._running:
+            self._start()
+
+        self._done  = done
+        self._total = total
+
+        if scan:
+            self.scanLabel.setText("Scan %.0f out of %.0f: %s"
+                                   %(done + 1, total, scan))
+        else:
+            self.scanLabel.setText("Finished %.0f out of %.0f scans"
+                                   %(done, total))
+            self.stageLabel.setText("")
+
+        self.batchBar.setValue(int(100 * done / max(total, 1)))
+        self.countLabel.setText("Done: %.0f, remaining: %.0f"
+                                %(done, total - done))
+        self._updateTiming()
+
+    def setStage(self, stage, fraction):
+        """Shows the stage of the analysis of the current scan."""
+
+        if not self._running:
+            return
+
+        self.stageLabel.setText(stage)
+        self.stageBar.setValue(int(100 * fraction))
+
+    def addFailure(self, scan, message):
+        """
+        Lists a scan whose analysis stopped because of an error. The batch
+        continues with the next scan.
+        
+        Args:
+            scan(str): name of the scan.
+            message(str): the error.
+        """
+        
+        self._failures.append("%s: %s" %(scan, message))
+        self.failedLabel.setText("Failed: %.0f\n" %(len(self._failures)) +
+                                 "\n".join(self._failures))
+
+    def finish(self):
+        """Called when the batch has stopped."""
+
+        self._running = False
+        self.pauseButton.setEnabled(False)
+        self.stopButton.setEnabled(False)
+        self.closeButton.setEnabled(True)
+        self.etaLabel.setText("")
+
+
+    '''Private'''
+
+    def _start(self):
+        """Resets the window for a new batch and shows it."""
+
+        #A new batch is not paused
+        self.pauseButton.setChecked(False)
+
+        self._startTime     = time.monotonic()
+        self._pauseTime     = None
+        self._pausedTime    = 0
+        self._done          = 0
+        self._failures      = []
+        self._running       = True
+
+        self.pauseButton.setEnabled(True)
+        self.stopButton.setEnabled(True)
+        self.closeButton.setEnabled(False)
+        self.stageLabel.setText("")
+        self.stageBar.setValue(0)
+        self.throughputLabel.setText("")
+        self.etaLabel.setText("")
+        self.failedLabel.setText("")
+
+        self.show()
+        self.raise_()
+
+    def _updateTiming(self):
+        """Shows the number of scans per minute and the estimated time
+        until the batch is done. Time spent paused is not counted."""
+
+        if self._done == 0:
+            return
+
+        elapsed     = time.monotonic() - self._startTime - self._pausedTime
+        throughput  = self._done / max(elapsed, 1e-6)
+        remaining   = (self._total - self._done) / throughput
+
+        self.throughputLabel.setText("%.2f scans / min" %(60 * throughput))
+        if self._done < self._total:
+            self.etaLabel.setText("Time remaining: " +
+                                  time.strftime("%H:%M:%S",
+                                                time.gmtime(remaining)))
+
+    def _pauseButtonToggled(self, paused):
+
+        if paused:
+            self._pauseTime     = time.monotonic()
+            self.pauseButton.setText("Resume")
+        else:
+            if self._pauseTime is not None:
+                self._pausedTime   += time.monotonic() - self._pauseTime
+            self._pauseTime     = None
+            self.pauseButton.setText("Pause")
+
+        self.pauseSignal.emit(paused)
+
+    def _stopButtonPressed(self):
+
+        self.stopButton.setEnabled(False)
+        self.pauseButton.setEnabled(False)
+        self.stageLabel.setText("Stopping after the current scan")
+        self.stopSignal.emit()
@@ -40,10 +40,22 @@ class SelmaGUIModel:
         """Passes the pixmap to the mainWin."""
         self.mainWin.setPixmap(frame)
         
+    def setFramesSlot(self, frames):
+        """Passes the frames of a new series to the mainWin."""
+        self.mainWin.setFrames(frames)
+        
+    def showFrameSlot(self, idx):
+        """Passes the index of the frame to show to the mainWin."""
+        self.mainWin.showFrame(idx)
+        
     def setFrameCounterSlot(self, frameCounter, maxFrames):
         """Passes the frame count to the mainWin."""
         self.mainWin.setFrameCounter(frameCounter, maxFrames)
     
+    def playFramesSlot(self, indices):
+        """Passes the frames to play to the mainWin."""
+        self.mainWin.playFrames(indices)
+    
     def setMaskSlot(self, mask):
         """Passes the mask to the mainWin."""
         self.mainWin.setMask(mask)
@@ -63,6 +75,34 @@ class SelmaGUIModel:
     def setProgressLabelSlot(self, text):
         """Passes the progress message to mainwin"""
         self.mainWin.setProgressLabel(text)
+        
+    def setAnalysisProgressSlot(self, stage, fraction):
+        """Passes the stage and progress of the analysis to mainwin"""
+        self.mainWin.setAnalysisProgress(stage, fraction)
+        
+    def clearFramesSlot(self):
+        """Tells mainwin to remove the shown series"""
+        self.mainWin.clearFrames()
+        
+    def setBusySlot(self, busy):
+        """Tells mainwin whether an analysis is running"""
+        self.mainWin.setBusy(busy)
+        
+    def setBatchBusySlot(self, busy):
+        """Tells mainwin whether a batch analysis is running"""
+        self.mainWin.setBatchBusy(busy)
+        
+    def setBatchStageSlot(self, stage, fraction):
+        """Passes the stage of the current scan of a batch to mainwin"""
+        self.mainWin.setBatchStage(stage, fraction)
+        
+    def setBatchProgressSlot(self, done, total, scan):
+        """Passes the progress of a batch analysis to mainwin"""
+        self.mainWin.setBatchProgress(done, total, scan)
+        
+    def batchFailedSlot(self, scan, message):
+        """Passes a scan of a batch analysis that failed to mainwin"""
+        self.mainWin.setBatchFailure(scan, message)
     
     #Getter functions
     # ------------------------------------------------------------------    
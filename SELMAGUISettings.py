@@ -12,6 +12,8 @@ This module contains the following classes:
 from PyQt5 import (QtCore, QtGui, QtWidgets)
 import os
 
+import SELMAT1Cache
+
 # ====================================================================
 class QHLine(QtWidgets.QFrame):
     def __init__(self):
@@ -73,6 +75,7 @@ class SelmaSettings(QtWidgets.QWidget):
         self.nonPerpTab     = QtWidgets.QWidget()
         self.deduplicateTab = QtWidgets.QWidget()
         self.segmentTab     = QtWidgets.QWidget()
+        self.sweepTab       = QtWidgets.QWidget()
         self.clusteringTab  = QtWidgets.QWidget()
         self.resetTab       = QtWidgets.QWidget()
         
@@ -82,6 +85,7 @@ class SelmaSettings(QtWidgets.QWidget):
         self.tabs.addTab(self.nonPerpTab,       "Non-Perp")
         self.tabs.addTab(self.deduplicateTab,   "Deduplicate")
         self.tabs.addTab(self.segmentTab,       "Segment")
+        self.tabs.addTab(self.sweepTab,         "Sweep")
         #self.tabs.addTab(self.clusteringTab,    "Advanced Clustering")
         self.tabs.addTab(self.resetTab,         "Reset")
         
@@ -92,6 +96,7 @@ class SelmaSettings(QtWidgets.QWidget):
         self.initNonPerpTab()
         self.initDeduplicateTab()
         self.initSegmentTab()
+        self.initSweepTab()
         # self.initClusteringTab()
         self.initResetTab()
         
@@ -138,6 +143,18 @@ class SelmaSettings(QtWidgets.QWidget):
         self.mainTab.ignoreOuterBandBox         = QtWidgets.QCheckBox()
         self.mainTab.decimalCommaBox            = QtWidgets.QCheckBox()
         self.mainTab.mmPixelBox                 = QtWidgets.QCheckBox()
+        self.mainTab.outputFormatBox            = QtWidgets.QComboBox()
+        self.mainTab.outputFormatBox.addItem("Text (.txt)",     "txt")
+        self.mainTab.outputFormatBox.addItem("NumPy (.npz)",    "npz")
+        self.mainTab.outputFormatBox.addItem("HDF5 (.h5)",      "h5")
+        self.mainTab.outputFormatBox.addItem("Parquet (.parquet)", 
+                                             "parquet")
+        self.mainTab.catalogueFileEdit          = QtWidgets.QLineEdit()
+        self.mainTab.streamingModeBox           = QtWidgets.QCheckBox()
+        self.mainTab.playbackFpsEdit            = QtWidgets.QLineEdit()
+        self.mainTab.convergedSTDBox            = QtWidgets.QCheckBox()
+        self.mainTab.bootstrapBox               = QtWidgets.QCheckBox()
+        self.mainTab.bootstrapReplicatesEdit    = QtWidgets.QLineEdit()
         
         self.mainTab.label1     = QtWidgets.QLabel("Median filter diameter")
         self.mainTab.label2     = QtWidgets.QLabel("Confindence interval")
@@ -146,9 +163,23 @@ class SelmaSettings(QtWidgets.QWidget):
         self.mainTab.label5     = QtWidgets.QLabel(
             "Use Gaussian smoothing\ninstead of median filter")
         self.mainTab.label6     = QtWidgets.QLabel(
-            "Ignore the outer 80 pixels\nof the image.")
+            "Ignore a band along the\nedge of the brain.")
         self.mainTab.label7     = QtWidgets.QLabel(
             "Use a decimal comma in the\noutput instead of a dot.")
+        self.mainTab.label8     = QtWidgets.QLabel(
+            "Output format of the\nvessel data.")
+        self.mainTab.label9     = QtWidgets.QLabel(
+            "Results catalogue (.sqlite)")
+        self.mainTab.label10    = QtWidgets.QLabel(
+            "Streaming analysis\n(low memory use)")
+        self.mainTab.label11    = QtWidgets.QLabel(
+            "Playback frame rate (fps)")
+        self.mainTab.label12    = QtWidgets.QLabel(
+            "Estimate the noise from the\nconverged standard deviation")
+        self.mainTab.label13    = QtWidgets.QLabel(
+            "Bootstrap confidence intervals\nof Vmean and PI_norm")
+        self.mainTab.label14    = QtWidgets.QLabel(
+            "Number of bootstrap replicates")
         
         self.mainTab.label1.setToolTip(
             "Diameter of the kernel used in the median filtering operations.")
@@ -168,6 +199,30 @@ class SelmaSettings(QtWidgets.QWidget):
             "\nUse only for testing.")
         self.mainTab.label6.setToolTip(
             "Removes the outer 80 pixels at each edge from the mask. ")
+        self.mainTab.label8.setToolTip(
+            "File format of the -Vessel_Data output. The binary formats " +
+            "(.npz, .h5, .parquet) \ncan be loaded without parsing text. " +
+            "The decimal comma only applies to text.")
+        self.mainTab.label9.setToolTip(
+            "Path to a SQLite catalogue. Every analysed scan and its " +
+            "vessels are added to it. \nLeave empty to disable.")
+        self.mainTab.label10.setToolTip(
+            "Reads the frames one at a time during the analysis instead " +
+            "of keeping all frames in memory. \nUse for long or multi-slice" +
+            " scans. Applies to scans loaded after changing the setting.")
+        self.mainTab.label11.setToolTip(
+            "Number of frames per second shown when playing the frames " +
+            "(View > Play / Pause).")
+        self.mainTab.label12.setToolTip(
+            "Scales the velocity with a single noise level, estimated " +
+            "from the mean velocity in the mask \nwith iterative " +
+            "outlier removal, instead of with the SNR of every voxel.")
+        self.mainTab.label13.setToolTip(
+            "Adds the 95% confidence intervals of Vmean and PI_norm to " +
+            "the output, \nfound by resampling the included vessels.")
+        self.mainTab.label14.setToolTip(
+            "Number of times the vessels are resampled for the " +
+            "confidence intervals. \nDefault is 10000.")
 
         #Add items to layout
         self.mainTab.layout     = QtWidgets.QGridLayout()
@@ -185,6 +240,20 @@ class SelmaSettings(QtWidgets.QWidget):
                                       6,0)
         self.mainTab.layout.addWidget(self.mainTab.decimalCommaBox,
                                       7,0)
+        self.mainTab.layout.addWidget(self.mainTab.outputFormatBox,
+                                      8,0)
+        self.mainTab.layout.addWidget(self.mainTab.catalogueFileEdit,
+                                      9,0)
+        self.mainTab.layout.addWidget(self.mainTab.streamingModeBox,
+                                      10,0)
+        self.mainTab.layout.addWidget(self.mainTab.playbackFpsEdit,
+                                      11,0)
+        self.mainTab.layout.addWidget(self.mainTab.convergedSTDBox,
+                                      12,0)
+        self.mainTab.layout.addWidget(self.mainTab.bootstrapBox,
+                                      13,0)
+        self.mainTab.layout.addWidget(self.mainTab.bootstrapReplicatesEdit,
+                                      14,0)
         
         #Add labels to layout
         self.mainTab.layout.addWidget(self.mainTab.label1,      0,1)
@@ -194,6 +263,13 @@ class SelmaSettings(QtWidgets.QWidget):
         self.mainTab.layout.addWidget(self.mainTab.label5,      5,3)
         self.mainTab.layout.addWidget(self.mainTab.label6,      6,3)
         self.mainTab.layout.addWidget(self.mainTab.label7,      7,3)
+        self.mainTab.layout.addWidget(self.mainTab.label8,      8,3)
+        self.mainTab.layout.addWidget(self.mainTab.label9,      9,3)
+        self.mainTab.layout.addWidget(self.mainTab.label10,     10,3)
+        self.mainTab.layout.addWidget(self.mainTab.label11,     11,3)
+        self.mainTab.layout.addWidget(self.mainTab.label12,     12,3)
+        self.mainTab.layout.addWidget(self.mainTab.label13,     13,3)
+        self.mainTab.layout.addWidget(self.mainTab.label14,     14,3)
         
         self.mainTab.setLayout(self.mainTab.layout)
         
@@ -439,20 +515,98 @@ class SelmaSettings(QtWidgets.QWidget):
     def initSegmentTab(self):
         
         self.segmentTab.whiteMatterProb            = QtWidgets.QLineEdit()
+        self.segmentTab.backendBox                 = QtWidgets.QComboBox()
+        self.segmentTab.backendBox.addItem("Built-in (SimpleITK)",  "sitk")
+        self.segmentTab.backendBox.addItem("SPM12 (MATLAB)",        "spm")
+        self.segmentTab.backendBox.setToolTip(
+            "The built-in segmentation runs in SELMA itself. The SPM12 " +
+            "segmentation needs MATLAB with its Python engine, SPM12 " +
+            "and dcm2nii.")
         
         self.segmentTab.label1     = QtWidgets.QLabel(
             "White matter probability")
+        self.segmentTab.label2     = QtWidgets.QLabel(
+            "Segmentation method")
+        
+        self.segmentTab.slabBox                    = QtWidgets.QCheckBox()
+        self.segmentTab.slabMarginEdit             = QtWidgets.QLineEdit()
+        self.segmentTab.label3     = QtWidgets.QLabel(
+            "Only process the T1 around the scan plane")
+        self.segmentTab.label4     = QtWidgets.QLabel(
+            "Margin around the scan plane (mm)")
+        self.segmentTab.label3.setToolTip(
+            "When toggled on, only the part of the T1 that is needed for " +
+            "the plane of the scan, plus the margin, is read and " +
+            "segmented with the built-in segmentation.")
+        self.segmentTab.clearCacheButton    = QtWidgets.QPushButton(
+            "Clear T1 cache")
+        self.segmentTab.clearCacheButton.setToolTip(
+            "Removes the cached T1 slices and segmentations from the disk.")
+        self.segmentTab.clearCacheButton.pressed.connect(
+            self.clearT1Cache)
 
         #Add items to layout
         self.segmentTab.layout     = QtWidgets.QGridLayout()
         self.segmentTab.layout.addWidget(
             self.segmentTab.whiteMatterProb, 0,0)
+        self.segmentTab.layout.addWidget(
+            self.segmentTab.backendBox, 1,0)
+        self.segmentTab.layout.addWidget(
+            self.segmentTab.slabBox, 2,0)
+        self.segmentTab.layout.addWidget(
+            self.segmentTab.slabMarginEdit, 3,0)
         
         #Add labels to layout
         self.segmentTab.layout.addWidget(self.segmentTab.label1,      0,1)
+        self.segmentTab.layout.addWidget(self.segmentTab.label2,      1,1)
+        self.segmentTab.layout.addWidget(self.segmentTab.label3,      2,1)
+        self.segmentTab.layout.addWidget(self.segmentTab.label4,      3,1)
+        
+        self.segmentTab.layout.addWidget(
+            self.segmentTab.clearCacheButton, 4,0)
         
         self.segmentTab.setLayout(self.segmentTab.layout)
         
+    def initSweepTab(self):
+        """The tab containing the values of the parameter sweep."""
+        
+        self.sweepTab.medDiamEdit           = QtWidgets.QLineEdit()
+        self.sweepTab.confidenceInterEdit   = QtWidgets.QLineEdit()
+        self.sweepTab.ratioThreshEdit       = QtWidgets.QLineEdit()
+        self.sweepTab.deduplicateRangeEdit  = QtWidgets.QLineEdit()
+        
+        self.sweepTab.label0    = QtWidgets.QLabel(
+            "Values separated by commas, e.g. 9, 11, 13.\n" +
+            "Leave empty to use the setting of the other tabs.")
+        self.sweepTab.label1    = QtWidgets.QLabel("Median filter diameter")
+        self.sweepTab.label2    = QtWidgets.QLabel("Confidence interval")
+        self.sweepTab.label3    = QtWidgets.QLabel("Ratio threshold")
+        self.sweepTab.label4    = QtWidgets.QLabel("Deduplication range")
+        
+        self.sweepTab.label0.setToolTip(
+            "Analyse > Parameter Sweep analyses every scan in a folder " +
+            "for every combination of these values. \nThe results are " +
+            "written to sweepResults.csv in the folder.")
+        
+        #Add items to layout
+        self.sweepTab.layout    = QtWidgets.QGridLayout()
+        self.sweepTab.layout.addWidget(self.sweepTab.label0,        0,0,1,2)
+        self.sweepTab.layout.addWidget(QHLine(),                    1,0,1,2)
+        self.sweepTab.layout.addWidget(self.sweepTab.medDiamEdit,   2,0)
+        self.sweepTab.layout.addWidget(self.sweepTab.confidenceInterEdit,
+                                       3,0)
+        self.sweepTab.layout.addWidget(self.sweepTab.ratioThreshEdit, 4,0)
+        self.sweepTab.layout.addWidget(self.sweepTab.deduplicateRangeEdit,
+                                       5,0)
+        
+        #Add labels to layout
+        self.sweepTab.layout.addWidget(self.sweepTab.label1,        2,1)
+        self.sweepTab.layout.addWidget(self.sweepTab.label2,        3,1)
+        self.sweepTab.layout.addWidget(self.sweepTab.label3,        4,1)
+        self.sweepTab.layout.addWidget(self.sweepTab.label4,        5,1)
+        
+        self.sweepTab.setLayout(self.sweepTab.layout)
+        
     # def initClusteringTab(self):
     #     """The tab containing the cluster settings.        """
         
@@ -602,6 +756,56 @@ class SelmaSettings(QtWidgets.QWidget):
             decimalComma     = decimalComma == 'true'
         self.mainTab.decimalCommaBox.setChecked(decimalComma)
         
+        #Output format of the vessel data
+        outputFormat         = settings.value("outputFormat")
+        index                = self.mainTab.outputFormatBox.findData(
+                                                            outputFormat)
+        if index == -1:
+            index = 0
+        self.mainTab.outputFormatBox.setCurrentIndex(index)
+        
+        #Results catalogue
+        catalogueFile        = settings.value("catalogueFile")
+        if catalogueFile is None:
+            catalogueFile    = ""
+        self.mainTab.catalogueFileEdit.setText(catalogueFile)
+        
+        #Streaming analysis - default is False
+        streamingMode        = settings.value("streamingMode")
+        if streamingMode is None:
+            streamingMode    = False
+        else:
+            streamingMode    = streamingMode == 'true'
+        self.mainTab.streamingModeBox.setChecked(streamingMode)
+        
+        #Playback frame rate
+        playbackFps          = settings.value("playbackFps")
+        if playbackFps is None:
+            playbackFps      = 20
+        self.mainTab.playbackFpsEdit.setText(str(playbackFps))
+        
+        #Converged standard deviation - default is False
+        convergedSTD         = settings.value("convergedSTD")
+        if convergedSTD is None:
+            convergedSTD     = False
+        else:
+            convergedSTD     = convergedSTD == 'true'
+        self.mainTab.convergedSTDBox.setChecked(convergedSTD)
+        
+        #Bootstrap confidence intervals - default is False
+        bootstrap            = settings.value("bootstrap")
+        if bootstrap is None:
+            bootstrap        = False
+        else:
+            bootstrap        = bootstrap == 'true'
+        self.mainTab.bootstrapBox.setChecked(bootstrap)
+        
+        bootstrapReplicates  = settings.value("bootstrapReplicates")
+        if bootstrapReplicates is None:
+            bootstrapReplicates = 10000
+        self.mainTab.bootstrapReplicatesEdit.setText(
+                                                str(bootstrapReplicates))
+        
         
         #Structure settings
         #=============================================
@@ -767,6 +971,44 @@ class SelmaSettings(QtWidgets.QWidget):
             whiteMatterProb = 0.5
         self.segmentTab.whiteMatterProb.setText(str(whiteMatterProb))
         
+        #Segmentation method
+        segmentationBackend = settings.value("segmentationBackend")
+        index               = self.segmentTab.backendBox.findData(
+                                                    segmentationBackend)
+        if index == -1:
+            index = 0
+        self.segmentTab.backendBox.setCurrentIndex(index)
+        
+        #Slab of the T1
+        t1SlabMode          = settings.value("t1SlabMode")
+        if t1SlabMode is None:
+            t1SlabMode      = False
+        else:
+            t1SlabMode      = t1SlabMode == 'true'
+        self.segmentTab.slabBox.setChecked(t1SlabMode)
+        
+        t1SlabMargin        = settings.value("t1SlabMargin")
+        if t1SlabMargin is None:
+            t1SlabMargin    = 10
+        self.segmentTab.slabMarginEdit.setText(str(t1SlabMargin))
+        
+        
+        #Sweep settings
+        #=============================================
+        
+        #Values of the swept settings - default is no sweep
+        for key, edit in (("sweepMedDiam", self.sweepTab.medDiamEdit),
+                          ("sweepConfidenceInter", 
+                           self.sweepTab.confidenceInterEdit),
+                          ("sweepRatioThresh", 
+                           self.sweepTab.ratioThreshEdit),
+                          ("sweepDeduplicateRange", 
+                           self.sweepTab.deduplicateRangeEdit)):
+            values  = settings.value(key)
+            if values is None:
+                values  = ""
+            edit.setText(str(values))
+        
         
         #Clustering settings
         #=============================================
@@ -885,6 +1127,49 @@ class SelmaSettings(QtWidgets.QWidget):
         gaussianSmoothing   = self.mainTab.gaussianSmoothingBox.isChecked()
         ignoreOuterBand     = self.mainTab.ignoreOuterBandBox.isChecked()
         decimalComma        = self.mainTab.decimalCommaBox.isChecked()
+        outputFormat        = self.mainTab.outputFormatBox.currentData()
+        streamingMode       = self.mainTab.streamingModeBox.isChecked()
+        
+        #Results catalogue
+        catalogueFile       = self.mainTab.catalogueFileEdit.text().strip()
+        if catalogueFile and not os.path.isdir(
+                os.path.dirname(os.path.abspath(catalogueFile))):
+            self.errorLabel.setText(
+                    "The folder of the results catalogue does not exist.")
+            return
+        
+        #Playback frame rate
+        playbackFps         = self.mainTab.playbackFpsEdit.text()
+        try: 
+            playbackFps     = float(playbackFps)
+        except:
+            self.errorLabel.setText(
+                    "Playback frame rate has to be a number.")
+            return
+        
+        if playbackFps <= 0:
+            self.errorLabel.setText(
+                    "Playback frame rate has to be larger than 0.")
+            return
+        
+        #Converged standard deviation
+        convergedSTD        = self.mainTab.convergedSTDBox.isChecked()
+        
+        #Bootstrap confidence intervals
+        bootstrap           = self.mainTab.bootstrapBox.isChecked()
+        
+        bootstrapReplicates = self.mainTab.bootstrapReplicatesEdit.text()
+        try: 
+            bootstrapReplicates = int(bootstrapReplicates)
+        except:
+            self.errorLabel.setText(
+                    "Number of bootstrap replicates has to be an integer.")
+            return
+        
+        if bootstrapReplicates <= 0:
+            self.errorLabel.setText(
+                    "Number of bootstrap replicates has to be larger than 0.")
+            return
         
         #=========================================
         #=========================================
@@ -1136,6 +1421,78 @@ class SelmaSettings(QtWidgets.QWidget):
                     "White matter probability has to be between 0 and 1.")
             return 
         
+        segmentationBackend = self.segmentTab.backendBox.currentData()
+        
+        #Slab
+        t1SlabMode      = self.segmentTab.slabBox.isChecked()
+        t1SlabMargin    = self.segmentTab.slabMarginEdit.text()
+        try: 
+            t1SlabMargin = float(t1SlabMargin)
+        except:
+            self.errorLabel.setText(
+                "Margin around the scan plane has to be a number.")
+            return
+        
+        if t1SlabMargin < 0:
+            self.errorLabel.setText(
+                "Margin around the scan plane has to be >= 0.")
+            return
+        
+        
+        #=========================================
+        #=========================================
+        #           Sweep settings
+        #=========================================
+        #=========================================
+        
+        sweepValues = dict()
+        for key, name, edit in (
+                ("sweepMedDiam", "median filter diameter", 
+                 self.sweepTab.medDiamEdit),
+                ("sweepConfidenceInter", "confidence interval",
+                 self.sweepTab.confidenceInterEdit),
+                ("sweepRatioThresh", "ratio threshold",
+                 self.sweepTab.ratioThreshEdit),
+                ("sweepDeduplicateRange", "deduplication range",
+                 self.sweepTab.deduplicateRangeEdit)):
+            text    = edit.text().strip()
+            try:
+                values  = [float(value) for value in text.split(',') 
+                           if value.strip()]
+            except:
+                self.errorLabel.setText(
+                    "The sweep values of the %s have to be numbers " %(name) +
+                    "separated by commas.")
+                return
+            sweepValues[key]    = text
+            
+            #The same rules as for the settings themselves
+            for value in values:
+                if key == "sweepMedDiam":
+                    if value != int(value):
+                        self.errorLabel.setText(
+                            "The sweep values of the median filter " +
+                            "diameter have to be integers.")
+                        return
+                    if int(value) %2 == 0 and not mmPixel:
+                        self.errorLabel.setText(
+                            "The sweep values of the median filter " +
+                            "diameter have to be odd numbers of pixels.")
+                        return
+                    
+                elif key == "sweepConfidenceInter":
+                    if value <= 0 or value >= 1:
+                        self.errorLabel.setText(
+                            "The sweep values of the confidence interval " +
+                            "have to be between 0 and 1.")
+                        return
+                    
+                elif value < 0:
+                    self.errorLabel.setText(
+                        "The sweep values of the %s have to be " %(name) +
+                        "> 0.")
+                    return
+        
         
         #=========================================
         #=========================================
@@ -1166,6 +1523,13 @@ class SelmaSettings(QtWidgets.QWidget):
         settings.setValue('gaussianSmoothing',      gaussianSmoothing)
         settings.setValue('ignoreOuterBand',        ignoreOuterBand)
         settings.setValue('decimalComma',           decimalComma)
+        settings.setValue('outputFormat',           outputFormat)
+        settings.setValue('catalogueFile',          catalogueFile)
+        settings.setValue('streamingMode',          streamingMode)
+        settings.setValue('playbackFps',            playbackFps)
+        settings.setValue('convergedSTD',           convergedSTD)
+        settings.setValue('bootstrap',              bootstrap)
+        settings.setValue('bootstrapReplicates',    bootstrapReplicates)
         
         #Structure selection
         # settings.setValue('BasalGanglia',           BasalGanglia)
@@ -1199,6 +1563,13 @@ class SelmaSettings(QtWidgets.QWidget):
         
         #Segmentation
         settings.setValue('whiteMatterProb',        whiteMatterProb)
+        settings.setValue('segmentationBackend',    segmentationBackend)
+        settings.setValue('t1SlabMode',             t1SlabMode)
+        settings.setValue('t1SlabMargin',           t1SlabMargin)
+        
+        #Sweep
+        for key, text in sweepValues.items():
+            settings.setValue(key,                  text)
         
         #Clustering
         # settings.setValue('PositiveMagnitude',      PositiveMagnitude)
@@ -1211,6 +1582,11 @@ class SelmaSettings(QtWidgets.QWidget):
         self.thresholdSignal.emit()
         
         
+    def clearT1Cache(self):
+        """Removes the cached results of the T1 processing."""
+        
+        SELMAT1Cache.clear()
+        
     def reset(self):
         """Removes all settings from the UI, and saves it to the application,
         prompting the values to reset to their defaults.
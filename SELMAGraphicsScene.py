@@ -15,7 +15,7 @@ This module contains the following classes:
 
 
 import numpy as np
-import qimage2ndarray
+import cv2
 
 from PyQt5 import (QtCore, QtGui, QtWidgets)
 
@@ -61,6 +61,15 @@ class GraphicsScene(QtWidgets.QGraphicsScene):
         #Keeps track if the scene is active
         self._active        = False
         
+        #Mouse events are collected and sent at most once per refresh of
+        #the display.
+        self._hoverPos          = None
+        self._contrastChanged   = False
+        self._updateTimer       = QtCore.QTimer(self)
+        self._updateTimer.setSingleShot(True)
+        self._updateTimer.setInterval(_getRefreshInterval())
+        self._updateTimer.timeout.connect(self._sendUpdates)
+        
         self._initUI(pixmapItem)
     
     def _initUI(self, pixmapItem):
@@ -78,6 +87,10 @@ class GraphicsScene(QtWidgets.QGraphicsScene):
         self._button                = None  
         self._mask                  = None
         
+        #uint8 buffers wrapped by the overlay images
+        self._maskBuffer            = None
+        self._vesselBuffer          = None
+        
         self._maskBrush     = QtGui.QBrush(QtGui.QColor("#AA0000FF"))
         self._addBrush      = QtGui.QBrush(QtGui.QColor("#6000FF00"))
         self._subtractBrush = QtGui.QBrush(QtGui.QColor("#80FF0000"))
@@ -102,6 +115,10 @@ class GraphicsScene(QtWidgets.QGraphicsScene):
     def getMask(self):
         return self._mask
     
+    def getContrast(self):
+        """Returns the current contrast and brightness."""
+        return self._contrast, self._brightness
+    
     
     #Setters:
     
@@ -113,26 +130,13 @@ class GraphicsScene(QtWidgets.QGraphicsScene):
             mask (numpy.ndarray): binary mask.
         """
         
-        #Turn the mask into a transparent pixmap with the color of _maskBrush
-        maskr       = np.reshape(mask * self._maskBrush.color().redF(),
-                                 (1,mask.shape[0], mask.shape[1])
-                                 )
-        maskg       = np.reshape(mask * self._maskBrush.color().greenF(),
-                                 (1,mask.shape[0], mask.shape[1])
-                                 )
-        maskb       = np.reshape(mask * self._maskBrush.color().blueF(),
-                                 (1,mask.shape[0], mask.shape[1])
-                                 )
-        maskalpha   = np.reshape(mask * self._maskBrush.color().alphaF(),
-                                 (1,mask.shape[0], mask.shape[1])
-                                 )
-        
-        mask = np.vstack((maskr, maskg, maskb, maskalpha))
-        mask = np.swapaxes(mask, 0,2)
-        mask = np.swapaxes(mask, 0,1)
-        
-        qimage = qimage2ndarray.array2qimage(mask, normalize = True)
-        vesselMaskPixmap = QtGui.QPixmap(qimage)
+        #Wrap the mask in an indexed image with the color of _maskBrush.
+        #The buffer is kept, since the image doesn't own a copy of it.
+        self._vesselBuffer  = np.ascontiguousarray(mask > 0, 
+                                                   dtype = np.uint8)
+        qimage              = _makeOverlayImage(self._vesselBuffer,
+                                                self._maskBrush.color())
+        vesselMaskPixmap    = QtGui.QPixmap.fromImage(qimage)
         
         #Add the vesselMask to the scene
         self._vesselPixmapItem.setPixmap(vesselMaskPixmap)
@@ -240,7 +244,8 @@ class GraphicsScene(QtWidgets.QGraphicsScene):
         x,y = self.limitToSceneRect(event.scenePos())
         l = self.sceneRect().left()
         t = self.sceneRect().top()
-        self.mouseMove.emit(x-l,y-t)
+        self._hoverPos  = (int(x-l), int(y-t))
+        self._scheduleUpdate()
         
         super(GraphicsScene, self).mouseMoveEvent(event)
         
@@ -378,86 +383,92 @@ class GraphicsScene(QtWidgets.QGraphicsScene):
         self._brightness    = min(self._brightness, 100)
         
         #Send signal to imageViewer
-        self.adjustContrastSignal.emit(self._contrast,
-                                       self._brightness)
+        self._contrastChanged = True
+        self._scheduleUpdate()
         
         
     #Auxillary
     #=================================================================
     
+    def _scheduleUpdate(self):
+        """Starts the timer that sends the collected mouse events, unless 
+        it is already running."""
+        
+        if not self._updateTimer.isActive():
+            self._updateTimer.start()
+    
+    def _sendUpdates(self):
+        """Sends the last cursor position and contrast since the previous 
+        update. Earlier events in between are dropped."""
+        
+        if self._hoverPos is not None:
+            self.mouseMove.emit(*self._hoverPos)
+            self._hoverPos = None
+        
+        if self._contrastChanged:
+            self.adjustContrastSignal.emit(self._contrast,
+                                           self._brightness)
+            self._contrastChanged = False
+    
     def findROI(self):
         """Finds the ROI of the polygon that was last drawn.
         
-        Reads the pixels that are rendered in the graphicsScene
-        and masks those that match the addBrush/subtractBrush color
-        (depending on the isAdd property of the polygon.)
+        The polygon is rasterised directly into a mask of the size of the
+        scene. A pixel is in the ROI if its centre lies inside the polygon
+        (even-odd rule), which is the same area as the polygon that is 
+        drawn on the screen.
         
-        Note: this method is pretty hacky, but still the most elegant 
-        way so far. It ensures that the mask will be exactly as the 
-        user sees it on screen. 
-        For a more 'precise' version (with its own problems), see
-        the commented version at the bottom of the file.
+        Returns:
+            polygonMask(numpy.ndarray): boolean mask of the ROI.
         """
     
         #Get screen dimensions
         dimX = int(self.sceneRect().right() - self.sceneRect().left())
         dimY = int(self.sceneRect().bottom() - self.sceneRect().top())
         
-        #Prepare to render the graphicsScene to a QImage
-        image       = QtGui.QImage(dimX,
-                                   dimY,
-                                   QtGui.QImage.Format_ARGB32_Premultiplied)
-        painter     = QtGui.QPainter(image)
+        #Vertices relative to the top left corner of the scene
+        vertices    = np.array([[point.x(), point.y()] 
+                                for point in self._polygon])
+        vertices   -= [self.sceneRect().left(), self.sceneRect().top()]
         
-        #hide pixmap
-        self._pixmapItem.hide()
+        #The vertices lie on the pixel edges. At twice the resolution, the
+        #pixel centres are the odd grid points, which are never on an edge
+        #of the 4-connected polygon.
+        vertices    = np.round(2 * vertices).astype(np.int32)
+        canvas      = np.zeros((2 * dimY, 2 * dimX), dtype = np.uint8)
+        cv2.fillPoly(canvas, [vertices], 1)
         
-        #Render the image on the screen (without the pixmap) to the painter.
-        self.render(painter, QtCore.QRectF(), QtCore.QRectF())
-        painter.end()
-        
-        #show pixmap
-        self._pixmapItem.show()
-        
-        #Get array from QImage
-        bitBuffer   = image.bits()
-        bitBuffer.setsize(dimX * dimY * 4)
-        arr = np.frombuffer(bitBuffer, np.uint8)
-        arr = np.reshape(arr, (dimX, dimY,4))
-        
-        #Mask out ROIs
-        #Note: colors are [b,g,r,alpha] (apparently)
-        if self._currentPolygonItem.getIsAdd():
-            roiColor        = self._addBrush.color()
-            maskValue       = roiColor.green() * roiColor.alpha() / 255
-            polygonMask     = arr[:,:,1] == maskValue
-        else:
-            roiColor        = self._subtractBrush.color()
-            maskValue       = roiColor.red() * roiColor.alpha() / 255
-            polygonMask     = arr[:,:,2] == maskValue
+        polygonMask = canvas[1::2, 1::2] > 0
         
         return polygonMask
         
     def updateMask(self, polygonMask):
-        """Takes the drawn ROI and adds / subtracts it from the mask."""
+        """Takes the drawn ROI and adds / subtracts it from the mask. Only
+        the bounding rectangle of the ROI is updated."""
         
         if self._mask is None:
-            self._mask = np.zeros(
-                                (int(self.sceneRect().width()), 
-                                 int(self.sceneRect().height())
-                                 ))
+            self._mask = np.zeros(polygonMask.shape)
+        
+        mask        = np.asarray(self._mask) > 0
         
-        self._mask  = self._mask.astype(np.uint8)
-        polygonMask = polygonMask.astype(np.int8)
+        #Bounding rectangle of the ROI in pixels
+        rect        = self._polygon.boundingRect()
+        left        = self.sceneRect().left()
+        top         = self.sceneRect().top()
+        x0          = max(0, int(np.floor(rect.left()   - left)))
+        y0          = max(0, int(np.floor(rect.top()    - top)))
+        x1          = min(mask.shape[1], int(np.ceil(rect.right()  - left)))
+        y1          = min(mask.shape[0], int(np.ceil(rect.bottom() - top)))
         
+        region      = (slice(y0, y1), slice(x0, x1))
         if self._currentPolygonItem.getIsAdd():
-            mask        = self._mask + polygonMask
+            mask[region]   |= polygonMask[region]
         else:
-            mask        = self._mask - polygonMask
+            mask[region]   &= ~polygonMask[region]
             
-        self._mask      = mask > 0
+        self._mask      = mask
         #Updates the pixmapItem containing the mask
-        self.updateMaskPixmap()
+        self.updateMaskPixmap(QtCore.QRect(x0, y0, x1 - x0, y1 - y0))
         
         
     
@@ -487,84 +498,49 @@ class GraphicsScene(QtWidgets.QGraphicsScene):
         if len(polygon) == 0:
             polygon.append(QtCore.QPointF(x,y))
         
-        #Find the current and last points        
-        x2 = x
-        y2 = y
-        x1 = polygon[-1].x()
-        y1 = polygon[-1].y()
-        x0 = x1
-        y0 = y1
-        
-        if polygon.size() > 1:
-            x0 = polygon[-2].x()
-            y0 = polygon[-2].y()
-        
-        #numSteps is the distance between the current and last points
-        numSteps = abs(x2 - x1) + abs(y2 - y1)
+        #Steps from the last point to the current point
+        steps   = _get4ConnectedSteps(polygon[-1].x(), polygon[-1].y(), x, y)
         
-        while numSteps > 1: 
-            
-            deltaX = x2 - x1
-            deltaY = y2 - y1
-            deltaXPrev = int(x0 - x1)
-            deltaYPrev = int(y0 - y1)
-            
-            signX = np.sign(deltaX)
-            signY = np.sign(deltaY)
-            
-            #What direction should the next step be in
-            #TODO, rewrite
-            if abs(deltaY) > abs(deltaX):
-                polygon.append(QtCore.QPointF(x1, y1 + signY))     
-                y1 = y1 + signY
-            elif abs(deltaX) > abs(deltaY):
-                polygon.append(QtCore.QPointF(x1 + signX, y1))  
-                x1 = x1 + signX
-            elif deltaYPrev == 0:
-                polygon.append(QtCore.QPointF(x1, y1 + signY)) 
-                y1 = y1 + signY
-            elif deltaXPrev == 0:
-                polygon.append(QtCore.QPointF(x1 + signX, y1))      
-                x1 = x1 + signX
-            else:
-                polygon.append(QtCore.QPointF(x1 + signX, y1))
-                x1 = x1 + signX
+        for stepX, stepY in steps.tolist():
+            polygon.append(QtCore.QPointF(stepX, stepY))
             
-            numSteps -= 1
-        
-        #If numSteps == 1, then it's 4-connected.
-        polygon.append(QtCore.QPointF(x, y))  
         self._currentPolygonItem.setPolygon(self._polygon)
     
     
-    def updateMaskPixmap(self):
+    def updateMaskPixmap(self, rect = None):
         """Updates the mask used in the maskPixmapItem. Doesn't make a new 
-        pixmapitem."""
-        
+        pixmapitem.
         
-        mask = self._mask.astype(np.uint8)*255
+        Args:
+            rect(QRect): the part of the mask that changed, in pixels. If
+            None, the whole pixmap is made again.
+        """
         
-        #Turn the mask into a transparent pixmap with the color of _addBrush
-        maskr       = np.reshape(mask * self._addBrush.color().redF(),
-                                 (1,mask.shape[0], mask.shape[1])
-                                 )
-        maskg       = np.reshape(mask * self._addBrush.color().greenF(),
-                                 (1,mask.shape[0], mask.shape[1])
-                                 )
-        maskb       = np.reshape(mask * self._addBrush.color().blueF(),
-                                 (1,mask.shape[0], mask.shape[1])
-                                 )
-        maskalpha   = np.reshape(mask * self._addBrush.color().alphaF(),
-                                 (1,mask.shape[0], mask.shape[1])
-                                 )
+        height, width   = self._mask.shape
+        fullUpdate      = (rect is None or 
+                           self._maskBuffer is None or
+                           self._maskBuffer.shape != self._mask.shape)
         
-        mask = np.vstack((maskr, maskg, maskb, maskalpha))
-        mask = np.swapaxes(mask, 0,2)
-        mask = np.swapaxes(mask, 0,1)
+        #Wrap the mask in an indexed image with the color of _addBrush.
+        if fullUpdate:
+            self._maskBuffer    = np.ascontiguousarray(self._mask > 0,
+                                                       dtype = np.uint8)
+            rect                = QtCore.QRect(0, 0, width, height)
+        else:
+            region  = (slice(rect.top(),  rect.top()  + rect.height()),
+                       slice(rect.left(), rect.left() + rect.width()))
+            self._maskBuffer[region] = self._mask[region] > 0
+            
+        qimage = _makeOverlayImage(self._maskBuffer, self._addBrush.color())
         
-        #Make it into a pixmap.
-        qimage = qimage2ndarray.array2qimage(mask, normalize = True)
-        self._maskPixmap = QtGui.QPixmap(qimage)
+        if fullUpdate:
+            self._maskPixmap = QtGui.QPixmap.fromImage(qimage)
+        else:
+            #Only draw the changed rectangle over the previous pixmap.
+            painter = QtGui.QPainter(self._maskPixmap)
+            painter.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+            painter.drawImage(rect.topLeft(), qimage, rect)
+            painter.end()
         
         #Update the pixmapItem.
         self._maskPixmapItem.setPixmap(self._maskPixmap)
@@ -643,4 +619,66 @@ polygon.contains() function. Takes long, gives strange results.
 #        #Find all pixels in polygon.
 #        grid = path.contains_points(points)
 #            
-#        return grid
\ No newline at end of file
+#        return grid
+
+
+def _makeOverlayImage(buffer, color):
+    """
+    Wraps a mask in an 8-bit indexed QImage without copying it. Pixels 
+    that are 0 are transparent, pixels that are 1 get the given color.
+    
+    Args:
+        buffer(numpy.ndarray): C-contiguous uint8 mask with values 0 and 1.
+        The buffer has to be kept alive as long as the image is used.
+        color(QColor): color of the mask.
+        
+    Returns:
+        qimage(QImage): the mask as a Format_Indexed8 image.
+    """
+    
+    height, width   = buffer.shape
+    qimage          = QtGui.QImage(buffer.data, width, height, 
+                                   buffer.strides[0], 
+                                   QtGui.QImage.Format_Indexed8)
+    qimage.setColorTable([QtGui.qRgba(0, 0, 0, 0), color.rgba()])
+    
+    return qimage
+
+
+def _getRefreshInterval():
+    """Returns the time between two refreshes of the screen in ms."""
+    
+    screen  = QtGui.QGuiApplication.primaryScreen()
+    rate    = 60
+    if screen is not None and screen.refreshRate() > 0:
+        rate    = screen.refreshRate()
+    
+    return max(1, int(1000 / rate))
+
+
+def _get4ConnectedSteps(x1, y1, x2, y2):
+    """
+    Returns the points of a 4-connected path from (x1, y1) to (x2, y2), 
+    that stays as close as possible to the straight line between them.
+    
+    Args:
+        x1, y1(float): start point, not included in the path.
+        x2, y2(float): end point, the last point of the path.
+        
+    Returns:
+        steps(numpy.ndarray): array of shape (nSteps, 2) with the x and y
+        coordinates of the path.
+    """
+    
+    deltaX      = x2 - x1
+    deltaY      = y2 - y1
+    numSteps    = int(abs(deltaX) + abs(deltaY))
+    
+    #Every step is along x or y. The number of steps along x so far 
+    #follows the line.
+    step        = np.arange(1, numSteps + 1)
+    stepsX      = np.round(step * abs(deltaX) / max(numSteps, 1))
+    stepsY      = step - stepsX
+    
+    return np.column_stack((x1 + np.sign(deltaX) * stepsX,
+                            y1 + np.sign(deltaY) * stepsY))
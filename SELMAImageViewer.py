@@ -18,6 +18,8 @@ import qimage2ndarray
 import SELMAGraphicsScene
 import SELMAGraphicsView
 import SELMAGUIBar
+import SELMAFrameCache
+import SELMAGUISettings
 
 # ====================================================================
 
@@ -34,12 +36,31 @@ class ImageViewer(QtWidgets.QFrame):
         #Initial pixmap 
         self._pixmapItem = QtWidgets.QGraphicsPixmapItem()
         
+        #Converted frames of the series that is scrolled through
+        self._frameCache    = None
+        self._frameIdx      = None
+        
+        #8-bit image of the shown frame, before contrast & brightness
+        self._displayImage  = None
+        
+        #Values of the shown frame, for the value under the cursor
+        self._frame         = None
+        
+        #Cine playback of the frames
+        self._playbackFrames    = []
+        self._playbackPos       = 0
+        self._playbackPixmaps   = dict()
+        self._playbackTimer     = QtCore.QTimer(self)
+        self._playbackTimer.setTimerType(QtCore.Qt.PreciseTimer)
+        self._playbackTimer.timeout.connect(self._showNextPlaybackFrame)
+        
         #GraphicsScene - handles displaying the pixmap, and masks.
         self._scene = SELMAGraphicsScene.GraphicsScene(self._pixmapItem,
                                                        self)
         #Connect signals
         self._scene.updateProgressBar.connect(self.setProgressBar)
         self._scene.adjustContrastSignal.connect(self.adjustDisplay)
+        self._scene.mouseMove.connect(self.showPixelValue)
         
         #GraphicsView - handles the zooming and resizing.
         self._view = SELMAGraphicsView.SynchableGraphicsView(self._scene)
@@ -104,6 +125,10 @@ class ImageViewer(QtWidgets.QFrame):
     # ------------------------------------------------------------------
     '''Public'''
     
+    #Signals
+    playbackFrameSignal = QtCore.pyqtSignal(int)
+    """Emitted with the index of the frame that is shown during playback."""
+    
     #Properties
     # ------------------------------------------------------------------
 
@@ -161,27 +186,99 @@ class ImageViewer(QtWidgets.QFrame):
     
     def setPixmap(self, array):
         """Changes the original pixmap. """
-        self._originalPixmap = array
         
-        qimage = qimage2ndarray.array2qimage(array, normalize = True)
-        pixmap = QtGui.QPixmap(qimage)
+        self.stopPlayback()
+        self._frame = np.asarray(array)
         
-        #Add the pixmap to the scene
-        self._pixmapItem.setPixmap(pixmap)
-        self._pixmapItem.setOffset(-pixmap.width()  / 2.0,
-                                   -pixmap.height() / 2.0)
-        self._pixmapItem.setTransformationMode(QtCore.Qt.SmoothTransformation)
-        self._pixmapItem.setZValue(0)
+        qimage = qimage2ndarray.gray2qimage(array, normalize = True)
+        self._setImage(qimage, reset = True)
         
-        self._pixmapItem.setPixmap(pixmap)
-        self.fitToWindow()
+    def setFrames(self, frames):
+        """Sets the series of frames that is scrolled through with 
+        showFrame. The frames are converted to 8-bit images once and kept
+        in a cache.
         
-        #Update the scene
-        self._scene.resetContrast()
-        self._scene.setActive(True)
+        Args:
+            frames(sequence): the frames of the series.
+        """
         
-#        self._scene.setPixmap(self._pixmapItem)
-
+        self.stopPlayback()
+        if self._frameCache is not None:
+            self._frameCache.close()
+        
+        self._frameCache    = SELMAFrameCache.FrameCache(frames)
+        self._frameIdx      = None
+        
+    def showFrame(self, idx):
+        """Shows a frame of the series set with setFrames. Unlike 
+        setPixmap, the zoom and contrast are kept when the frame has the
+        same size as the previous one. Stops the playback."""
+        
+        if self._frameCache is None:
+            return
+        
+        self.stopPlayback()
+        qimage                  = self._frameCache.getImage(idx)
+        reset                   = self._frameIdx is None
+        self._frameIdx          = idx
+        
+        #The values are only read when the cursor is on the frame
+        self._frame             = None
+        
+        self._setImage(qimage, reset)
+        
+    def startPlayback(self, indices):
+        """
+        Loops through frames of the series set with setFrames at the frame
+        rate in the settings, starting after the shown frame. Every frame
+        is converted to a pixmap once, so the next loops only swap the 
+        pixmap. The masks are not changed.
+        
+        Args:
+            indices(list): indices of the frames to play.
+        """
+        
+        self.stopPlayback()
+        if self._frameCache is None or len(indices) == 0:
+            return
+        
+        self._playbackFrames    = list(indices)
+        self._playbackPixmaps   = dict()
+        if self._frameIdx in self._playbackFrames:
+            self._playbackPos   = self._playbackFrames.index(self._frameIdx)
+        else:
+            self._playbackPos   = -1
+        
+        interval = max(1, int(round(1000 / _getPlaybackFps())))
+        self._playbackTimer.start(interval)
+        
+    def stopPlayback(self):
+        """Stops the playback and frees the pixmaps of the played frames."""
+        
+        self._playbackTimer.stop()
+        self._playbackPixmaps   = dict()
+        
+    def isPlaying(self):
+        return self._playbackTimer.isActive()
+    
+    def clear(self):
+        """Removes the frames of the series, e.g. when a scan could not be
+        read completely. Drawing is turned off until a new frame is 
+        shown."""
+        
+        self.stopPlayback()
+        if self._frameCache is not None:
+            self._frameCache.close()
+        
+        self._frameCache    = None
+        self._frameIdx      = None
+        self._frame         = None
+        self._displayImage  = None
+        
+        self._pixmapItem.setPixmap(QtGui.QPixmap())
+        self._scene.resetMask()
+        self._scene.setActive(False)
+        self.setFrameCounter(0, 0)
     
     def setMask(self, mask):
         """Applies a new mask to the |QGraphicsScene| (*QGraphicsScene*)."""
@@ -348,48 +445,87 @@ class ImageViewer(QtWidgets.QFrame):
         """Adjusts the display pixmap by the defined brightness 
         and contrast.
         
-        
-        The pixmap doesn't seem to be normalised between 0 and 255 correctly.
-        This leads to the image being very bright once it's adjusted and 
-        truncated in the code below. 
-        Properly normalising the image causes the adjustment of contrast and 
-        brightness to malfunction. Therefore the bug is left in. 
+        The shown image is an 8-bit indexed image of the frame normalised
+        between 0 and 255. The contrast and brightness are applied to its
+        colour table, so the pixels of the frame are not changed.
         """
         
-        #Begin with the original
-        displayPixmap   = np.copy(self._originalPixmap)
-
-        #Change the contrast
-        C               = contrastFactor
-        F               = (259*(C + 255) / (255*(259 - C)))
-        
-        displayPixmap   = F * (displayPixmap - 128) + 128
+        if self._displayImage is None:
+            return
         
-        #Change the brightness
-        displayPixmap   += brightness
+        qimage = QtGui.QImage(self._displayImage)
+        qimage.setColorTable(_getColorTable(contrastFactor, brightness))
         
-        #Truncate the values
-        displayPixmap[displayPixmap < 0]    = 0
-        displayPixmap[displayPixmap > 255]  = 255
+        self._pixmapItem.setPixmap(QtGui.QPixmap.fromImage(qimage))
         
-        #Change the pixmap on the screen
-        self.displayPixmap = displayPixmap
-        self.updateDisplay()
+        #The played frames have to be converted with the new contrast
+        self._playbackPixmaps   = dict()
+
+    def _setImage(self, qimage, reset):
+        """Puts the image on the screen. 
         
+        Args:
+            qimage(QImage): the image to show.
+            
+            reset(bool): fit the image to the window and reset the 
+            contrast. The view is also reset when the size of the image
+            changes.
+        """
         
-    def updateDisplay(self):
-        """Draws the updated display on the screen."""
+        self._displayImage  = qimage
+        pixmap              = QtGui.QPixmap.fromImage(qimage)
         
-        qimage = qimage2ndarray.array2qimage(self.displayPixmap,
-                                             normalize = True)
-        pixmap = QtGui.QPixmap(qimage)
+        if self._pixmapItem.pixmap().size() != pixmap.size():
+            reset = True
         
         self._pixmapItem.setPixmap(pixmap)
-#        self._pixmapItem.setOffset(-pixmap.width()/2.0,
-#                                   -pixmap.height()/2.0)
-#        self._pixmapItem.setTransformationMode(QtCore.Qt.SmoothTransformation)
-#        self.fitToWindow()
+        
+        if reset:
+            #Add the pixmap to the scene
+            self._pixmapItem.setOffset(-pixmap.width()  / 2.0,
+                                       -pixmap.height() / 2.0)
+            self._pixmapItem.setTransformationMode(
+                                        QtCore.Qt.SmoothTransformation)
+            self._pixmapItem.setZValue(0)
+            self.fitToWindow()
+            
+            self._scene.resetContrast()
+        
+        else:
+            #Keep the contrast of the previous frame
+            contrast, brightness = self._scene.getContrast()
+            if contrast != 0 or brightness != 0:
+                self.adjustDisplay(contrast, brightness)
+        
+        #Update the scene
+        self._scene.setActive(True)
 
+    def _showNextPlaybackFrame(self):
+        """Shows the next frame of the playback. Only the pixmap of the
+        frame is changed, the view and the overlays stay the same."""
+        
+        self._playbackPos   = (self._playbackPos + 1) % len(
+                                                    self._playbackFrames)
+        idx                 = self._playbackFrames[self._playbackPos]
+        image               = self._frameCache.getImage(idx)
+        
+        pixmap              = self._playbackPixmaps.get(idx)
+        if pixmap is None:
+            qimage          = image
+            contrast, brightness = self._scene.getContrast()
+            if contrast != 0 or brightness != 0:
+                qimage      = QtGui.QImage(image)
+                qimage.setColorTable(_getColorTable(contrast, brightness))
+            pixmap          = QtGui.QPixmap.fromImage(qimage)
+            self._playbackPixmaps[idx] = pixmap
+        
+        self._displayImage  = image
+        self._frameIdx      = idx
+        self._frame         = None
+        self._pixmapItem.setPixmap(pixmap)
+        
+        self.playbackFrameSignal.emit(idx)
+    
     #Event Handlers
     # ------------------------------------------------------------------
     
@@ -407,6 +543,20 @@ class ImageViewer(QtWidgets.QFrame):
 #            val = np.mean(val[:3])
         pixelValue = round(pixelValue, 5)
         self.valueLabel.updateValues(x,y, pixelValue)
+        
+    def showPixelValue(self, x, y):
+        """Shows the value of the shown frame under the cursor.
+        
+        :param int x: x-index of the frame
+        :param int y: y-index of the frame """
+        
+        if self._frame is None:
+            if self._frameCache is None or self._frameIdx is None:
+                return
+            self._frame = self._frameCache.getFrame(self._frameIdx)
+        
+        if 0 <= y < self._frame.shape[0] and 0 <= x < self._frame.shape[1]:
+            self.mouseHover(x, y, float(self._frame[y, x]))
 
     def handleWheelNotches(self, notches):
         """Handle wheel notch event from underlying |QGraphicsView|.
@@ -451,4 +601,42 @@ class ImageViewer(QtWidgets.QFrame):
         self._view.dumpTransform(self._view.transform(), " "*4)
 
 
-# ====================================================================
\ No newline at end of file
+# ====================================================================
+
+
+def _getPlaybackFps():
+    """Returns the frame rate of the playback from the settings."""
+    
+    COMPANY, APPNAME, _ = SELMAGUISettings.getInfo()
+    COMPANY             = COMPANY.split()[0]
+    APPNAME             = APPNAME.split()[0]
+    settings            = QtCore.QSettings(COMPANY, APPNAME)
+    
+    try:
+        fps             = float(settings.value('playbackFps'))
+    except (TypeError, ValueError):
+        fps             = 20
+    
+    return max(fps, 0.1)
+
+
+def _getColorTable(contrastFactor, brightness):
+    """
+    Returns the gray colour table of an 8-bit image with the contrast and
+    brightness applied.
+    
+    Args:
+        contrastFactor(int): contrast, from -255 to 255.
+        brightness(int): brightness, from -255 to 255.
+        
+    Returns:
+        colorTable(list): 256 qRgb values.
+    """
+    
+    C       = contrastFactor
+    F       = (259*(C + 255) / (255*(259 - C)))
+    
+    table   = F * (np.arange(256) - 128) + 128 + brightness
+    table   = np.clip(table, 0, 255).astype(np.uint8)
+    
+    return [QtGui.qRgb(value, value, value) for value in table.tolist()]
@@ -4,15 +4,33 @@
 This static module contains the following functions:
 
 + :function:`getLibraries`    
++ :function:`getGeometry`
 + :function:`getTransMatrix`
++ :function:`getSamplingGrid`
++ :function:`resliceVolume`
 + :function:`doInterpolation`
 
 """
 
+import collections
+import concurrent.futures
 import numpy as np
 import pydicom
+import scipy.ndimage
 from PyQt5 import (QtCore, QtGui, QtWidgets)
-from scipy.interpolate import RegularGridInterpolator
+
+#Locations in a volume in the T1 space of the pixels of a pca slice, see
+#getSamplingGrid.
+SamplingGrid = collections.namedtuple("SamplingGrid", 
+                                      ["coordinates", "inside", "shape"])
+
+#Geometry of a series read from its headers, see getGeometry.
+Geometry     = collections.namedtuple("Geometry", 
+                                      ["positions", "orientation",
+                                       "pixelSpacing", "sliceThickness"])
+
+#Geometries that were read, per series
+_geometryCache  = dict()
 
 def getLibraries(self):
     """
@@ -75,67 +93,115 @@ def getLibraries(self):
     
     return libs
 
-def getTransMatrix(info):
-    '''Returns the rotation and transformation matrices based on the image 
-    position and image orientation for a dicom info object.'''
+def getGeometry(info):
+    '''
+    Reads the geometry of a series from the dicom headers only, without 
+    the pixel data. The headers of a classic series are read in parallel.
+    The geometry is cached per series, so it is only read once.
     
-    # import pdb; pdb.set_trace()
-    #Find the rightmost(?) frame and get the ImagePositionPatient from there
-    maxIdx  = 0
-    maxVal  = -1e10
-    vals = []
+    Args:
+        info: the pydicom dataset of an enhanced dicom, or a list with the 
+        filenames of the files of a classic series.
+    
+    Returns:
+        Geometry with the ImagePositionPatient of every frame or file as an
+        Nx3 array, the ImageOrientationPatient, the pixel spacing and the
+        slice thickness. For 3D acquisitions the slice thickness is the 
+        spacing between the slices.
+    '''
+    
+    key     = _getSeriesKey(info)
+    if key is not None and key in _geometryCache:
+        return _geometryCache[key]
     
     if type(info) is list:
         
-        i = 0
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            headers = list(executor.map(
+                lambda fname: pydicom.dcmread(fname, 
+                                              stop_before_pixels = True),
+                info))
         
-        for frame in info:
-            
-            T1dcm = pydicom.dcmread(frame)
-            val     = T1dcm.ImagePositionPatient[0]
-            vals.append(val)
-            
-            if float(val) > maxVal:
-                maxVal = float(val)
-                maxIdx   = i
-                
-            i = i + 1
+        positions   = np.asarray([header.ImagePositionPatient 
+                                  for header in headers], dtype = float)
+        
+        #The other values are read from the rightmost(?) file
+        info        = headers[int(np.argmax(positions[:, 0]))]
         
-        info = pydicom.dcmread(info[maxIdx])
-            
-        ipp = info.ImagePositionPatient
-        ipp = [float(ipp[0]), float(ipp[1]), float(ipp[2])] #coordinates of right most pixel
         iop = info.ImageOrientationPatient # orientation (direction of axes)
-        ps  = info.PixelSpacing 
-        ps  = [float(ps[0]), float(ps[1])] # Pixel spacing
+        ps  = info.PixelSpacing # Pixel spacing
         st  = float(info.SliceThickness) #Slice thickness
         
     else:
-    
-        for i in range(info.pixel_array.shape[0]):
-            val     = info.PerFrameFunctionalGroupsSequence[i].\
-                                      PlanePositionSequence[0].\
-                                      ImagePositionPatient[0]
-                                       
-            if float(val) > maxVal:
-                maxVal = float(val)
-                maxIdx   = i
-           
-        ipp = info.PerFrameFunctionalGroupsSequence[maxIdx].\
-                    PlanePositionSequence[0].\
-                    ImagePositionPatient
-        ipp = [float(ipp[0]), float(ipp[1]), float(ipp[2])] #coordinates of right most pixel
-        iop = info.PerFrameFunctionalGroupsSequence[0].\
+        
+        frames      = info.PerFrameFunctionalGroupsSequence
+        positions   = np.asarray([frame.PlanePositionSequence[0].
+                                  ImagePositionPatient 
+                                  for frame in frames], dtype = float)
+        
+        iop = frames[0].\
                     PlaneOrientationSequence[0].\
                     ImageOrientationPatient # orientation (direction of axes)
-        ps  = info.PerFrameFunctionalGroupsSequence[0].\
+        ps  = frames[0].\
             PixelMeasuresSequence[0].\
-                PixelSpacing 
-        ps  = [float(ps[0]), float(ps[1])] # Pixel spacing
-        st  = float(info.
-                  PerFrameFunctionalGroupsSequence[0]
+                PixelSpacing # Pixel spacing
+        st  = float(frames[0]
                   [0x2005,0x140f][0].SliceThickness) #Slice thickness
+    
+    #Use the spacing between the slices for 3D acquisitions
+    if info.MRAcquisitionType != '2D':
+        try:
+                st = float(info.SpacingBetweenSlices)
+        except:
+            if 'philips' in info.Manufacturer.lower():
+                dcmFrameAddress             = 0x5200, 0x9230
+                dcmPrivateCreatorAddress    = 0x2005, 0x140f
+                page    =   info[dcmFrameAddress][0]            \
+                            [dcmPrivateCreatorAddress][0]       
+                st      =   float(page.SpacingBetweenSlices)
+    
+    geometry    = Geometry(positions,
+                           np.asarray(iop, dtype = float),
+                           np.asarray(ps, dtype = float),
+                           st)
+    
+    if key is not None:
+        _geometryCache[key] = geometry
+    
+    return geometry
 
+def _getSeriesKey(info):
+    '''
+    Returns the key of a series in the geometry cache: the filenames of a
+    classic series, or the filename and SOPInstanceUID of an enhanced 
+    dicom. Returns None if the dataset can't be identified.
+    '''
+    
+    if type(info) is list:
+        return tuple(info)
+    
+    filename    = getattr(info, 'filename', None)
+    if not isinstance(filename, str):
+        filename    = None
+    uid         = info.get('SOPInstanceUID')
+    
+    if filename is None and uid is None:
+        return None
+    
+    return filename, uid
+
+def getTransMatrix(info):
+    '''Returns the rotation and transformation matrices based on the image 
+    position and image orientation for a dicom info object.'''
+    
+    #Find the rightmost(?) frame and get the ImagePositionPatient from there
+    geometry    = getGeometry(info)
+    maxIdx      = int(np.argmax(geometry.positions[:, 0]))
+    
+    ipp = geometry.positions[maxIdx] #coordinates of right most pixel
+    iop = geometry.orientation # orientation (direction of axes)
+    ps  = geometry.pixelSpacing # Pixel spacing
+    st  = geometry.sliceThickness #Slice thickness
 
     #%Translate to put top left pixel at ImagePositionPatient
     Tipp = [[1, 0, 0, ipp[0]],
@@ -154,16 +220,6 @@ def getTransMatrix(info):
            [0,  0,  0,  1]]
     
     #Scale using PixelSpacing
-    if info.MRAcquisitionType != '2D':
-        try:
-                st = float(info.SpacingBetweenSlices)
-        except:
-            if 'philips' in info.Manufacturer.lower():
-                dcmFrameAddress             = 0x5200, 0x9230
-                dcmPrivateCreatorAddress    = 0x2005, 0x140f
-                page    =   info[dcmFrameAddress][0]            \
-                            [dcmPrivateCreatorAddress][0]       
-                st      =   float(page.SpacingBetweenSlices)
     S = [  [ps[1], 0, 0, 0],
            [0, ps[0], 0, 0],
            [0, 0, st, 0],
@@ -183,109 +239,97 @@ def getTransMatrix(info):
     
     return M, R
 
-def doInterpolation(M, t1im, pcaShape):
+def getSamplingGrid(M, volumeShape, pcaShape):
         '''
-        Interpolates the 3d t1 image at the locations of the pca grid defined
-        by the transformation matrix M.
+        Finds the locations in a 3d volume in the T1 space that lie on the 
+        pca grid defined by the transformation matrix M. The grid only 
+        depends on the geometry of the T1 and the pca, so it can be reused
+        for every volume in the T1 space with the same shape, e.g. the T1 
+        image and the white matter segmentation.
+        
+        Args:
+            M(numpy.ndarray): 4x4 transformation matrix from the pca to 
+            the T1 space.
+            volumeShape(tuple): shape of the volume, as (frames, rows, 
+            columns).
+            pcaShape(tuple): shape of the pca pixel array.
+        
+        Returns:
+            SamplingGrid with the indices in the volume of the pca pixels
+            that lie inside the volume, a mask of those pixels and the 
+            shape of the interpolated slice.
         
         Note: most of this code is converted from the matlab PulsateGUI 
         program. It has been tested and seems to work, but many of the steps
         are only empirically verified (= I don't know why everything works
                                        the way it does.)
-        
         '''
-
-        #swap axes for x and y 
-        t1toqfnew = np.zeros((4,4))
-        t1toqfnew[:,0] = M[:,1]
-        t1toqfnew[:,1] = M[:,0]
-        t1toqfnew[:,2] = M[:,2]
-        t1toqfnew[:,3] = M[:,3]
-        
-        #Switch axes to x,y,z so that it is the same as matlab
-        #There's probably a way to combine the next few steps into one, 
-        #but this works
-        t1  = t1im
-        t1  = np.flip(t1, 1)
-        t1  = np.swapaxes(t1, 0,2)
-        
-        #Reorient the image such that it maches the LPH orientation of the PCA
-        t1_3D = np.flip(t1,1)
-        t1_3D = np.flip(t1_3D,2)
-        t1_3D = np.swapaxes(t1_3D, 1,0)
-        
-        # get coordinate ranges
-        corrcoorx = -0.5
-        corrcoory = -1.5
-        corrcoorz = -1.5
-        Zrange = 1
-        
-        range_x = np.arange(1, pcaShape[2] + 1) + corrcoorx
-        range_y = np.arange(1, pcaShape[1] + 1) + corrcoory
-        range_z = Zrange + corrcoorz;
-        
-        #Finalise transformation matrix
-        M = t1toqfnew + [[0,0,0,1],[0,0,0,1],[0,0,0,1],[0,0,0,0]]
-        
-        #Shift coordinates (this probably isn't necessary in python, but I 
-        # haven't verified that.)
-        dV =  [-0.5, -0.5, -0.5]        
-        range_x = range_x - dV[0]
-        range_y = range_y - dV[1]
-        range_z = range_z - dV[2]
-        yg, xg, zg = np.meshgrid(range_y,range_x,range_z)
-        
-        xyz = np.asarray([
-               np.reshape(xg,-1),
-               np.reshape(yg,-1),
-               np.reshape(zg, -1),
-               np.ones(len(xg)**2)])
-        
-        #Construct interpolation coordinates
-        uvw = np.dot(M, xyz)
-        uvw = np.transpose(uvw[:3,:])
-        
-        # interpolate
-        #Here we vary from lennart's method, as we have to use 
-        #scipy.RegularGridInterpolator
-        
-        #Get interpolation coordinates
-        xi = uvw[:,0]
-        yi = uvw[:,1]
-        zi = uvw[:,2]
+        
+        numFrames   = volumeShape[0]
+        
+        #Pixel coordinates of the pca slice. The columns of the slice are
+        #flipped, as in the matlab code.
+        x           = np.arange(1, pcaShape[2] + 1, dtype = float)[:, None]
+        y           = np.arange(pcaShape[1] - 1, -1, -1, dtype = float)
+        
+        #Apply the transformation matrix, with the x and y axes swapped.
+        #The slice lies at z = 0. The 1 is added because the coordinates 
+        #are one-based in matlab.
+        uvw         = [M[i, 1] * x + M[i, 0] * y + M[i, 3] + 1 
+                       for i in range(3)]
+        xi, yi, zi  = uvw
+        
+        #The matlab code reorients the T1 to the LPH orientation of the pca
+        #with flips and swaps. Instead, the coordinates are converted to
+        #indices in the volume as it is: (frame, row, column).
         
         #Find only values that lie within the t1 space
-        index = (xi > 0) * (xi < t1_3D.shape[0] - 1) * \
-                (yi > 0) * (yi < t1_3D.shape[1] - 1) * \
-                (zi > 0) * (zi < t1_3D.shape[2] - 1)
-        xi = xi[index]
-        yi = yi[index]
-        zi = zi[index]
-        
-        # For some reason, we have to switch x and y. I really don't 
-        # understand why. 
-        pts = np.transpose((yi, xi, zi))   
-        
-        #### Create interpolation space
-        x = np.arange(0,t1_3D.shape[0])
-        y = np.arange(0,t1_3D.shape[1])
-        z = np.arange(0,t1_3D.shape[2])
-        inter = RegularGridInterpolator((x,y,z), t1_3D)
-   
-        # Interpolate at the pca coordinate locations
-        inp     = inter(pts)
-        
-        #Insert the interpolated values in a new slice
-        res = np.zeros(len(index))
-        res[index] = inp
-        res = np.reshape(res, xg.shape[:2])
-        
-        #### Experimental: flip on column axis
-        res     = np.flip(res, 1)
-        
-        #Store the interpolation result
+        inside      = ((xi > 0) & (xi < volumeShape[2] - 1) &
+                       (yi > 0) & (yi < volumeShape[1] - 1) &
+                       (zi > 0) & (zi < numFrames - 1))
+        
+        coordinates = np.asarray([numFrames - 1 - zi[inside],
+                                  yi[inside],
+                                  xi[inside]])
+        
+        return SamplingGrid(coordinates, inside, inside.shape)
+
+def resliceVolume(volume, grid):
+        '''
+        Interpolates a 3d volume in the T1 space on the pca slice with 
+        trilinear interpolation.
+        
+        Args:
+            volume(numpy.ndarray): volume in the T1 space, as (frames, rows,
+            columns).
+            grid(SamplingGrid): made by getSamplingGrid for the shape of 
+            the volume.
+        
+        Returns:
+            The interpolated slice. Pixels outside the volume are zero.
+        '''
+        
+        res         = np.zeros(grid.shape)
+        res[grid.inside] = scipy.ndimage.map_coordinates(
+                                                np.asarray(volume),
+                                                grid.coordinates,
+                                                output  = np.float64,
+                                                order   = 1)
+        
         return res
 
+def doInterpolation(M, t1im, pcaShape):
+        '''
+        Interpolates the 3d t1 image at the locations of the pca grid defined
+        by the transformation matrix M. When more volumes are interpolated
+        on the same pca grid, use getSamplingGrid and resliceVolume so the
+        grid is only made once.
+        '''
+        
+        grid    = getSamplingGrid(M, np.shape(t1im), pcaShape)
+        
+        return resliceVolume(t1im, grid)
+
 
 
 
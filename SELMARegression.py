@@ -0,0 +1,560 @@
+#!/usr/bin/env python
+
+"""
+This module contains regression checks of the vectorised parts of the
+analysis. Every check runs the new implementation next to a reference
+copy of the loop it replaced, on random synthetic data, and compares the
+results:
+
++ Sampling grid:      getSamplingGrid and resliceVolume against the
+                      RegularGridInterpolator reslicing of doInterpolation.
++ Sigma clipping:     sigmaClipSTD against the loops of 
+                      _estimateVelocitySTD, one series at a time.
++ Vessel parameters:  obtainFilters, filterVelocities and 
+                      summariseVelocities against their loops, for every
+                      structure, with tied velocities and vessels above
+                      the venc.
+
+The checks need no dicom files and no settings. Run them with:
+
+    python SELMARegression.py --trials 20 --seed 0
+
+The program exits with status 1 when a check fails.
+
+"""
+
+# ====================================================================
+
+import argparse
+import sys
+import warnings
+
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+from scipy.spatial.transform import Rotation
+
+# ====================================================================
+
+import SELMAData
+import SELMADataCalculate
+import SELMAInterpolate
+
+# ====================================================================
+
+
+def checkSamplingGrid(rng, trials):
+    """
+    Reslices random T1 volumes on randomly rotated and shifted pca grids.
+    One grid is made per trial and used for two volumes, the same way as
+    the T1 image and the white matter segmentation share a grid.
+
+    Args:
+        rng(numpy.random.RandomState): random generator.
+        trials(int): number of grids.
+
+    Returns:
+        failures(list): a description of every mismatch.
+    """
+
+    failures    = []
+    for trial in range(trials):
+        #The reference mixes up the rows and columns of the T1 in the
+        #check of the bounds, so it only works for square T1 frames.
+        volumeSize  = rng.randint(40, 70)
+        volumeShape = (rng.randint(30, 50), volumeSize, volumeSize)
+        size        = rng.randint(24, 48)
+        pcaShape    = (10, size, size)
+
+        M           = np.eye(4)
+        M[:3, :3]   = (Rotation.from_euler('xyz', 0.3 * rng.randn(3)
+                                           ).as_matrix() *
+                       rng.uniform(0.5, 1.5))
+        M[:3, 3]    = [rng.uniform(-5, 20), rng.uniform(-5, 20),
+                       rng.uniform(5, volumeShape[0] - 5)]
+
+        grid        = SELMAInterpolate.getSamplingGrid(M, volumeShape,
+                                                       pcaShape)
+
+        #Values are at least 1, so the pixels outside the volume are the
+        #only zeros.
+        for name in ("T1", "segmentation"):
+            volume      = rng.randint(1, 1000, volumeShape
+                                      ).astype(np.uint16)
+            reference   = _referenceInterpolation(M, volume, pcaShape)
+            result      = SELMAInterpolate.resliceVolume(volume, grid)
+
+            if result.shape != reference.shape:
+                failures.append("trial %d, %s: shape %s instead of %s"
+                                %(trial, name, result.shape,
+                                  reference.shape))
+                continue
+
+            outside = np.sum((result == 0) != (reference == 0))
+            diff    = np.max(np.abs(result - reference))
+            if outside > 0 or diff > 1e-6:
+                failures.append("trial %d, %s: %d pixels differ in being "
+                                "outside the volume, max difference %g"
+                                %(trial, name, outside, diff))
+
+    return failures
+
+
+def checkSigmaClip(rng, trials):
+    """
+    Estimates the noise of three series of random noise with outliers, 
+    like the velocity, real and imaginary signal in a mask.
+    
+    The loops that were replaced clip the values around zero, and 
+    sigmaClipSTD around the mean. Both are compared on series that are 
+    symmetric around zero, where the two are the same. On series that are
+    not centred around zero, sigmaClipSTD is compared to the same loop 
+    clipping around the mean.
+
+    Args:
+        rng(numpy.random.RandomState): random generator.
+        trials(int): number of data sets.
+
+    Returns:
+        failures(list): a description of every mismatch.
+    """
+
+    failures    = []
+    for trial in range(trials):
+        numValues   = rng.randint(20, 2000)
+        data        = rng.randn(3, numValues) * rng.uniform(0.1, 10, (3, 1))
+        outliers    = rng.rand(3, numValues) < 0.05
+        data[outliers] *= rng.uniform(5, 50)
+        
+        symmetric   = np.concatenate((data, -data), axis = 1)
+        offset      = data + rng.uniform(-100, 100, (3, 1))
+        
+        for name, series, reference in (
+                ("symmetric", symmetric, _referenceNoiseLoop),
+                ("offset", offset, _referenceMeanClip)):
+            result      = SELMAData.sigmaClipSTD(series)
+            expected    = np.array([reference(values) for values in series])
+            
+            if not np.allclose(result, expected, rtol = 1e-9, atol = 0):
+                failures.append("trial %d, %s: %s instead of %s"
+                                %(trial, name, result, expected))
+
+    return failures
+
+
+def checkVesselParameters(rng, trials):
+    """
+    Calculates the vessel parameters of random vessels with 
+    calculateParameters and with the loops it replaced. The trials cycle 
+    through the Basal Ganglia, the Semioval Centre and advanced clustering
+    with random flags. The mean velocities are rounded, so vessels have 
+    more than one peak voxel, and every other trial has a venc that some
+    vessels exceed.
+    
+    The loops excluded the wrong vessels when a vessel was above the venc,
+    so the reference excludes every vessel with a phase above the venc.
+
+    Args:
+        rng(numpy.random.RandomState): random generator.
+        trials(int): number of data sets.
+
+    Returns:
+        failures(list): a description of every mismatch.
+    """
+
+    failures    = []
+    for trial in range(trials):
+        structure   = trial % 3
+        if structure == 0:
+            settings    = {'BasalGanglia': True}
+        elif structure == 1:
+            settings    = {'SemiovalCentre': True}
+        else:
+            settings    = {'AdvancedClustering': True}
+            for key in ('PositiveFlow', 'NegativeFlow', 'PositiveMagnitude',
+                        'NegativeMagnitude', 'IsointenseMagnitude'):
+                settings[key]   = bool(rng.rand() > 0.5)
+        
+        venc        = 3.0 if trial % 2 else 1e9
+        seed        = rng.randint(2**31)
+        result      = _VesselData(np.random.RandomState(seed), settings, 
+                                  venc)
+        reference   = _VesselData(np.random.RandomState(seed), settings, 
+                                  venc)
+        
+        with warnings.catch_warnings(), np.errstate(all = 'ignore'):
+            #Structures without vessels give NaN
+            warnings.simplefilter('ignore')
+            SELMADataCalculate.calculateParameters(result)
+            _referenceCalculateParameters(reference)
+        
+        for name in ('_Flows', '_Magnitudes', '_V_cardiac_cycle_included'):
+            if not np.array_equal(getattr(result, name), 
+                                  getattr(reference, name)):
+                failures.append("trial %d: %s differs" %(trial, name))
+        
+        if (len(result._included_vessels) != 
+            len(reference._included_vessels) or not all(
+                np.array_equal(vessel, referenceVessel) for vessel, 
+                referenceVessel in zip(result._included_vessels,
+                                       reference._included_vessels))):
+            failures.append("trial %d: _included_vessels differs" %trial)
+        
+        for name in ('_Vmean', '_PI_norm', '_allsemV', '_allsemPI'):
+            value           = getattr(result, name)
+            referenceValue  = getattr(reference, name)
+            if not np.isclose(value, referenceValue, rtol = 1e-12, 
+                              atol = 0, equal_nan = True):
+                failures.append("trial %d: %s is %g instead of %g"
+                                %(trial, name, value, referenceValue))
+
+    return failures
+
+
+CHECKS      = (("Sampling grid",    checkSamplingGrid),
+               ("Sigma clipping",   checkSigmaClip),
+               ("Vessel parameters", checkVesselParameters))
+
+
+# ====================================================================
+
+def _referenceInterpolation(M, t1im, pcaShape):
+    """The reslicing of doInterpolation before getSamplingGrid, for square
+    pca slices and square T1 frames."""
+
+    #swap axes for x and y
+    t1toqfnew       = np.zeros((4,4))
+    t1toqfnew[:,0]  = M[:,1]
+    t1toqfnew[:,1]  = M[:,0]
+    t1toqfnew[:,2]  = M[:,2]
+    t1toqfnew[:,3]  = M[:,3]
+
+    t1      = np.flip(t1im, 1)
+    t1      = np.swapaxes(t1, 0,2)
+
+    #Reorient the image such that it maches the LPH orientation of the PCA
+    t1_3D   = np.flip(t1,1)
+    t1_3D   = np.flip(t1_3D,2)
+    t1_3D   = np.swapaxes(t1_3D, 1,0)
+
+    range_x = np.arange(1, pcaShape[2] + 1) - 0.5 + 0.5
+    range_y = np.arange(1, pcaShape[1] + 1) - 1.5 + 0.5
+    range_z = 1 - 1.5 + 0.5
+
+    M       = t1toqfnew + [[0,0,0,1],[0,0,0,1],[0,0,0,1],[0,0,0,0]]
+
+    yg, xg, zg = np.meshgrid(range_y,range_x,range_z)
+    xyz     = np.asarray([np.reshape(xg,-1),
+                          np.reshape(yg,-1),
+                          np.reshape(zg, -1),
+                          np.ones(len(xg)**2)])
+
+    uvw     = np.transpose(np.dot(M, xyz)[:3,:])
+    xi      = uvw[:,0]
+    yi      = uvw[:,1]
+    zi      = uvw[:,2]
+
+    index   = (xi > 0) * (xi < t1_3D.shape[0] - 1) * \
+              (yi > 0) * (yi < t1_3D.shape[1] - 1) * \
+              (zi > 0) * (zi < t1_3D.shape[2] - 1)
+    pts     = np.transpose((yi[index], xi[index], zi[index]))
+
+    inter   = RegularGridInterpolator((np.arange(0,t1_3D.shape[0]),
+                                       np.arange(0,t1_3D.shape[1]),
+                                       np.arange(0,t1_3D.shape[2])),
+                                      t1_3D)
+
+    res         = np.zeros(len(index))
+    res[index]  = inter(pts)
+    res         = np.reshape(res, xg.shape[:2])
+
+    return np.flip(res, 1)
+
+
+def _referenceNoiseLoop(values):
+    """The loop of _estimateVelocitySTD before sigmaClipSTD, for one 
+    series."""
+
+    SD_factor = 4 # value derived from simulated data
+    
+    CONVERGED = 0;
+    MAXRUNS = 100;
+    iRun = 0;
+    SD_init = np.std(values)
+    SD_prev = SD_init
+    
+    while (not CONVERGED) and (iRun < MAXRUNS):
+        
+        values_dummy = values
+        outlier_indices = np.where(abs(values) > (SD_factor * SD_prev))
+        values_dummy = np.delete(values_dummy,outlier_indices)
+        SD_curr = np.std(values_dummy)
+        
+        if abs(SD_curr - SD_prev) < 10 * np.finfo(float).eps:
+            
+            CONVERGED = 1;
+            
+        # Update counters/ stats
+        iRun = iRun + 1
+        SD_prev = SD_curr
+        
+    return SD_curr
+
+
+def _referenceMeanClip(values):
+    """The same loop as _referenceNoiseLoop, clipping around the mean of 
+    the values that were kept instead of around zero."""
+
+    kept    = values
+    mean    = np.mean(values)
+    std     = np.std(values)
+    
+    for _ in range(SELMAData.SIGMA_CLIP_RUNS):
+        kept    = values[np.abs(values - mean) <= 
+                         SELMAData.SIGMA_CLIP_FACTOR * std]
+        newStd  = np.std(kept)
+        mean    = np.mean(kept)
+        
+        if abs(newStd - std) < 10 * np.finfo(float).eps:
+            std = newStd
+            break
+        std     = newStd
+        
+    return std
+
+
+class _VesselData:
+    """The attributes of a SELMADataObject that calculateParameters 
+    uses, filled with random vessels."""
+
+    def __init__(self, rng, settings, venc, shape = (64, 64), 
+                 nPhases = 20):
+        self._settings  = settings
+        self._venc      = venc
+        self._nPhases   = nPhases
+        
+        self._meanCorrectedVelocity     = np.round(rng.randn(*shape), 1)
+        self._correctedVelocityFrames   = rng.randn(nPhases, *shape) * 1.2
+        for name in ('_sigFlowPos', '_sigFlowNeg', '_sigMagPos', 
+                     '_sigMagNeg', '_sigMagIso'):
+            setattr(self, name, (rng.rand(*shape) > 0.4).astype(np.uint8))
+        
+        labels  = rng.randint(0, 30, shape)
+        self._lone_vessels      = [(labels == label).astype(np.uint8) 
+                                   for label in range(1, 30) 
+                                   if rng.rand() > 0.2]
+        self._included_vessels  = []
+        
+    def _readFromSettings(self, key, default = None):
+        return self._settings.get(key)
+    
+    def _getVoxelSeries(self, rows, columns):
+        return self._correctedVelocityFrames[:, rows, columns], None
+    
+    def getTags(self):
+        return {'venc': self._venc}
+    
+    @property
+    def _selmaDicom(self):
+        return self
+
+
+def _referenceObtainFilters(self):
+    """obtainFilters before the vectorisation."""
+    
+    if self._readFromSettings('AdvancedClustering'):
+        
+        PositiveMagnitude = self._readFromSettings('PositiveMagnitude')
+        NegativeMagnitude = self._readFromSettings('NegativeMagnitude')
+        IsointenseMagnitude = self._readFromSettings('IsointenseMagnitude')
+        
+        PositiveFlow = self._readFromSettings('PositiveFlow')
+        NegativeFlow = self._readFromSettings('NegativeFlow')
+        
+        self._Magnitude_filter = np.array([PositiveMagnitude, NegativeMagnitude, 
+                                     IsointenseMagnitude])
+        self._Flow_filter = np.array([PositiveFlow, NegativeFlow])
+    
+    meanVelocity    = self._meanCorrectedVelocity
+    
+    self._V_cardiac_cycle = np.zeros((len(self._lone_vessels),
+                                self._nPhases + 3))
+
+    self._Magnitudes = np.zeros((len(self._lone_vessels),3))
+    self._Flows = np.zeros((len(self._lone_vessels),2))
+
+    for idx, vessel in enumerate(self._lone_vessels):
+    
+        vesselCoords   = np.nonzero(vessel)
+
+        vessel_velocities = abs(meanVelocity[vesselCoords[0],
+                                             vesselCoords[1]])
+            
+        pidx = np.where(vessel_velocities == max(vessel_velocities))
+         
+        self._V_cardiac_cycle[idx,0] = vesselCoords[0][pidx[0][0]]
+        self._V_cardiac_cycle[idx,1] = vesselCoords[1][pidx[0][0]]
+        
+        self._Flows[idx,0] = round(self._sigFlowPos[vesselCoords[0][pidx[0][0]],
+                            vesselCoords[1][pidx[0][0]]],  4)
+        self._Flows[idx,1] = round(self._sigFlowNeg[vesselCoords[0][pidx[0][0]],
+                            vesselCoords[1][pidx[0][0]]],  4)
+        self._Magnitudes[idx,0] = round(self._sigMagPos[vesselCoords[0]
+                            [pidx[0][0]],vesselCoords[1][pidx[0][0]]],  4)
+        self._Magnitudes[idx,1] = round(self._sigMagNeg[vesselCoords[0]
+                            [pidx[0][0]],vesselCoords[1][pidx[0][0]]],  4)
+        self._Magnitudes[idx,2] = round(self._sigMagIso[vesselCoords[0]
+                            [pidx[0][0]],vesselCoords[1][pidx[0][0]]],  4)
+        
+        self._V_cardiac_cycle[idx,2] = idx + 1
+        
+        self._V_cardiac_cycle[
+        idx,3:self._V_cardiac_cycle.shape[1]] = self._getVoxelSeries(
+        [vesselCoords[0][pidx[0][0]]],
+        [vesselCoords[1][pidx[0][0]]])[0].ravel()
+
+
+def _referenceFilterVelocities(self):
+    """filterVelocities before the vectorisation."""
+      
+    if self._readFromSettings('BasalGanglia'):
+                        
+        self._V_cardiac_cycle = self._V_cardiac_cycle[np.intersect1d(
+        np.where(self._Flows[:,0] == 1)[0],
+        np.where(self._Magnitudes[:,0] == 1)[0]),:]
+    
+        self._included_vessels = [i for j, 
+        i in enumerate(self._lone_vessels) 
+        if j in np.intersect1d(np.where(self._Flows[:,0] == 1)[0]
+                               ,np.where(self._Magnitudes[:,0] == 1)[0])]
+
+    elif self._readFromSettings('SemiovalCentre'):
+ 
+        self._V_cardiac_cycle = self._V_cardiac_cycle[np.where(self._Flows[
+            :,1]  == 1)[0],:]
+    
+        self._included_vessels = [i for j, 
+        i in enumerate(self._lone_vessels) if j in np.where(self._Flows[:,1] 
+                                                            == 1)[0]]
+        
+    elif self._readFromSettings('AdvancedClustering'):
+    
+        selectedMagnitudes = np.where(self._Magnitude_filter == 1)[0]
+        selectedFlows = np.where(self._Flow_filter == 1)[0]
+        
+        self._V_cardiac_cycle = self._V_cardiac_cycle[np.intersect1d(
+            np.where(self._Flows[:,selectedFlows] == 1)[0], np.where(
+                self._Magnitudes[:,selectedMagnitudes] == 1)[0]),:]
+        
+        self._included_vessels = [i for j, 
+        i in enumerate(self._lone_vessels) 
+        if j in np.intersect1d(np.where(self._Flows[:,selectedFlows] == 1)[0],
+                    np.where(self._Magnitudes[:,selectedMagnitudes] == 1)[0])]
+
+
+def _referenceCalculateParameters(self):
+    """calculateParameters before the vectorisation, with a loop over the
+    vessels for the venc exclusion."""
+  
+    _referenceObtainFilters(self)
+    _referenceFilterVelocities(self)
+    
+    V_cardiac_cycle     = abs(self._V_cardiac_cycle)
+    venc                = self._selmaDicom.getTags()['venc']
+    keep                = []
+    for idx in range(V_cardiac_cycle.shape[0]):
+        if not np.any(V_cardiac_cycle[idx,3:self._nPhases + 3] > venc):
+            keep.append(idx)
+    
+    self._included_vessels = [self._included_vessels[idx] for idx in keep]
+    self._V_cardiac_cycle_included = V_cardiac_cycle[keep]
+    
+    _referenceSummariseVelocities(self, self._V_cardiac_cycle_included)
+
+
+def _referenceSummariseVelocities(self, V_cardiac_cycle):
+    """summariseVelocities before the vectorisation."""
+                
+    VmeanPerVesselList = np.zeros((V_cardiac_cycle.shape[0],1))
+    MeanCurveOverAllVessels = np.zeros((1,self._nPhases))
+    
+    NormMeanCurvePerVessel = np.zeros((V_cardiac_cycle.shape[0],
+                            self._nPhases))
+    normMeanCurveOverAllVessels = np.zeros((1,
+                                self._nPhases))
+
+    for i in range(0,V_cardiac_cycle.shape[0]):
+        
+       VmeanPerVesselList[i,0:V_cardiac_cycle.shape[0]] = np.mean(
+           V_cardiac_cycle[i,3:V_cardiac_cycle.shape[1]])
+       
+       MeanCurveOverAllVessels = MeanCurveOverAllVessels + np.squeeze((
+           V_cardiac_cycle[i,3:V_cardiac_cycle.shape[1]]/
+           (V_cardiac_cycle.shape[0])))
+       
+       NormMeanCurvePerVessel[i,0:self._nPhases] = V_cardiac_cycle[
+           i,3:V_cardiac_cycle.shape[1]]/np.mean(
+            V_cardiac_cycle[i,3:V_cardiac_cycle.shape[1]])
+       
+       # Velocity curves are first normalised and then averaged
+       normMeanCurveOverAllVessels = (normMeanCurveOverAllVessels + 
+        V_cardiac_cycle[i,3:V_cardiac_cycle.shape[1]]/np.mean(
+        V_cardiac_cycle[i,3:V_cardiac_cycle.shape[1]])/
+        (V_cardiac_cycle.shape[0]))
+         
+    # Compute mean velocity  
+    self._Vmean = np.mean(MeanCurveOverAllVessels)
+    
+    # Compute PI using normalised velocity curve of cardiac cycle averaged 
+    # over all vessels
+    self._PI_norm = (np.max(normMeanCurveOverAllVessels) - np.min(
+        normMeanCurveOverAllVessels))/np.mean(normMeanCurveOverAllVessels)
+    
+    # Compute standard error of the mean of Vmean (adapted from MATLAB)
+    allstdV = np.std(VmeanPerVesselList,ddof = 1)
+    self._allsemV = allstdV/np.sqrt(V_cardiac_cycle.shape[0])
+    
+    # Compute standard error of the mean of PI_norm (adapted from MATLAB)
+    allimaxV = np.where(normMeanCurveOverAllVessels == np.max(
+        normMeanCurveOverAllVessels))[1]
+    alliminV = np.where(normMeanCurveOverAllVessels == np.min(
+        normMeanCurveOverAllVessels))[1]
+    allstdnormV = np.std(NormMeanCurvePerVessel,ddof = 1,axis = 0)
+    allstdmaxV = allstdnormV[allimaxV];
+    allstdminV = allstdnormV[alliminV];
+    allsemmaxV = allstdmaxV/np.sqrt(V_cardiac_cycle.shape[0])
+    allsemminV = allstdminV/np.sqrt(V_cardiac_cycle.shape[0])
+    allcovarmaxminV = 0
+    self._allsemPI = np.sqrt(allsemmaxV**2 + allsemminV**2 - 2*
+                             allcovarmaxminV)[0]
+
+
+def main(argv = None):
+    """Runs every check and prints the results."""
+
+    parser  = argparse.ArgumentParser(description =
+                "Compares the vectorised analysis with the loops it "
+                "replaced.")
+    parser.add_argument("--trials", type = int, default = 20,
+                        help = "number of random data sets per check")
+    parser.add_argument("--seed", type = int, default = 0,
+                        help = "seed of the random data")
+    args    = parser.parse_args(argv)
+
+    failed  = False
+    for name, check in CHECKS:
+        rng         = np.random.RandomState(args.seed)
+        failures    = check(rng, args.trials)
+
+        if failures:
+            failed  = True
+            print("%-20s FAILED" % name)
+            for failure in failures:
+                print("    " + failure)
+        else:
+            print("%-20s OK" % name)
+
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""
+This static module contains the following functions:
+
++ :function:`segmentWhiteMatter`
++ :function:`fitGaussianMixture`
+
+The built-in white matter segmentation. It runs in-process on the T1 volume
+with SimpleITK and numpy, without MATLAB, SPM or temporary files:
+
+1. The head is separated from the background with a threshold relative to
+   the brightest voxels.
+2. The bias field is removed with N4 on a downsampled copy of the volume.
+3. The intensities in the head are classified in tissue classes with a
+   Gaussian mixture that is fitted with EM, starting from k-means.
+4. The probability of the brightest class is the white matter probability.
+   Bright tissue outside the brain, like the fat of the scalp, is removed
+   by only keeping the largest connected white matter region.
+
+"""
+
+# ====================================================================
+
+import numpy as np
+import SimpleITK as sitk
+
+# ====================================================================
+
+#Segmentation backends that can be selected in the settings
+BACKENDS            = ('sitk', 'spm')
+
+#Number of tissue classes in the head: CSF, grey matter and white matter
+NUM_CLASSES         = 3
+
+#Threshold of the head mask, as a fraction of the 99th percentile of the
+#intensities
+HEAD_THRESHOLD      = 0.1
+
+#Downsampling of the volume for the estimation of the bias field
+N4_SHRINK_FACTOR    = 4
+
+#Number of N4 iterations
+N4_ITERATIONS       = 50
+
+#Minimum distance in mm between the control points of the bias field. The
+#bias field of a thin slab of the T1 is fitted with fewer control points,
+#so they don't fit the contrast between the tissues.
+N4_CONTROL_SPACING  = 50.
+
+#Number of bins of the intensity histogram that the mixture is fitted to
+HISTOGRAM_BINS      = 512
+
+#Radius in voxels of the opening that disconnects the white matter from
+#bright tissue outside the brain
+OPENING_RADIUS      = 2
+
+def segmentWhiteMatter(volume, spacing = (1., 1., 1.),
+                       numClasses = NUM_CLASSES):
+    """
+    Segments the white matter in a T1 volume.
+
+    Args:
+        volume(numpy.ndarray): the T1 volume with the frames along the
+        first axis.
+        spacing(tuple): voxel spacing of the volume in mm along the
+        columns, rows and frames, in the order SimpleITK uses.
+        numClasses(int): number of tissue classes in the head.
+
+    Returns:
+        probability(numpy.ndarray): the white matter probability of every
+        voxel, between 0 and 1, with the same shape as volume.
+    """
+
+    image       = sitk.GetImageFromArray(np.asarray(volume,
+                                                    dtype = np.float32))
+    image.SetSpacing([float(s) for s in spacing])
+
+    #Head mask. The threshold doesn't depend on the amount of background,
+    #so a slab of the T1 is masked the same way as the whole volume.
+    threshold   = HEAD_THRESHOLD * np.percentile(volume, 99)
+    headMask    = sitk.BinaryThreshold(image, float(threshold), 
+                                       float(np.max(volume)), 1, 0)
+    headMask    = sitk.BinaryFillhole(headMask)
+
+    #Bias field correction
+    corrected   = _correctBiasField(image, headMask)
+
+    #Tissue classification
+    values      = sitk.GetArrayViewFromImage(corrected)
+    inside      = sitk.GetArrayViewFromImage(headMask) > 0
+
+    weights, means, stds    = fitGaussianMixture(values[inside], numClasses)
+    wmClass                 = int(np.argmax(means))
+
+    probability             = np.zeros(np.shape(volume), dtype = np.float64)
+    probability[inside]     = _posterior(values[inside], weights, means,
+                                         stds)[wmClass]
+
+    #Only keep the white matter of the brain
+    probability[~_getBrainRegion(probability)] = 0
+
+    return probability
+
+def fitGaussianMixture(values, numClasses, iterations = 100,
+                       tolerance = 1e-6):
+    """
+    Fits a one dimensional Gaussian mixture to the values with EM. The fit
+    starts from k-means clusters and is done on a histogram of the values,
+    so its cost doesn't depend on the number of values.
+
+    Args:
+        values(numpy.ndarray): the values.
+        numClasses(int): number of Gaussians.
+        iterations(int): maximum number of EM iterations.
+        tolerance(float): the fit stops when the log-likelihood per value
+        changes less than this.
+
+    Returns:
+        weights, means, stds(numpy.ndarray): the parameters of the
+        Gaussians, sorted on their means.
+    """
+
+    counts, edges   = np.histogram(values, HISTOGRAM_BINS)
+    centres         = (edges[:-1] + edges[1:]) / 2
+    counts          = counts.astype(np.float64)
+    binWidth        = edges[1] - edges[0]
+
+    #K-means on the histogram, starting from means spread evenly between
+    #the 1st and 99th percentile, so the start doesn't depend on how much
+    #of every tissue there is
+    cumulative      = np.cumsum(counts) / np.sum(counts)
+    low, high       = centres[np.searchsorted(cumulative, [0.01, 0.99])]
+    means           = np.linspace(low, high, numClasses)
+    for _ in range(iterations):
+        labels      = np.argmin(np.abs(centres[:, None] - means[None, :]),
+                                axis = 1)
+        newMeans    = np.array([np.average(centres[labels == k],
+                                           weights = counts[labels == k])
+                                if np.sum(counts[labels == k]) > 0
+                                else means[k]
+                                for k in range(numClasses)])
+        if np.allclose(newMeans, means):
+            break
+        means       = newMeans
+
+    labels          = np.argmin(np.abs(centres[:, None] - means[None, :]),
+                                axis = 1)
+    weights         = np.array([np.sum(counts[labels == k])
+                                for k in range(numClasses)]) / np.sum(counts)
+    stds            = np.array([np.sqrt(np.average(
+                                    (centres[labels == k] - means[k])**2,
+                                    weights = counts[labels == k]))
+                                if np.sum(counts[labels == k]) > 0
+                                else binWidth
+                                for k in range(numClasses)])
+    weights         = np.maximum(weights, 1e-6)
+    stds            = np.maximum(stds, binWidth)
+
+    #EM
+    previous        = -np.inf
+    for _ in range(iterations):
+        likelihoods     = _likelihoods(centres, weights, means, stds)
+        total           = np.maximum(np.sum(likelihoods, axis = 0), 1e-300)
+        responsibility  = likelihoods / total * counts
+
+        logLikelihood   = np.sum(counts * np.log(total)) / np.sum(counts)
+        if abs(logLikelihood - previous) < tolerance:
+            break
+        previous        = logLikelihood
+
+        classCounts     = np.maximum(np.sum(responsibility, axis = 1), 1e-12)
+        weights         = classCounts / np.sum(counts)
+        means           = np.sum(responsibility * centres, axis = 1) / \
+                            classCounts
+        stds            = np.sqrt(np.sum(responsibility *
+                                         (centres - means[:, None])**2,
+                                         axis = 1) / classCounts)
+        stds            = np.maximum(stds, binWidth)
+
+    order           = np.argsort(means)
+
+    return weights[order], means[order], stds[order]
+
+def _correctBiasField(image, headMask):
+    """Estimates the bias field with N4 on a downsampled copy of the image
+    and returns the image divided by the full resolution bias field."""
+
+    shrink          = [N4_SHRINK_FACTOR if size >= 4 * N4_SHRINK_FACTOR
+                       else 1 for size in image.GetSize()]
+    smallImage      = sitk.Shrink(image, shrink)
+    smallMask       = sitk.Shrink(headMask, shrink)
+
+    #B-spline of order 3 with at least one span in every direction
+    extent          = np.multiply(image.GetSize(), image.GetSpacing())
+    spans           = np.maximum(np.round(extent / N4_CONTROL_SPACING), 1)
+    
+    corrector       = sitk.N4BiasFieldCorrectionImageFilter()
+    corrector.SetMaximumNumberOfIterations([N4_ITERATIONS])
+    corrector.SetNumberOfControlPoints([int(n) + 3 for n in spans])
+    corrector.Execute(smallImage, smallMask)
+
+    logBiasField    = corrector.GetLogBiasFieldAsImage(image)
+
+    return image / sitk.Exp(logBiasField)
+
+def _likelihoods(values, weights, means, stds):
+    """Returns the weighted likelihood of the values for every Gaussian,
+    as a (numClasses, len(values)) array."""
+
+    diff    = (values[None, :] - means[:, None]) / stds[:, None]
+
+    return weights[:, None] * np.exp(-0.5 * diff**2) / \
+            (np.sqrt(2 * np.pi) * stds[:, None])
+
+def _posterior(values, weights, means, stds):
+    """Returns the probability of every class for every value."""
+
+    likelihoods = _likelihoods(values, weights, means, stds)
+    total       = np.sum(likelihoods, axis = 0)
+    total[total == 0] = 1
+
+    return likelihoods / total
+
+def _getBrainRegion(probability):
+    """Returns the largest connected region of white matter, after an
+    opening that separates it from bright tissue outside the brain,
+    dilated back to cover the edges of the white matter."""
+
+    wm          = sitk.GetImageFromArray((probability >= 0.5).astype(np.uint8))
+    opened      = sitk.BinaryMorphologicalOpening(wm, [OPENING_RADIUS] * 3)
+    components  = sitk.RelabelComponent(sitk.ConnectedComponent(opened))
+    largest     = sitk.BinaryThreshold(components, 1, 1, 1, 0)
+    region      = sitk.BinaryDilate(largest, [OPENING_RADIUS + 1] * 3)
+
+    region      = sitk.GetArrayFromImage(region) > 0
+    if not np.any(region):
+        #Nothing to select from, keep everything
+        region[:]   = True
+
+    return region
@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+
+"""
+This module contains the parameter sweep of the vessel analysis, with the
+following functions:
+
++ :function:`sweepScan`
++ :function:`sweepDirectory`
++ :function:`getGridPoints`
++ :function:`getFirstStage`
++ :function:`getSweepGrid`
++ :function:`checkSweepGrid`
++ :function:`parseValues`
++ :function:`writeSweepResults`
+
+A sweep analyses a scan once for every combination of the values of the
+swept settings. The combinations are run in the order in which the settings
+of the early stages of the analysis change the least, and every run starts
+at the first stage that uses a setting that changed (see
+SELMAData.STAGE_STATISTICS). So the median images and SNR are computed once
+per median filter diameter, and the significant voxels, masks and clusters
+once per confidence interval. The results are collected in a table with one
+row per combination and scan.
+
+A folder of scans is swept from the GUI with Analyse > Parameter Sweep,
+with the values in the Sweep tab of the settings. Without the GUI run:
+
+    python SELMASweep.py scan.dcm --grid medDiam=9,11 ratioThresh=2,3
+
+The other settings are the saved settings of the GUI.
+
+"""
+
+# ====================================================================
+
+import argparse
+import csv
+import itertools
+import os
+import sys
+import traceback
+
+from PyQt5 import QtCore
+
+# ====================================================================
+
+import SELMAData
+import SELMADataIO
+import SELMAGUISettings
+import SELMABatchAnalysis
+import SELMADataModels
+
+# ====================================================================
+
+#Settings that can be swept and the stage of the analysis that uses them,
+#from the first stage to the last
+SWEEP_SETTINGS  = (('medDiam',           SELMAData.STAGE_STATISTICS),
+                   ('confidenceInter',   SELMAData.STAGE_SIGNIFICANCE),
+                   ('ratioThresh',       SELMAData.STAGE_NON_PERP),
+                   ('deduplicateRange',  SELMAData.STAGE_VESSELS))
+
+#Columns of the results table and the key in the velocityDict they come
+#from. Results that weren't computed with the settings are left empty.
+SWEEP_METRICS   = (('nDetected',        'No. detected vessels'),
+                   ('nPerpendicular',   'No. perpendicular vessels'),
+                   ('nLone',            'No. lone vessels'),
+                   ('nIncluded',        'No. included vessels'),
+                   ('Vmean',            'Vmean vessels'),
+                   ('PI_norm',          'PI_norm vessels'),
+                   ('VmeanSEM',         'Vmean SEM'),
+                   ('PI_normSEM',       'PI_norm SEM'),
+                   ('VmeanCILow',       'Vmean CI low'),
+                   ('VmeanCIHigh',      'Vmean CI high'),
+                   ('PI_normCILow',     'PI_norm CI low'),
+                   ('PI_normCIHigh',    'PI_norm CI high'))
+
+
+def sweepScan(self, grid, cancelEvent = None):
+    """
+    Runs the vessel analysis of a scan for every combination of the values
+    in the grid. No results are written to disk, and the saved settings
+    are not changed.
+
+    Args:
+        self(SELMADataObject): the scan, with its mask.
+        grid(dict): list of values of every swept setting, see
+        SWEEP_SETTINGS.
+        cancelEvent(threading.Event): when set, the sweep stops at the
+        start of the next stage by raising AnalysisCancelled.
+
+    Returns:
+        rows(list): dictionary with the scan, settings and results of every
+        combination, or None if the scan can't be analysed.
+    """
+
+    if cancelEvent is not None:
+        self._cancelEvent = cancelEvent
+
+    if not self._checkAnalysisSettings():
+        return None
+
+    if self._mask is None:
+        self._signalObject.errorMessageSignal.emit("No mask loaded.")
+        return None
+
+    #Slices of a multi-slice scan are analysed separately
+    multiSlice      = self._selmaDicom.getNumSlices() > 1
+    if multiSlice:
+        sliceObjects    = self._createSliceObjects()
+        if sliceObjects is None:
+            return None
+    else:
+        sliceObjects    = [self]
+
+    mask            = self._mask
+    sliceMasks      = [sliceObject._mask for sliceObject in sliceObjects]
+
+    rows            = []
+    previous        = None
+
+    try:
+        for point in getGridPoints(grid):
+            firstStage  = getFirstStage(previous, point)
+            self._settingsOverrides.update(point)
+
+            #The mask is changed by the significance stage
+            if firstStage <= SELMAData.STAGE_SIGNIFICANCE:
+                for sliceObject, sliceMask in zip(sliceObjects, sliceMasks):
+                    sliceObject._mask   = sliceMask
+
+            if multiSlice:
+                self._runSlices(sliceObjects, firstStage)
+                self._combineSlices(sliceObjects)
+                velocityDict    = self._velocityDict[0]
+            else:
+                self._runPipeline(firstStage)
+                velocityDict    = self._makeVelocityDict()
+
+            row             = dict()
+            row['scan']     = self._dcmFilename
+            row.update(point)
+
+            for column, key in SWEEP_METRICS:
+                value       = velocityDict.get(key)
+                if isinstance(value, list):
+                    #Semioval centre, non-perpendicular vessels aren't
+                    #removed
+                    value   = len(value)
+                row[column] = value
+
+            rows.append(row)
+            previous        = point
+
+    finally:
+        self._settingsOverrides.clear()
+        self._mask  = mask
+
+    return rows
+
+
+def sweepDirectory(dirName, files, grid, self, cancelEvent = None,
+                   batchControl = None):
+    """
+    Sweeps all enhanced dicoms in dirName that have a mask, see
+    SELMABatchAnalysis.EnhancedBatchAnalysis. The results of all scans are
+    written to sweepResults.csv in the folder, after every scan. Runs in an
+    AnalysisWorker of the data model (self).
+
+    Args:
+        dirName(str): path to the directory.
+        files(list): the files in the directory.
+        grid(dict): list of values of every swept setting.
+        self(SelmaDataModel): the data model that started the sweep.
+        cancelEvent(threading.Event): cancellation token of the analysis.
+        batchControl(BatchControl): used to pause or stop the sweep.
+    """
+
+    if batchControl is None:
+        batchControl = SELMABatchAnalysis.BatchControl()
+
+    dcms    = [file for file in files
+               if file.find(".dcm") != -1 and file.find("mask") == -1]
+    total   = len(dcms)
+
+    if not dcms:
+        self.signalObject.errorMessageSignal.emit(
+             "No DICOM files found in folder. The sweep will be stopped.")
+        return
+
+    outputName  = dirName + '/sweepResults.csv'
+    rows        = []
+    done        = 0
+
+    for dcm in dcms:
+
+        if not batchControl.waitForNextScan(cancelEvent):
+            break
+
+        self.signalObject.batchProgressSignal.emit(done, total, dcm)
+
+        try:
+            scanRows    = _sweepDirectoryScan(dirName, files, dcm, grid, 
+                                              self, cancelEvent)
+        except SELMAData.AnalysisCancelled:
+            raise
+        except Exception as e:
+            traceback.print_exc()
+            self.signalObject.batchFailedSignal.emit(dcm, str(e))
+            scanRows    = None
+            
+        if scanRows:
+            rows   += scanRows
+            writeSweepResults(rows, outputName)
+
+        done       += 1
+
+    self.signalObject.batchProgressSignal.emit(done, total, "")
+    self.signalObject.setProgressBarSignal.emit(int(100))
+
+    if done < total:
+        self.signalObject.setProgressLabelSignal.emit(
+                "Sweep stopped after %.0f out of %.0f scans" %(done, total))
+    else:
+        self.signalObject.setProgressLabelSignal.emit("Sweep complete!")
+
+
+def _sweepDirectoryScan(dirName, files, dcm, grid, self, cancelEvent):
+    """Sweeps a single scan of sweepDirectory. The scan gets its own 
+    SELMADataObject and signals, so the scan that is shown in the GUI is
+    not changed. Returns the rows of the scan, or None if it has no 
+    mask."""
+    
+    sdo         = SELMAData.SELMADataObject(
+                        SELMABatchAnalysis.createScanSignals(
+                            self.signalObject),
+                        dcmFilename = dirName + '/' + dcm,
+                        classic = False)
+
+    maskFile    = SELMABatchAnalysis.findMaskFile(files, dcm)
+    if maskFile is None:
+        self.signalObject.infoMessageSignal.emit(
+         "Mask of %s not found in folder. Moving to next scan" %(dcm))
+        return None
+
+    try:
+        sdo.setMask(SELMADataIO.loadMask(dirName + '/' + maskFile))
+    except:
+        self.signalObject.errorMessageSignal.emit(
+            "The mask of %s can't be read. Moving on to next scan."
+            %(dcm))
+        return None
+
+    return sweepScan(sdo, grid, cancelEvent)
+
+
+def getGridPoints(grid):
+    """
+    Returns all combinations of the values in the grid. The settings of the
+    last stages change first, so consecutive combinations share as many
+    stages as possible.
+
+    Args:
+        grid(dict): list of values of every swept setting.
+
+    Returns:
+        points(list): dictionary with the value of every swept setting, for
+        every combination.
+    """
+
+    keys    = [key for key, _ in SWEEP_SETTINGS if grid.get(key)]
+
+    return [dict(zip(keys, values))
+            for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def getFirstStage(previous, point):
+    """
+    Returns the first stage of the analysis that has to be run again for
+    a combination of settings, after the previous combination.
+
+    Args:
+        previous(dict): the previous combination, or None for the first.
+        point(dict): the combination that is run next.
+
+    Returns:
+        stage(int): the first stage, see SELMAData.STAGE_STATISTICS.
+    """
+
+    if previous is None:
+        return SELMAData.STAGE_STATISTICS
+
+    stages  = [stage for key, stage in SWEEP_SETTINGS
+               if key in point and point[key] != previous.get(key)]
+
+    return min(stages, default = SELMAData.STAGE_VESSELS)
+
+
+def getSweepGrid():
+    """
+    Returns the grid in the Sweep tab of the settings.
+
+    Returns:
+        grid(dict): list of values of every swept setting. Settings without
+        values aren't swept.
+
+    Raises:
+        ValueError: if a value isn't a number or isn't allowed, see 
+        checkSweepGrid.
+    """
+
+    settings            = _getSettings()
+
+    grid    = dict()
+    for key, _ in SWEEP_SETTINGS:
+        text        = settings.value(getSweepSettingName(key))
+        if text:
+            try:
+                grid[key]   = parseValues(text)
+            except ValueError:
+                raise ValueError("The sweep values of %s have to be " %(key) +
+                                 "numbers separated by commas.")
+
+    checkSweepGrid(grid)
+
+    return grid
+
+
+def checkSweepGrid(grid):
+    """
+    Checks the swept values with the rules of the settings window: the 
+    median filter diameter is an integer, and odd unless it is in mm, the
+    confidence interval is between 0 and 1, and the ratio threshold and 
+    deduplication range are not negative.
+
+    Args:
+        grid(dict): list of values of every swept setting.
+
+    Raises:
+        ValueError: with a message for the user, if a value isn't allowed.
+    """
+
+    #Settings that were just saved are read back as a bool
+    mmPixel     = _getSettings().value('mmPixel') in (True, 'true')
+
+    for value in grid.get('medDiam', []):
+        if value != int(value):
+            raise ValueError("Median filter diameter has to be an integer.")
+        if int(value) %2 == 0 and not mmPixel:
+            raise ValueError("Median filter diameter has to be an odd " +
+                             "number of pixels.")
+
+    for value in grid.get('confidenceInter', []):
+        if value <= 0 or value >= 1:
+            raise ValueError("Confidence interval has to be between 0 " +
+                             "and 1.")
+
+    for value in grid.get('ratioThresh', []):
+        if value < 0:
+            raise ValueError("Ratio threshold has to be > 0.")
+
+    for value in grid.get('deduplicateRange', []):
+        if value < 0:
+            raise ValueError("Deduplication range has to be > 0.")
+
+
+def _getSettings():
+    """Returns the saved settings of the GUI."""
+
+    COMPANY, APPNAME, _ = SELMAGUISettings.getInfo()
+    COMPANY             = COMPANY.split()[0]
+    APPNAME             = APPNAME.split()[0]
+
+    return QtCore.QSettings(COMPANY, APPNAME)
+
+
+def getSweepSettingName(key):
+    """Returns the name of the setting with the swept values of a
+    setting, e.g. sweepMedDiam for medDiam."""
+
+    return 'sweep' + key[0].upper() + key[1:]
+
+
+def parseValues(text):
+    """
+    Reads a list of values that are separated by commas.
+
+    Args:
+        text(str): the values, e.g. '9, 11, 13'.
+
+    Returns:
+        values(list): the values as floats.
+
+    Raises:
+        ValueError: if a value isn't a number.
+    """
+
+    return [float(value) for value in text.split(',') if value.strip()]
+
+
+def writeSweepResults(rows, fname):
+    """
+    Writes the results of a sweep to a .csv file with one row per scan and
+    combination of settings.
+
+    Args:
+        rows(list): the rows returned by sweepScan.
+        fname(str): path to the .csv file.
+    """
+
+    columns = ['scan'] + [key for key, _ in SWEEP_SETTINGS
+                          if any(key in row for row in rows)]
+    columns += [column for column, _ in SWEEP_METRICS]
+
+    with open(fname, 'w', newline = '') as f:
+        writer  = csv.DictWriter(f, columns, restval = '')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: '' if value is None else value
+                             for key, value in row.items()})
+
+
+def main(argv = None):
+    """Sweeps the scans given on the command line."""
+
+    parser  = argparse.ArgumentParser(description =
+                "Runs the vessel analysis for every combination of the " +
+                "values of the swept settings.")
+    parser.add_argument("scans", nargs = "+",
+                        help = "enhanced dicoms of the scans.")
+    parser.add_argument("--mask",
+                        help = "mask used for all scans. By default the " +
+                        "mask in the folder of every scan is used, as in " +
+                        "the batch analysis.")
+    parser.add_argument("--grid", nargs = "+", default = [],
+                        metavar = "SETTING=VALUES",
+                        help = "values of a setting, e.g. medDiam=9,11. " +
+                        "By default the values in the Sweep tab of the " +
+                        "settings are used. Settings: " +
+                        ", ".join(key for key, _ in SWEEP_SETTINGS) + ".")
+    parser.add_argument("--output", default = "sweepResults.csv",
+                        help = "path to the results table.")
+    args    = parser.parse_args(argv)
+
+    grid    = dict()
+    for item in args.grid:
+        key, _, text    = item.partition('=')
+        if key not in dict(SWEEP_SETTINGS):
+            parser.error("%s can't be swept." %(key))
+        try:
+            grid[key]   = parseValues(text)
+        except ValueError:
+            parser.error("The values of %s have to be numbers." %(key))
+            
+    #The settings and signals need an application
+    app             = (QtCore.QCoreApplication.instance() or
+                       QtCore.QCoreApplication(sys.argv[:1]))
+
+    try:
+        if args.grid:
+            checkSweepGrid(grid)
+        else:
+            grid    = getSweepGrid()
+    except ValueError as e:
+        parser.error(str(e))
+
+    if not any(grid.values()):
+        parser.error("No values to sweep.")
+    signalObject    = SELMADataModels.SDMSignals()
+    signalObject.errorMessageSignal.connect(
+        lambda message: print(message, file = sys.stderr))
+    signalObject.infoMessageSignal.connect(
+        lambda message: print(message, file = sys.stderr))
+
+    rows    = []
+    for scan in args.scans:
+        try:
+            scanRows    = _sweepCommandLineScan(scan, args.mask, grid,
+                                                signalObject)
+        except Exception as e:
+            traceback.print_exc()
+            print("%s failed, moving to next scan: %s" %(scan, e),
+                  file = sys.stderr)
+            continue
+
+        if scanRows:
+            rows   += scanRows
+            writeSweepResults(rows, args.output)
+            print("%s: %.0f combinations" %(scan, len(scanRows)))
+
+
+def _sweepCommandLineScan(scan, maskFile, grid, signalObject):
+    """Sweeps a single scan of main, with the given mask or the mask in 
+    the folder of the scan. Returns the rows of the scan, or None if it 
+    has no mask."""
+
+    if maskFile is None:
+        dirName     = os.path.dirname(os.path.abspath(scan))
+        maskFile    = SELMABatchAnalysis.findMaskFile(
+                            os.listdir(dirName), os.path.basename(scan))
+        if maskFile is not None:
+            maskFile    = os.path.join(dirName, maskFile)
+
+    if maskFile is None:
+        print("Mask of %s not found. Moving to next scan." %(scan),
+              file = sys.stderr)
+        return None
+
+    sdo         = SELMAData.SELMADataObject(signalObject,
+                                            dcmFilename = scan,
+                                            classic = False)
+    sdo.setMask(SELMADataIO.loadMask(maskFile))
+
+    return sweepScan(sdo, grid)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+This static module contains the following functions:
+
++ :function:`getCacheDir`
++ :function:`hashFile`
++ :function:`getPlaneKey`
++ :function:`load`
++ :function:`save`
++ :function:`clear`
+
+The cache stores the results of the T1 processing on disk: the T1 slice
+interpolated on the pca plane, the interpolated white matter probability
+slice and the full segmentation volume. Entries are found with the hash of
+the contents of the T1 file, and for the interpolated slices also with the
+geometry of the pca plane. The same T1 paired with another scan of the
+same plane, or loaded again later, doesn't have to be read, segmented or
+interpolated again.
+
+Floating point arrays are stored as float32. The cache is limited to 
+MAX_CACHE_SIZE bytes; the entries that were used least recently are 
+removed first.
+
+"""
+
+# ====================================================================
+
+import os
+import shutil
+import hashlib
+import threading
+import numpy as np
+
+from PyQt5 import QtCore
+
+# ====================================================================
+
+#Size of the blocks in which a file is read for hashing
+HASH_BLOCK_SIZE = 1 << 20
+
+#Maximum size of the cache on disk in bytes
+MAX_CACHE_SIZE  = 2 << 30
+
+#Hashes of the files that were read, per (filename, size, mtime)
+_fileHashes     = dict()
+_lock           = threading.Lock()
+
+def getCacheDir():
+    """
+    Returns the directory in which the cache is stored.
+
+    Returns:
+        path(str): the SELMA/T1 subdirectory of the cache location of the
+        user.
+    """
+
+    location = QtCore.QStandardPaths.writableLocation(
+                            QtCore.QStandardPaths.GenericCacheLocation)
+    return os.path.join(location, "SELMA", "T1")
+
+def hashFile(fname):
+    """
+    Returns the SHA-1 hash of the contents of a file. The hash is only
+    computed once for every version of the file in a session.
+
+    Args:
+        fname(str): path to the file.
+
+    Returns:
+        hash(str): hexadecimal SHA-1 hash of the contents of the file.
+    """
+
+    stat    = os.stat(fname)
+    key     = (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+
+    with _lock:
+        if key in _fileHashes:
+            return _fileHashes[key]
+
+    sha1    = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha1.update(block)
+
+    with _lock:
+        _fileHashes[key] = sha1.hexdigest()
+
+    return _fileHashes[key]
+
+def getPlaneKey(Mpca, pcaShape):
+    """
+    Returns a key for the geometry of a pca plane.
+
+    Args:
+        Mpca(numpy.ndarray): transformation matrix of the pca, see
+        SELMAInterpolate.getTransMatrix.
+        pcaShape(tuple): shape of the pixel array of the pca.
+
+    Returns:
+        key(str): hexadecimal SHA-1 hash of the geometry. The matrix is
+        rounded, so rounding errors in the headers don't change the key.
+    """
+
+    sha1    = hashlib.sha1()
+    sha1.update(np.round(np.asarray(Mpca, dtype = np.float64), 6).tobytes())
+    sha1.update(np.asarray(pcaShape, dtype = np.int64).tobytes())
+
+    return sha1.hexdigest()
+
+def load(t1Hash, name, planeKey = None):
+    """
+    Loads an entry from the cache.
+
+    Args:
+        t1Hash(str): hash of the T1 file, see hashFile.
+        name(str): name of the entry, e.g. 'segmentation'.
+        planeKey(str): key of the pca plane for entries that are
+        interpolated on it, see getPlaneKey.
+
+    Returns:
+        array(numpy.ndarray): the cached array, or None if it isn't in the
+        cache or can't be read.
+    """
+
+    path    = _getPath(t1Hash, name, planeKey)
+    try:
+        array   = np.load(path)
+    except (OSError, ValueError):
+        return None
+
+    #Mark the entry as used, for the size limit
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    return array
+
+def save(t1Hash, name, array, planeKey = None):
+    """
+    Stores an entry in the cache. The cache is an optimisation, so an entry
+    that can't be written is skipped. Floating point arrays are stored as
+    float32.
+
+    Args:
+        t1Hash(str): hash of the T1 file, see hashFile.
+        name(str): name of the entry, e.g. 'segmentation'.
+        array(numpy.ndarray): the array to store.
+        planeKey(str): key of the pca plane for entries that are
+        interpolated on it, see getPlaneKey.
+
+    Returns:
+        array(numpy.ndarray): the array as it is stored, so the result is
+        the same as when it is loaded from the cache later.
+    """
+
+    array   = np.asarray(array)
+    if np.issubdtype(array.dtype, np.floating):
+        array   = array.astype(np.float32)
+
+    path    = _getPath(t1Hash, name, planeKey)
+    tmpPath = "%s.%d.%d.tmp" %(path, os.getpid(), threading.get_ident())
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(tmpPath, "wb") as f:
+            np.save(f, array)
+
+        #Readers never see a partly written entry
+        os.replace(tmpPath, path)
+    except OSError:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+    _limitSize(MAX_CACHE_SIZE)
+
+    return array
+
+def clear():
+    """Removes all entries from the cache."""
+
+    with _lock:
+        shutil.rmtree(getCacheDir(), ignore_errors = True)
+
+def _getPath(t1Hash, name, planeKey):
+    """Returns the path to the file of an entry."""
+
+    if planeKey is not None:
+        name    = name + "_" + planeKey
+
+    return os.path.join(getCacheDir(), t1Hash, name + ".npy")
+
+def _limitSize(maxSize):
+    """Removes the entries that were used least recently until the cache
+    is at most maxSize bytes."""
+
+    with _lock:
+        entries = []
+        for dirPath, _, fileNames in os.walk(getCacheDir()):
+            for fileName in fileNames:
+                if not fileName.endswith(".npy"):
+                    continue
+                path    = os.path.join(dirPath, fileName)
+                try:
+                    stat    = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        size    = sum(entry[1] for entry in entries)
+        for _, entrySize, path in sorted(entries):
+            if size <= maxSize:
+                break
+            try:
+                os.remove(path)
+                size   -= entrySize
+            except OSError:
+                continue
+
+            #Remove the directory of a T1 without entries
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
@@ -11,11 +11,17 @@ This module contains the following classes:
 
 import SELMADicom
 import SELMAInterpolate
+import SELMAT1Cache
+import SELMASegment
 
 import pydicom
 import SimpleITK as sitk
 import numpy as np
-#import matlab.engine
+
+#Version of each segmentation backend. Raise it when a segmentation 
+#changes, so the segmentations of an older version in the cache are not used.
+SEGMENTATION_VERSIONS   = {'sitk': 2,
+                           'spm':  1}
 
 
 class SELMAT1Dicom(SELMADicom.SELMADicom):
@@ -23,13 +29,23 @@ class SELMAT1Dicom(SELMADicom.SELMADicom):
     This class deals with t1 segmentation
     """
 
-    def __init__(self, dcmFilename, pcaDcm):
+    def __init__(self, dcmFilename, pcaDcm, slabMargin = None):
         """
-        Load & rescale the T1 & interpolate correct slice
+        Load & rescale the T1 & interpolate correct slice. Only the headers
+        are read when the slice is in the cache.
+        
+        Args:
+            dcmFilename(str): path to the T1 dicom.
+            pcaDcm(pydicom.Dataset): the header of the pca dicom.
+            slabMargin(float): if given, only the part of the T1 around the
+            pca plane, plus this margin in mm, is read and segmented. 
+            Otherwise the whole volume is used.
         """
         self._dcmFilename = dcmFilename
-        self._dcm = pydicom.dcmread(self._dcmFilename)
+        self._dcm = pydicom.dcmread(self._dcmFilename,
+                                    stop_before_pixels = True)
         self._pcaDcm = pcaDcm
+        self._slabMargin = slabMargin
 
         #############################################################
         # Declare some variables for use in interpolating / segmenting
@@ -44,10 +60,22 @@ class SELMAT1Dicom(SELMADicom.SELMADicom):
         # interpolating properties
         self._M             = None
             #transformation matrix between this T1 & pca
+        self._samplingGrids = dict()
+            #locations of the pca slice per shape and start of the resliced
+            #volume
+        self._slab          = None
+            #slices of the ordered magnitude volume that are loaded
+
+        # cache properties
+        self._t1Hash        = SELMAT1Cache.hashFile(self._dcmFilename)
+        self._planeKey      = None
+            #key of the geometry of the pca plane
 
         # Segmentation properties
         self._maskSlice     = None
         self._segmentation  = None
+        self._backend       = None
+            #segmentation backend that made the mask slice
 
         #############################################################
 
@@ -56,27 +84,34 @@ class SELMAT1Dicom(SELMADicom.SELMADicom):
         self.findMagnitudeFrames()
 
         # Interpolate the t1 slice
-        self.orderFramesOnPosition()
         self.interpolateT1()
 
     '''Public'''
 
-    def getSegmentationMask(self):
+    def getSegmentationMask(self, backend = "sitk"):
         """
         Walks through the various functions for constructing a T1 segmentation.
         
+        With the 'sitk' backend:
+        -Segment the white matter in-process, see SELMASegment
+        
+        With the 'spm' backend:
         -Find libraries (SPM & dcm2nii)
         -Launch matlab engine
         -Run matlab script to convert to .nii & segment
         -Remove unnecessary files
+        
         -Interpolate segmentation slice from brainmask           
+        
+        Args:
+            backend(str): 'sitk' or 'spm'.
             
         Returns:
             self._segmentation; the interpolated slice of the brainmask
         """
         
-        if self._maskSlice is None:
-            self.segmentAndInterpolateMask()
+        if self._maskSlice is None or self._backend != backend:
+            self.segmentAndInterpolateMask(backend)
         
         return self._maskSlice
 
@@ -104,7 +139,7 @@ class SELMAT1Dicom(SELMADicom.SELMADicom):
         self._magFrameIndex = []
 
         if 'philips' in self._manufacturer.lower():
-            for i in range(len(self._dcm.pixel_array)):
+            for i in range(int(self._dcm.NumberOfFrames)):
                 dcmFrameAddress = 0x5200, 0x9230
                 dcmPrivateCreatorAddress = 0x2005, 0x140f
                 dcmImageTypeAddress = 0x0008, 0x0008
@@ -118,54 +153,202 @@ class SELMAT1Dicom(SELMADicom.SELMADicom):
                     # other manufacturers
                     
         else:
-            self._magFrameIndex     = np.ones(self._dcm.pixel_array.shape[0])
+            self._magFrameIndex     = np.arange(int(self._dcm.NumberOfFrames))
 
-        self._frames = self._dcm.pixel_array[self._magFrameIndex]
-        self._numFrames = len(self._frames)
+        self._numFrames = len(self._magFrameIndex)
+
+    def loadFrames(self):
+        """
+            Reads the magnitude frames of the slab, ordered on position. 
+            Uncompressed pixel data is read directly from the file, so only
+            the slab is read. Compressed pixel data is decoded completely.
+        """
+        
+        if self._slab is None:
+            self.findSlab()
+        
+        frames, rows, columns   = self._slab
+        indices                 = np.asarray(self._magFrameIndex)\
+                                    [self.getFrameOrder()][frames]
+
+        header, rawFrames       = SELMADicom.openRawFrames(self._dcmFilename)
+        if rawFrames is None:
+            rawFrames           = pydicom.dcmread(
+                                        self._dcmFilename).pixel_array
+        
+        self._frames    = np.array(rawFrames[indices, rows, columns])
 
     ######################################################################
     # Functions dealing with the segmentation & interpolation of T1 & mask
 
-    def orderFramesOnPosition(self):
+    def getFrameOrder(self):
         '''
-        Looks at the order the frames are in and sorts them if they are not 
-        continuously increasing to the left
+        Returns the order of the magnitude frames that sorts them on their
+        position, continuously increasing to the left.
         '''
         
-        LRPos   = []
-        for idx in self._magFrameIndex:
-            pos     = self._dcm.PerFrameFunctionalGroupsSequence[idx].\
-                                             PlanePositionSequence[0].\
-                                              ImagePositionPatient[0]
-            LRPos.append(float(pos))                                              
+        positions   = SELMAInterpolate.getGeometry(self._dcm).positions
+        LRPos       = positions[np.asarray(self._magFrameIndex), 0]
             
-        order           = np.argsort(LRPos)
-        order           = order[::-1]
-        orderedFrames   = self._frames[order,:,:]
+        order       = np.argsort(LRPos)
+        order       = order[::-1]
         
-        self._frames    = orderedFrames
+        return order
+    
+    def findSlab(self):
+        '''
+        Finds the part of the ordered magnitude volume that is needed to 
+        interpolate the pca slice: the bounding box of the pca slice in the
+        T1 volume, plus the slab margin on every side. The whole volume is
+        used when there is no slab margin, or when the pca slice doesn't 
+        intersect the T1.
+        '''
         
+        shape       = self._getVolumeShape()
+        self._slab  = tuple(slice(0, size) for size in shape)
+        
+        if self._slabMargin is None:
+            return
+        
+        grid        = SELMAInterpolate.getSamplingGrid(self._M, shape,
+                                                       self._getPcaShape())
+        if grid.coordinates.shape[1] == 0:
+            return
+        
+        geometry    = SELMAInterpolate.getGeometry(self._dcm)
+        spacing     = np.array([geometry.sliceThickness,
+                                geometry.pixelSpacing[0],
+                                geometry.pixelSpacing[1]], dtype = float)
+        margin      = np.ceil(self._slabMargin / spacing)
+        
+        #The interpolation uses the voxels on both sides of every location
+        lower       = np.floor(np.min(grid.coordinates, axis = 1)) - margin
+        upper       = np.floor(np.max(grid.coordinates, axis = 1)) + 2 + \
+                        margin
+        lower       = np.maximum(lower, 0).astype(int)
+        upper       = np.minimum(upper, shape).astype(int)
+        
+        self._slab  = tuple(slice(start, stop) 
+                            for start, stop in zip(lower, upper))
+    
+    def _getVolumeShape(self):
+        '''
+        Returns the shape of the complete magnitude volume.
+        '''
+        
+        return (self._numFrames, 
+                int(self._dcm.Rows),
+                int(self._dcm.Columns))
+        
+    def _getPcaShape(self):
+        '''
+        Returns the shape of the pixel array of the pca dicom, read from the
+        header so the pixel data does not have to be decoded.
+        '''
+        
+        return (int(self._pcaDcm.NumberOfFrames),
+                int(self._pcaDcm.Rows),
+                int(self._pcaDcm.Columns))
     
     def interpolateT1(self):
         '''
         Interpolates a slice in the T1 image to match with the pca slice.
+        The slice is taken from the cache if this T1 was interpolated on 
+        the same plane before.
         '''
         
         #First, construct the 
         Mpca, Rpca  = SELMAInterpolate.getTransMatrix(self._pcaDcm)
         Mt1, Rt1    = SELMAInterpolate.getTransMatrix(self._dcm)
         self._M     = np.dot(np.linalg.inv(Mt1), Mpca)
-        pcaShape    = self._pcaDcm.pixel_array.shape
         
-        self._t1Slice   = SELMAInterpolate.doInterpolation(self._M,
-                                                           self._frames,
-                                                           pcaShape)
+        self._planeKey  = SELMAT1Cache.getPlaneKey(Mpca, self._getPcaShape())
+        self._t1Slice   = SELMAT1Cache.load(self._t1Hash, "t1Slice",
+                                            self._planeKey)
+        if self._t1Slice is not None:
+            return
+        
+        self.loadFrames()
+        self._t1Slice   = SELMAT1Cache.save(self._t1Hash, "t1Slice",
+                                            self._reslice(self._frames,
+                                                          self._slab),
+                                            self._planeKey)
         
-    def segmentAndInterpolateMask(self):
+    def segmentAndInterpolateMask(self, backend = "sitk"):
         '''
-        Calls the matlab code that runs the SPM segmentation on the t1 dicom.
-        Loads and interpolates the resulting WM mask.
+        Segments the white matter in the t1 dicom with the built-in 
+        SimpleITK segmentation, or calls the matlab code that runs the SPM 
+        segmentation. Loads and interpolates the resulting WM mask.
+        
+        The segmentation of this T1 and its interpolated slice on the pca
+        plane are taken from the cache when they were made before with the
+        same backend. The built-in segmentation only segments the slab, so
+        with a slab margin its segmentation is cached per pca plane.
+        
+        Args:
+            backend(str): 'sitk' or 'spm'.
+        '''
+        
+        name            = "%s-v%d" % (backend, SEGMENTATION_VERSIONS[backend])
+        slab            = None
+        segmentationKey = None
+        if backend != "spm" and self._slabMargin is not None:
+            if self._slab is None:
+                self.findSlab()
+            name            = "%s-slab%g" %(name, self._slabMargin)
+            slab            = self._slab
+            segmentationKey = self._planeKey
+        
+        self._backend   = backend
+        self._maskSlice = SELMAT1Cache.load(self._t1Hash, 
+                                            "maskSlice-" + name,
+                                            self._planeKey)
+        if self._maskSlice is not None:
+            return
+        
+        self._segmentation = SELMAT1Cache.load(self._t1Hash, 
+                                               "segmentation-" + name,
+                                               segmentationKey)
+        if self._segmentation is None:
+            if backend == "spm":
+                segmentation    = self._segmentSPM()
+            else:
+                segmentation    = self._segmentSITK()
+            self._segmentation  = SELMAT1Cache.save(self._t1Hash, 
+                                                    "segmentation-" + name,
+                                                    segmentation, 
+                                                    segmentationKey)
+
+        # Create interpolated slice
+        self._maskSlice = SELMAT1Cache.save(self._t1Hash, 
+                                            "maskSlice-" + name,
+                                            self._reslice(self._segmentation,
+                                                          slab),
+                                            self._planeKey)
+        
+    def _segmentSITK(self):
+        '''
+        Runs the built-in segmentation on the ordered magnitude frames of
+        the slab and returns the WM probability volume of the slab.
+        '''
+        
+        if self._frames is None:
+            self.loadFrames()
+        
+        geometry    = SELMAInterpolate.getGeometry(self._dcm)
+        spacing     = (geometry.pixelSpacing[1],
+                       geometry.pixelSpacing[0],
+                       geometry.sliceThickness)
+        
+        return SELMASegment.segmentWhiteMatter(self._frames, spacing)
+        
+    def _segmentSPM(self):
+        '''
+        Runs the SPM segmentation and returns the WM probability volume.
+        Raises an ImportError when the matlab engine is not installed.
         '''
+        
+        import matlab.engine
   
         #Prepare for matlab call
         libraries = SELMAInterpolate.getLibraries(self)
@@ -186,13 +369,40 @@ class SELMAT1Dicom(SELMADicom.SELMADicom):
         im = np.swapaxes(im,0,2)
         im = np.swapaxes(im,1,2)
         
-        self._segmentation = im
-
-        # Create interpolated slice
-        pcaShape        = self._pcaDcm.pixel_array.shape
-   
-        self._maskSlice = SELMAInterpolate.doInterpolation(self._M,
-                                                           self._segmentation,
-                                                           pcaShape)
-
-
+        return im
+        
+    def _reslice(self, volume, slab = None):
+        '''
+        Interpolates a volume in the T1 space on the pca slice. The sampling
+        grid is only made once for every shape of volume, so the T1 and 
+        its segmentation use the same grid.
+        
+        Args:
+            volume(numpy.ndarray): the volume in the T1 space.
+            slab(tuple): if given, the volume is only this part of the 
+            ordered magnitude volume, see findSlab.
+        '''
+        
+        shape   = np.shape(volume)
+        starts  = (0, 0, 0)
+        if slab is not None:
+            starts  = tuple(part.start for part in slab)
+        
+        key     = (shape, starts)
+        if key not in self._samplingGrids:
+            if slab is None:
+                grid    = SELMAInterpolate.getSamplingGrid(
+                                                        self._M,
+                                                        shape,
+                                                        self._getPcaShape())
+            else:
+                grid    = SELMAInterpolate.getSamplingGrid(
+                                                self._M,
+                                                self._getVolumeShape(),
+                                                self._getPcaShape())
+                grid    = grid._replace(coordinates = grid.coordinates -
+                                        np.asarray(starts)[:, None])
+            self._samplingGrids[key] = grid
+        
+        return SELMAInterpolate.resliceVolume(volume,
+                                              self._samplingGrids[key])